@@ -0,0 +1,357 @@
+"""
+Benchmarks the /upload/, /analyze/ and /get_image/ pipeline end to end with
+synthetic datasets and a deterministic stand-in for the LLM.
+
+Run from the backend directory:
+
+    python -m benchmarks.run --rows 100000 --output benchmarks/baselines/local.json
+    python -m benchmarks.run --rows 100000 --compare benchmarks/baselines/local.json
+    python -m benchmarks.run --s3 --concurrency 8
+
+Needs moto for --s3 (pip install "moto[s3]").
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import subprocess
+import statistics
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+from benchmarks.synthetic import write_csv, ENCODINGS
+
+S3_BUCKET = "benchmark-bucket"
+
+# Query, then the code the fake LLM answers it with: pandas code for a
+# DataFrame, pandas code over chunks for datasets too large to load, and SQL
+SCENARIOS = [
+    {
+        "name": "aggregate",
+        "query": "total qty by region",
+        "python": "print(df.groupby('region')['qty'].sum())",
+        "chunked": (
+            "import pandas as pd\n"
+            "parts = [chunk.groupby('region')['qty'].sum() for chunk in dataset.chunks(['region', 'qty'])]\n"
+            "print(pd.concat(parts).groupby(level=0).sum())"
+        ),
+        "sql": 'SELECT "region", SUM("qty") AS total FROM df GROUP BY 1 ORDER BY 2 DESC',
+    },
+    {
+        "name": "top_rows",
+        "query": "top 10 rows with the highest price",
+        "python": "print(df.nlargest(10, 'price'))",
+        "chunked": (
+            "import pandas as pd\n"
+            "top = pd.concat(chunk.nlargest(10, 'price') for chunk in dataset.chunks())\n"
+            "print(top.nlargest(10, 'price'))"
+        ),
+        "sql": 'SELECT * FROM df ORDER BY "price" DESC LIMIT 10',
+    },
+    {
+        "name": "describe",
+        "query": "describe the numeric columns",
+        "python": "print(df.describe())",
+        "chunked": "print(dataset.head(1000).describe())",
+        "sql": None,
+    },
+    {
+        "name": "plot",
+        "query": "plot the average price over time",
+        "python": (
+            "import matplotlib.pyplot as plt\n"
+            "df.groupby('day')['price'].mean().plot()\n"
+            "plt.savefig('output.png')"
+        ),
+        "chunked": (
+            "import pandas as pd\n"
+            "import matplotlib.pyplot as plt\n"
+            "parts = [chunk.groupby('day')['price'].agg(['sum', 'count']) for chunk in dataset.chunks(['day', 'price'])]\n"
+            "totals = pd.concat(parts).groupby(level=0).sum()\n"
+            "(totals['sum'] / totals['count']).plot()\n"
+            "plt.savefig('output.png')"
+        ),
+        "sql": None,
+    },
+]
+
+class ScriptedLLM(FakeListChatModel):
+    """
+    Stands in for ChatGoogleGenerativeAI: answers each scenario's query with
+    its canned code, in the language and data access mode the prompt asks for.
+    """
+
+    responses: list = []
+
+    def __init__(self, **kwargs):
+        super().__init__(responses=[""])
+
+    def _call(self, messages, stop=None, run_manager=None, **kwargs):
+        system = str(messages[0].content)
+        query = str(messages[-1].content)
+        scenario = next((s for s in SCENARIOS if s["query"] == query), SCENARIOS[0])
+        if "DuckDB SQL" in system and scenario["sql"]:
+            return scenario["sql"]
+        if "dataset.chunks" in system:
+            return scenario["chunked"]
+        return scenario["python"]
+
+def _percentile(values: list, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+def summarize(values: list) -> dict:
+    """Mean, median, p95 and max of a list of durations in seconds."""
+    if not values:
+        return {}
+    return {
+        "count": len(values),
+        "mean": round(statistics.fmean(values), 6),
+        "p50": round(_percentile(values, 0.5), 6),
+        "p95": round(_percentile(values, 0.95), 6),
+        "max": round(max(values), 6),
+    }
+
+def _gauge(metrics_text: str, name: str):
+    """Reads an unlabelled gauge from the /metrics output."""
+    for line in metrics_text.splitlines():
+        if line.startswith(f"dataquery_{name} "):
+            return float(line.split()[1])
+    return None
+
+class Benchmark:
+    def __init__(self, client, args):
+        self.client = client
+        self.args = args
+
+    def upload(self, path: str) -> tuple[str, float]:
+        start = time.perf_counter()
+        with open(path, "rb") as f:
+            response = self.client.post("/upload/", files={"file": ("data.csv", f, "text/csv")})
+        elapsed = time.perf_counter() - start
+        response.raise_for_status()
+        return response.json()["session_id"], elapsed
+
+    def analyze(self, session_id: str, query: str) -> tuple[dict, float]:
+        start = time.perf_counter()
+        response = self.client.post("/analyze/", data={"session_id": session_id, "user_query": query, "timings": "true"})
+        elapsed = time.perf_counter() - start
+        response.raise_for_status()
+        result = response.json()
+        if result["stderr"] or result["stdout"].startswith("Error during code execution"):
+            print(f"  warning: '{query}' failed: {(result['stderr'] or result['stdout']).strip()[:200]}")
+        return result, elapsed
+
+    def get_image(self, session_id: str, timestamp: str, etag: str | None = None):
+        headers = {"If-None-Match": etag} if etag else {}
+        start = time.perf_counter()
+        response = self.client.get("/get_image/", params={"session_id": session_id, "timestamp": timestamp}, headers=headers)
+        return response, time.perf_counter() - start
+
+    def clear(self, session_id: str):
+        self.client.post("/clear_session/", data={"session_id": session_id})
+
+    def run_dataset(self, path: str) -> dict:
+        """Uploads a dataset, runs every scenario cold and warm, fetches its images, then runs the load test."""
+        report = {"file_bytes": os.path.getsize(path), "scenarios": {}}
+        session_id, report["upload_seconds"] = self.upload(path)
+        image_fetches, image_revalidations = [], []
+        try:
+            for scenario in SCENARIOS:
+                runs = {"cold": [], "warm": []}
+                stages = {}
+                for _ in range(self.args.repeat):
+                    result, elapsed = self.analyze(session_id, scenario["query"])
+                    runs["warm" if result["result_cached"] else "cold"].append(elapsed)
+                    for stage, seconds in result.get("timings", {}).items():
+                        stages.setdefault(stage, []).append(seconds)
+                    for timestamp in result["image_timestamps"]:
+                        response, fetched = self.get_image(session_id, timestamp)
+                        image_fetches.append(fetched)
+                        response, fetched = self.get_image(session_id, timestamp, response.headers.get("etag"))
+                        image_revalidations.append(fetched)
+                report["scenarios"][scenario["name"]] = {
+                    "language": result["language"],
+                    "cold": summarize(runs["cold"]),
+                    "warm": summarize(runs["warm"]),
+                    "stages": {stage: summarize(values) for stage, values in stages.items()},
+                }
+                print(f"  {scenario['name']:<10} {result['language']:<6} cold {report['scenarios'][scenario['name']]['cold'].get('mean', 0):.3f}s")
+            report["get_image"] = {"fetch": summarize(image_fetches), "revalidate": summarize(image_revalidations)}
+        finally:
+            self.clear(session_id)
+        if self.args.concurrency > 1:
+            report["load"] = self.run_load(path)
+        return report
+
+    def run_load(self, path: str) -> dict:
+        """
+        Runs the scenarios from `concurrency` clients at once, each with its own
+        session of the same dataset, and reports throughput and latency.
+        """
+        sessions = [self.upload(path)[0] for _ in range(self.args.concurrency)]
+        requests = [
+            (sessions[i % len(sessions)], SCENARIOS[i % len(SCENARIOS)]["query"])
+            for i in range(self.args.load_requests)
+        ]
+        start = time.perf_counter()
+        try:
+            with ThreadPoolExecutor(max_workers=self.args.concurrency) as executor:
+                latencies = [elapsed for _, elapsed in executor.map(lambda request: self.analyze(*request), requests)]
+        finally:
+            elapsed = time.perf_counter() - start
+            for session_id in sessions:
+                self.clear(session_id)
+        print(f"  load       {len(requests)} requests, {len(requests) / elapsed:.1f} req/s")
+        return {
+            "concurrency": self.args.concurrency,
+            "requests": len(requests),
+            "seconds": round(elapsed, 6),
+            "requests_per_second": round(len(requests) / elapsed, 3),
+            "latency": summarize(latencies),
+        }
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _flatten(report: dict, prefix: str = "") -> dict:
+    """Maps the dotted path of every timing in a report to its value."""
+    values = {}
+    for key, value in report.items():
+        path = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict):
+            values.update(_flatten(value, path))
+        elif isinstance(value, (int, float)) and key in ("mean", "p50", "p95", "upload_seconds", "requests_per_second"):
+            values[path] = value
+    return values
+
+def compare(report: dict, baseline: dict, tolerance: float, min_delta: float) -> list[str]:
+    """
+    Compares the timings of two reports and prints those that changed by more
+    than `tolerance` (a fraction) and `min_delta` seconds, so sub-millisecond
+    noise is ignored. Returns the timings that got slower, or for throughput,
+    lower.
+    """
+    current, previous = _flatten(report["datasets"]), _flatten(baseline["datasets"])
+    regressions = []
+    for path, value in sorted(current.items()):
+        before = previous.get(path)
+        if not before:
+            continue
+        change = (value - before) / before
+        throughput = path.endswith("requests_per_second")
+        if throughput:
+            change = -change
+        if abs(change) <= tolerance or (not throughput and abs(value - before) <= min_delta):
+            continue
+        marker = "REGRESSION" if change > 0 else "improved"
+        print(f"  {path:<70} {before:>10.4f} -> {value:>10.4f} {marker}")
+        if change > 0:
+            regressions.append(path)
+    return regressions
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 200_000], help="Rows of each dataset")
+    parser.add_argument("--extra-columns", type=int, default=4, help="Float columns added to the six base columns")
+    parser.add_argument("--encoding", choices=ENCODINGS, nargs="+", default=["utf-8"], help="Encodings to write datasets in")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs of each scenario per dataset; the first is cold")
+    parser.add_argument("--concurrency", type=int, default=4, help="Concurrent clients of the load test, 1 skips it")
+    parser.add_argument("--load-requests", type=int, default=32, help="Requests sent by the load test")
+    parser.add_argument("--s3", action="store_true", help="Store sessions in a moto-mocked S3 bucket")
+    parser.add_argument("--output", help="Write the report to this JSON file, e.g. as a baseline")
+    parser.add_argument("--compare", help="Baseline report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Slowdown over the baseline reported as a regression")
+    parser.add_argument("--min-delta", type=float, default=0.002, help="Seconds a timing must change by to be reported")
+    return parser.parse_args(argv)
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    os.environ.setdefault("GOOGLE_API_KEY", "benchmark")
+    # Everything the app stores goes to a scratch directory, so the fake
+    # LLM's code never reaches the real codegen cache, histories or uploads
+    scratch_dir = tempfile.mkdtemp(prefix="benchmark_")
+    os.environ.update(
+        LOCAL_STORAGE_PATH=os.path.join(scratch_dir, "uploaded_csv"),
+        HISTORY_STORE_PATH=os.path.join(scratch_dir, "cache", "history.db"),
+        CODEGEN_CACHE_PATH=os.path.join(scratch_dir, "cache", "codegen_cache.db"),
+        S3_CACHE_DIR=os.path.join(scratch_dir, "s3_cache"),
+    )
+    mock = None
+    if args.s3:
+        from moto import mock_aws
+        os.environ.update(
+            S3_BUCKET_NAME=S3_BUCKET, AWS_ACCESS_KEY_ID="benchmark", AWS_SECRET_ACCESS_KEY="benchmark",
+            AWS_DEFAULT_REGION="us-east-1",
+        )
+        mock = mock_aws()
+        mock.start()
+        import boto3
+        boto3.client("s3").create_bucket(Bucket=S3_BUCKET)
+
+    # The app builds its LLM chain on first use, so the fake must be in place before
+    import utils.llmhandler
+    utils.llmhandler.ChatGoogleGenerativeAI = ScriptedLLM
+    import main as app_module
+    from fastapi.testclient import TestClient
+
+    report = {
+        "meta": {
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "storage": "s3" if args.s3 else "local",
+            "args": vars(args),
+        },
+        "datasets": {},
+    }
+    try:
+        with tempfile.TemporaryDirectory(prefix="benchmark_data_") as data_dir, TestClient(app_module.app) as client:
+            benchmark = Benchmark(client, args)
+            for rows in args.rows:
+                for encoding in args.encoding:
+                    name = f"{rows}x{6 + args.extra_columns}-{encoding}"
+                    print(f"{name}:")
+                    path = write_csv(os.path.join(data_dir, f"{name}.csv"), rows, args.extra_columns, encoding)
+                    report["datasets"][name] = benchmark.run_dataset(path)
+            metrics_text = client.get("/metrics").text
+        report["memory"] = {
+            "process_peak_rss_bytes": _gauge(metrics_text, "process_peak_rss_bytes"),
+            "sandbox_peak_rss_bytes": _gauge(metrics_text, "sandbox_peak_rss_bytes"),
+        }
+    finally:
+        if mock:
+            mock.stop()
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    print(f"peak RSS: API {report['memory']['process_peak_rss_bytes'] or 0:.0f} B, sandbox {report['memory']['sandbox_peak_rss_bytes'] or 0:.0f} B")
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output}")
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+        print(f"Compared with {args.compare} ({baseline['meta'].get('commit')}):")
+        if baseline["meta"].get("storage") != report["meta"]["storage"]:
+            print(f"  note: the baseline used {baseline['meta'].get('storage')} storage, this run {report['meta']['storage']}")
+        regressions = compare(report, baseline, args.tolerance, args.min_delta)
+        if regressions:
+            print(f"{len(regressions)} timings regressed by more than {args.tolerance:.0%}")
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    # Sandbox workers are started with forkserver, which re-imports this
+    # module, so nothing may run on import
+    sys.exit(main())
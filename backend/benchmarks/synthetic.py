@@ -0,0 +1,42 @@
+import numpy as np
+import pandas as pd
+
+# Encodings datasets can be written in; utf-8-sig is UTF-8 with a BOM
+ENCODINGS = ("utf-8", "utf-8-sig", "cp1252")
+# Text with characters outside ASCII, so the encoding matters
+REGIONS = ["Zürich", "São Paulo", "Montréal", "Köln", "Málaga", "Aarhus", "Dublin", "Łódź"]
+REGIONS_CP1252 = [name.replace("Ł", "L").replace("ź", "z") for name in REGIONS]
+ROWS_PER_CHUNK = 100_000
+
+def _chunk(start: int, rows: int, extra_columns: int, regions: list, rng) -> pd.DataFrame:
+    data = {
+        "id": np.arange(start, start + rows),
+        "region": rng.choice(regions, rows),
+        "qty": rng.integers(0, 500, rows),
+        "price": np.round(rng.uniform(0.5, 999.0, rows), 2),
+        "day": pd.Timestamp("2024-01-01") + pd.to_timedelta(rng.integers(0, 365, rows), unit="D"),
+        "note": [f"order {i} café" for i in range(start, start + rows)],
+    }
+    for i in range(extra_columns):
+        data[f"x{i}"] = np.round(rng.normal(100, 15, rows), 3)
+    frame = pd.DataFrame(data)
+    frame["day"] = frame["day"].dt.strftime("%Y-%m-%d")
+    # A few missing values, as real exports have
+    frame.loc[frame.index % 97 == 0, "price"] = np.nan
+    return frame
+
+def write_csv(path: str, rows: int, extra_columns: int = 0, encoding: str = "utf-8", seed: int = 0) -> str:
+    """
+    Writes a synthetic sales dataset: id, region (non-ASCII text), qty,
+    price (with missing values), day, note, plus extra_columns float columns
+    x0, x1, ... Written chunk by chunk, so large datasets fit in memory.
+    """
+    if encoding not in ENCODINGS:
+        raise ValueError(f"Unsupported encoding {encoding}, expected one of {ENCODINGS}")
+    regions = REGIONS_CP1252 if encoding == "cp1252" else REGIONS
+    rng = np.random.default_rng(seed)
+    with open(path, "w", encoding=encoding, newline="") as f:
+        for start in range(0, rows, ROWS_PER_CHUNK):
+            chunk = _chunk(start, min(ROWS_PER_CHUNK, rows - start), extra_columns, regions, rng)
+            chunk.to_csv(f, index=False, header=start == 0)
+    return path
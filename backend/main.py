@@ -1,47 +1,140 @@
-from fastapi import FastAPI, UploadFile, File, Form, Query
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi import FastAPI, UploadFile, File, Form, Query, Header
+from fastapi.responses import (
+    JSONResponse, FileResponse, PlainTextResponse, StreamingResponse, RedirectResponse, Response
+)
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.background import BackgroundTask
 import os
+import json
 import uuid
 import shutil
+import time
+import asyncio
+import tempfile
+from contextlib import asynccontextmanager
 from pathlib import Path
-import boto3
 from botocore.exceptions import NoCredentialsError, PartialCredentialsError, ClientError
-from utils.llmhandler import generate_code_from_query, clear_memory
+from utils.llmhandler import (
+    agenerate_code_from_query, clear_memory, route_query, history_version, rollback_history, warm_up as warm_up_llm,
+    LANGUAGE_PYTHON, LANGUAGE_SQL
+)
 from utils.pythonexecutor import run_generated_code
-from utils.processdata import extract_csv_metadata_and_sample
+from utils.sql_engine import run_sql
+from utils.processdata import extract_csv_metadata_and_sample, save_profile, PROFILE_FILE
+from utils.dataloader import store_encoding
 from datetime import datetime
-from utils import local_storage
+from utils import local_storage, result_cache, s3_cache
+from utils.dataframe_cache import evict_file, cache_stats
+from utils.sandbox import release_shared_dataframe, get_sandbox_pool, shutdown_sandbox, SANDBOX_WALL_SECONDS
+from utils.artifacts import ensure_artifacts, memory_report
+from utils.ingest import (
+    StreamingIngest, S3MultipartUpload, UPLOAD_CHUNK_BYTES, MAX_UPLOAD_MB
+)
+from utils.concurrency import run_io, run_cpu, run_exec, pool_stats, PoolSaturatedError
+from utils.prompt_builder import prompt_stats
+from utils.cleanup import (
+    delete_s3_prefix, sessions_to_reap, SESSION_TTL_HOURS, DISK_QUOTA_MB, REAPER_INTERVAL_SECONDS
+)
+from utils.jobs import Job, JobLimitError, job_manager, format_sse
+from utils.metrics import inc, timed, observe_stage, record_cache, record_io, start_request_timings, render
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await init_storage()
+    warm_up_task = asyncio.create_task(warm_up())
+    reaper = asyncio.create_task(reaper_loop()) if SESSION_TTL_HOURS or DISK_QUOTA_MB else None
+    yield
+    warm_up_task.cancel()
+    if reaper:
+        reaper.cancel()
+    # Stops the workers and frees the shared memory blocks, which outlive the process otherwise
+    await run_io(shutdown_sandbox)
+
+app = FastAPI(lifespan=lifespan)
+
+# Image names are unique per analysis and never rewritten, so clients may
+# keep them for IMAGE_MAX_AGE seconds without revalidating
+IMAGE_MAX_AGE = int(os.getenv("IMAGE_MAX_AGE", "86400"))
+IMAGE_CACHE_CONTROL = f"private, max-age={IMAGE_MAX_AGE}, immutable"
+# How /get_image/ serves images from S3: "stream" passes the object body
+# through, "presigned" redirects to a presigned URL (the bucket needs CORS
+# rules for browsers to follow it)
+IMAGE_DELIVERY = os.getenv("IMAGE_DELIVERY", "stream")
+PRESIGNED_URL_SECONDS = int(os.getenv("PRESIGNED_URL_SECONDS", "3600"))
+IMAGE_STREAM_CHUNK_BYTES = 256 * 1024
 
 # --- Storage Configuration ---
 USE_S3 = False
 S3_BUCKET = os.getenv("S3_BUCKET_NAME")
 s3 = None
 
-try:
-    if S3_BUCKET:
-        s3 = boto3.client("s3")
+# Component -> "pending", "ready" or why it is not; reported by /ready/
+readiness = {"storage": "pending", "sandbox": "pending", "llm": "pending"}
+
+# Longest wait for the bucket check at startup before falling back to local storage
+STORAGE_INIT_TIMEOUT = float(os.getenv("STORAGE_INIT_TIMEOUT", "10"))
+
+def connect_s3():
+    """Creates the S3 client and checks the bucket is reachable. Returns the client, or None."""
+    try:
+        if not S3_BUCKET:
+            print("S3_BUCKET_NAME not found.")
+            return None
+        # boto3 is only imported when S3 is configured
+        import boto3
+        client = boto3.client("s3")
         # Check if we can access the bucket
-        s3.head_bucket(Bucket=S3_BUCKET)
-        USE_S3 = True
+        client.head_bucket(Bucket=S3_BUCKET)
         print("S3 configuration is valid. Using S3 for file storage.")
-    else:
-        print("S3_BUCKET_NAME not found.")
-except (NoCredentialsError, PartialCredentialsError):
-    print("AWS credentials not found.")
-except ClientError as e:
-    if e.response['Error']['Code'] == '404':
-        print(f"S3 bucket '{S3_BUCKET}' not found.")
-    else:
-        print(f"An S3 client error occurred: {e}")
-except Exception as e:
-    print(f"An unexpected error occurred with S3 setup: {e}")
+        return client
+    except (NoCredentialsError, PartialCredentialsError):
+        print("AWS credentials not found.")
+    except ClientError as e:
+        if e.response['Error']['Code'] == '404':
+            print(f"S3 bucket '{S3_BUCKET}' not found.")
+        else:
+            print(f"An S3 client error occurred: {e}")
+    except Exception as e:
+        print(f"An unexpected error occurred with S3 setup: {e}")
+    return None
+
+async def init_storage():
+    """
+    Picks the storage at startup: S3 if the bucket answers within
+    STORAGE_INIT_TIMEOUT seconds, local storage otherwise.
+    """
+    global s3, USE_S3
+    try:
+        s3 = await asyncio.wait_for(run_io(connect_s3), STORAGE_INIT_TIMEOUT)
+    except asyncio.TimeoutError:
+        print(f"S3 bucket '{S3_BUCKET}' did not answer within {STORAGE_INIT_TIMEOUT}s.")
+        s3 = None
+    USE_S3 = s3 is not None
+    if not USE_S3:
+        print("Using local storage as a fallback.")
+        await run_io(local_storage.setup_local_storage)
+    readiness["storage"] = "ready"
+
+async def warm_up():
+    """
+    Starts the sandbox workers and builds the LLM client in the background,
+    so the first analysis does not pay for them.
+    """
+    async def sandbox():
+        pool = await run_io(get_sandbox_pool)
+        return await run_io(pool.warm_up, SANDBOX_WALL_SECONDS)
 
-if not USE_S3:
-    print("Using local storage as a fallback.")
-    local_storage.setup_local_storage()
+    async def llm():
+        await run_io(warm_up_llm)
+
+    async def check(name: str, warm):
+        try:
+            readiness[name] = "ready" if await warm() is not False else "timed out"
+        except Exception as e:
+            print(f"Warm-up of {name} failed: {e}")
+            readiness[name] = f"failed: {e}"
+
+    await asyncio.gather(check("sandbox", sandbox), check("llm", llm))
 
 app.add_middleware(
     CORSMiddleware,
@@ -54,162 +147,728 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.exception_handler(PoolSaturatedError)
+@app.exception_handler(JobLimitError)
+async def pool_saturated_handler(request, exc: RuntimeError):
+    return JSONResponse(content={"error": f"Server busy: {exc}"}, status_code=503)
+
+def invalid_session(session_id: str):
+    """
+    Returns an error response for a session id that is not a UUID, which
+    could otherwise name a path outside its session. None for valid ids.
+    """
+    if local_storage.is_valid_session_id(session_id):
+        return None
+    return JSONResponse(content={"error": "Invalid session_id"}, status_code=400)
+
+def s3_blob_prefix(content_hash: str) -> str:
+    return f"blobs/{content_hash}/"
+
+def s3_object_exists(key: str) -> bool:
+    try:
+        s3.head_object(Bucket=S3_BUCKET, Key=key)
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+
+def load_s3_manifest(session_id: str):
+    """
+    Returns a session's upload manifest, from the local session directory or
+    from the bucket when another server handled the upload. None for sessions
+    from before the blob store.
+    """
+    manifest = local_storage.load_upload_manifest(session_id)
+    if manifest:
+        return manifest
+    try:
+        body = s3.get_object(Bucket=S3_BUCKET, Key=f"sessions/{session_id}/{local_storage.UPLOAD_MANIFEST}")["Body"]
+        manifest = json.loads(body.read())
+    except ClientError:
+        return None
+    local_storage.save_upload_manifest(session_id, manifest)
+    return manifest
+
+def release_s3_blob_ref(session_id: str, content_hash: str) -> list[str]:
+    """
+    Drops a session's reference to a blob in the bucket and deletes the blob
+    once no session references it any more. Returns the deleted keys.
+    """
+    prefix = s3_blob_prefix(content_hash)
+    s3.delete_object(Bucket=S3_BUCKET, Key=f"{prefix}refs/{session_id}")
+    if s3.list_objects_v2(Bucket=S3_BUCKET, Prefix=f"{prefix}refs/", MaxKeys=1).get("Contents"):
+        return []
+    keys, errors = delete_s3_prefix(s3, S3_BUCKET, prefix)
+    for error in errors:
+        print(error)
+    s3_cache.evict_prefix(S3_BUCKET, prefix)
+    # The local blob directory only holds derived files in S3 mode
+    local_storage.release_blob_ref(session_id, content_hash)
+    return keys
+
+def ensure_s3_blob(session_id: str, content_hash: str, csv_path: str, columnar_path: str | None) -> bool:
+    """
+    Makes sure the bucket holds a session's reference to a blob and the blob
+    itself, uploading the blob from its local copy when it is missing.
+    Reference changes are not locked in S3: a session releasing the last
+    other reference may delete the blob, and with it this reference, between
+    an upload's check for the blob and its reference write, so uploads call
+    this once more when they are done.
+
+    Returns:
+        bool: True if the blob had to be uploaded.
+    """
+    prefix = s3_blob_prefix(content_hash)
+    s3.put_object(Bucket=S3_BUCKET, Key=f"{prefix}refs/{session_id}", Body=b"")
+    if s3_object_exists(prefix + local_storage.BLOB_FILE_NAME):
+        return False
+    print(f"Blob {content_hash} was deleted during an upload, storing it again.")
+    if columnar_path:
+        s3.upload_file(columnar_path, S3_BUCKET, prefix + os.path.basename(columnar_path))
+    # The CSV last, as its presence marks the blob complete
+    s3.upload_file(csv_path, S3_BUCKET, prefix + local_storage.BLOB_FILE_NAME)
+    return True
+
+async def receive_upload(file: UploadFile, ingest: StreamingIngest, s3_upload=None):
+    """
+    Reads the request body in chunks and feeds them to the ingest, and to an
+    S3 multipart upload when one is given, without blocking the event loop.
+    Returns an error response if the upload is rejected, otherwise None.
+    """
+    max_bytes = MAX_UPLOAD_MB * 1024 * 1024
+    while True:
+        chunk = await file.read(UPLOAD_CHUNK_BYTES)
+        if not chunk:
+            break
+        if max_bytes and ingest.size + len(chunk) > max_bytes:
+            return JSONResponse(content={"error": f"File exceeds the {MAX_UPLOAD_MB} MB upload limit"}, status_code=413)
+        if s3_upload:
+            await s3_upload.write(chunk)
+        await run_io(ingest.write, chunk)
+    if ingest.size == 0:
+        return JSONResponse(content={"error": "Uploaded file is empty"}, status_code=400)
+    return None
+
 @app.post("/upload/")
 async def upload_csv(file: UploadFile = File(...)):
+    if not file.filename or not file.filename.lower().endswith(".csv"):
+        return JSONResponse(content={"error": "Only CSV files can be uploaded"}, status_code=400)
     session_id = str(uuid.uuid4())
+    file_name = os.path.basename(file.filename)
+
+    # Datasets are stored once per content hash; the hash is only known once
+    # the whole file has arrived, so the upload is staged first
+    if USE_S3:
+        staging_key = f"sessions/{session_id}/{file_name}"
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            ingest = StreamingIngest(os.path.join(tmp_dir, local_storage.BLOB_FILE_NAME))
+            s3_upload = S3MultipartUpload(s3, S3_BUCKET, staging_key)
+            try:
+                with timed("upload_receive"):
+                    error = await receive_upload(file, ingest, s3_upload)
+                with timed("ingest_finish"):
+                    result = None if error else await run_cpu(ingest.finish)
+            except Exception:
+                await s3_upload.abort()
+                await run_io(ingest.abort)
+                raise
+            if error:
+                await s3_upload.abort()
+                await run_io(ingest.abort)
+                return error
+
+            prefix = s3_blob_prefix(result["sha256"])
+            blob_key = prefix + local_storage.BLOB_FILE_NAME
+            created = not await run_io(s3_object_exists, blob_key)
+            if created:
+                with timed("blob_store"):
+                    await s3_upload.complete()
+                    # Server-side copy into the blob, done in parts for large files
+                    await run_io(s3.copy, {"Bucket": S3_BUCKET, "Key": staging_key}, S3_BUCKET, blob_key)
+                    await run_io(s3.delete_object, Bucket=S3_BUCKET, Key=staging_key)
+                    if result["columnar_path"]:
+                        columnar_key = prefix + os.path.basename(result["columnar_path"])
+                        await run_io(s3.upload_file, result["columnar_path"], S3_BUCKET, columnar_key)
+            else:
+                # Already stored by an earlier session, the bytes are not kept
+                await s3_upload.abort()
+            await run_io(s3.put_object, Bucket=S3_BUCKET, Key=f"{prefix}refs/{session_id}", Body=b"")
+            manifest = {"file_name": file_name, "sha256": result["sha256"], "size": result["size"]}
+            await run_io(
+                s3.put_object, Bucket=S3_BUCKET, Key=f"sessions/{session_id}/{local_storage.UPLOAD_MANIFEST}",
+                Body=json.dumps(manifest).encode("utf-8")
+            )
+            await run_io(local_storage.save_upload_manifest, session_id, manifest)
+            if created or not (local_storage.get_dataset_dir(session_id) / PROFILE_FILE).exists():
+                data_path = result["columnar_path"] or ingest.csv_path
+                if result["profile"] is not None:
+                    await run_io(save_profile, session_id, data_path, result["profile"])
+                else:
+                    await run_cpu(extract_csv_metadata_and_sample, data_path, session_id)
+            # Built while the staged copy is at hand, skipped if already present
+            with timed("artifacts"):
+                await run_cpu(ensure_artifacts, result["columnar_path"] or ingest.csv_path, session_id)
+            # The blob may have been deleted by a concurrent release since it was checked
+            with timed("blob_store"):
+                await run_io(ensure_s3_blob, session_id, result["sha256"], ingest.csv_path, result["columnar_path"])
+    else:
+        staging_dir = await run_io(local_storage.get_staging_dir)
+        ingest = StreamingIngest(str(staging_dir / local_storage.BLOB_FILE_NAME))
+        try:
+            with timed("upload_receive"):
+                error = await receive_upload(file, ingest)
+            with timed("ingest_finish"):
+                result = None if error else await run_cpu(ingest.finish)
+        except Exception:
+            await run_io(ingest.abort)
+            await run_io(shutil.rmtree, staging_dir, True)
+            raise
+        if error:
+            await run_io(ingest.abort)
+            await run_io(shutil.rmtree, staging_dir, True)
+            return error
+
+        with timed("blob_store"):
+            _, created = await run_io(local_storage.commit_blob, session_id, staging_dir, result["sha256"])
+        manifest = {"file_name": file_name, "sha256": result["sha256"], "size": result["size"]}
+        await run_io(local_storage.save_upload_manifest, session_id, manifest)
+        if created:
+            csv_path = local_storage.get_blob_dir(result["sha256"]) / local_storage.BLOB_FILE_NAME
+            await run_io(store_encoding, str(csv_path), session_id, result["encoding"])
+            data_path = local_storage.get_session_file(session_id)
+            # Profile once per dataset; /analyze/ reads the stored result
+            if result["profile"] is not None:
+                await run_io(save_profile, session_id, data_path, result["profile"])
+            else:
+                await run_cpu(extract_csv_metadata_and_sample, data_path, session_id)
+            with timed("artifacts"):
+                await run_cpu(ensure_artifacts, data_path, session_id)
+
+    record_io("upload", nbytes=result["size"])
+    memory = await run_io(memory_report, session_id)
+    return {
+        "session_id": session_id,
+        "file_name": file.filename,
+        "content_hash": result["sha256"],
+        "size": result["size"],
+        "deduplicated": not created,
+        "memory_saved_bytes": memory["saved_bytes"] if memory else None
+    }
+
+async def execute_code(session_id: str, code: str, local_path: str, artifacts_dir: str | None = None,
+                       language: str = LANGUAGE_PYTHON, job: Job | None = None) -> dict:
+    """
+    Runs generated code in the sandbox, or a generated SQL query in the
+    embedded engine, and stores the images it produces. Code run for a job
+    streams its stdout to the job and stops when the job is cancelled.
+    Returns its stdout, stderr, flags and the keys of its images.
+    """
+    if language == LANGUAGE_SQL:
+        output, error, flags, _ = await run_cpu(run_sql, code, local_path, session_id)
+        return {"stdout": output, "stderr": error, "flags": flags, "image_keys": [], "image_timestamps": []}
+
+    # Microseconds keep image names unique across analyses in the same session
+    timestamp = datetime.utcnow().strftime("%Y%m%d%H%M%S%f")
+    image_name = f"output_{timestamp}"
+    on_output = (lambda text: job.emit_threadsafe("stdout", {"text": text})) if job else None
+    cancelled = job.cancelled if job else None
+
+    image_keys = []
+    image_timestamps = []
     if USE_S3:
-        s3_key = f"sessions/{session_id}/{file.filename}"
-        s3.upload_fileobj(file.file, S3_BUCKET, s3_key)
+        # Images land in a per-request scratch directory and are uploaded from there
+        with tempfile.TemporaryDirectory() as output_dir:
+            output, error, flags, images = await run_exec(
+                run_generated_code, code, local_path, session_id, output_dir, image_name, artifacts_dir,
+                on_output, cancelled
+            )
+            variants = await save_image_variants(images)
+            with timed("image_upload"):
+                for path in images + variants:
+                    image_s3_key = f"sessions/{session_id}/{os.path.basename(path)}"
+                    await run_io(
+                        s3.upload_file, path, S3_BUCKET, image_s3_key,
+                        ExtraArgs={"ContentType": local_storage.image_media_type(path), "CacheControl": IMAGE_CACHE_CONTROL}
+                    )
+                    record_io("image_upload", nbytes=os.path.getsize(path))
+                    if path in images:
+                        image_keys.append(image_s3_key)
     else:
-        local_storage.save_uploaded_file(session_id, file)
-    
-    return {"session_id": session_id, "file_name": file.filename}
+        # Images are written straight into the session directory
+        output_dir = str(local_storage.get_session_dir(session_id))
+        output, error, flags, images = await run_exec(
+            run_generated_code, code, local_path, session_id, output_dir, image_name, artifacts_dir,
+            on_output, cancelled
+        )
+        await save_image_variants(images)
+    for path in images:
+        # /get_image/ addresses images by the part of the name after "output_"
+        image_timestamps.append(Path(path).stem[len("output_"):])
+    if not USE_S3:
+        # For local storage, the key is the timestamp
+        image_keys = image_timestamps
+
+    return {
+        "stdout": output,
+        "stderr": error,
+        "flags": flags,
+        "image_keys": image_keys,
+        "image_timestamps": image_timestamps
+    }
+
+async def save_image_variants(images: list[str]) -> list[str]:
+    """Writes the configured variants of each image, returns their paths."""
+    variants = []
+    if local_storage.IMAGE_VARIANTS:
+        with timed("image_variants"):
+            for path in images:
+                variants += await run_cpu(local_storage.save_output_image, path)
+    return variants
+
+async def run_analysis(session_id: str, code: str, local_path: str, artifacts_dir: str | None = None,
+                       language: str = LANGUAGE_PYTHON, job: Job | None = None) -> tuple[dict, bool]:
+    """
+    Executes generated code unless the same code already ran on the same
+    version of the dataset, in which case the stored result is returned.
+
+    Returns:
+        tuple: (the result, whether it came from the result cache)
+    """
+    result_key = await run_io(result_cache.result_key, code, local_path, language)
+    result = await run_io(result_cache.load_result, session_id, result_key)
+    if result and not USE_S3 and not all(
+        local_storage.get_image_path(session_id, image_timestamp)
+        for image_timestamp in result["image_timestamps"]
+    ):
+        result = None
+    record_cache("result", result is not None)
+    if result is not None:
+        return result, True
+    with timed("execute"):
+        result = await execute_code(session_id, code, local_path, artifacts_dir, language, job)
+    await run_io(result_cache.save_result, session_id, result_key, result)
+    return result, False
 
 @app.post("/analyze/")
 async def analyze_csv(
     session_id: str = Form(...),
-    user_query: str = Form(...)
+    user_query: str = Form(...),
+    timings: bool = Form(False)
 ):
-    local_path = None
-    if USE_S3:
-        prefix = f"sessions/{session_id}/"
-        response = s3.list_objects_v2(Bucket=S3_BUCKET, Prefix=prefix)
-        files = response.get("Contents", [])
-        if not files:
-            return JSONResponse(content={"error": "No file found for session"}, status_code=404)
-        s3_key = files[0]["Key"]
-        
-        # Define a local path for temporary processing
-        local_path = f"/tmp/{os.path.basename(s3_key)}"
-        os.makedirs(os.path.dirname(local_path), exist_ok=True)
-        s3.download_file(S3_BUCKET, s3_key, local_path)
-    else:
-        local_path = local_storage.get_session_file(session_id)
-        if not local_path:
-            return JSONResponse(content={"error": "No file found for session"}, status_code=404)
-
-    csv_info = extract_csv_metadata_and_sample(local_path)
-    code = generate_code_from_query(session_id, local_path, user_query)
-    output, error, flags = run_generated_code(code, local_path)
-
-    image_key = None
-    timestamp = datetime.utcnow().strftime("%Y%m%d%H%M%S")
-    image_path = "output.png"
-
-    if os.path.exists(image_path):
-        if USE_S3:
-            image_s3_key = f"sessions/{session_id}/output_{timestamp}.png"
-            s3.upload_file(image_path, S3_BUCKET, image_s3_key)
-            image_key = image_s3_key
-        else:
-            # For local storage, the key is the timestamp
-            local_storage.save_output_image(session_id, image_path, timestamp)
-            image_key = timestamp
+    error = invalid_session(session_id)
+    if error:
+        return error
+    response, status_code = await analysis_pipeline(session_id, user_query, timings)
+    return JSONResponse(content=response, status_code=status_code)
+
+async def analysis_pipeline(session_id: str, user_query: str, timings: bool = False, job: Job | None = None):
+    """
+    Answers a query about a session's dataset: locates the dataset, generates
+    code for the query and runs it. Run as a job, each stage, the generated
+    code, the printed output and the images are reported as job events, and
+    cancelling the job stops the code it runs.
+
+    Returns:
+        tuple: (the response, its HTTP status code)
+    """
+    def emit(event, data):
+        if job:
+            job.emit(event, data)
+
+    start = time.perf_counter()
+    stage_timings = start_request_timings()
+    await run_io(local_storage.touch_session, session_id)
+    emit("stage", {"stage": "loading"})
+    with timed("storage_fetch"):
+        local_path = await locate_dataset(session_id)
+    if not local_path:
+        return {"error": "No file found for session"}, 404
+
+    with timed("metadata"):
+        csv_info = await run_cpu(extract_csv_metadata_and_sample, local_path, session_id)
+    # Sessions whose artifacts were not built at upload get them on first use
+    with timed("artifacts"):
+        artifacts_dir = await run_cpu(ensure_artifacts, local_path, session_id)
+    # Filters and aggregates are answered with SQL, anything else with Python
+    language = route_query(user_query)
+    if language == LANGUAGE_SQL:
+        version = await run_io(history_version, session_id)
+    emit("stage", {"stage": "generating", "language": language})
+    with timed("generate"):
+        code = await agenerate_code_from_query(session_id, local_path, user_query, csv_info=csv_info, language=language)
+    emit("code", {"code": code, "language": language})
+    emit("stage", {"stage": "executing"})
+    result, result_cached = await run_analysis(session_id, code, local_path, artifacts_dir, language, job)
+    if language == LANGUAGE_SQL and result["stderr"] and not result["flags"]["stdout_generated"]:
+        # The query was not expressible as SQL after all. The failed exchange
+        # is dropped so later prompts only see the Python answer
+        await run_io(rollback_history, session_id, version)
+        language = LANGUAGE_PYTHON
+        emit("stage", {"stage": "generating", "language": language})
+        with timed("generate"):
+            code = await agenerate_code_from_query(session_id, local_path, user_query, csv_info=csv_info)
+        emit("code", {"code": code, "language": language})
+        emit("stage", {"stage": "executing"})
+        result, result_cached = await run_analysis(session_id, code, local_path, artifacts_dir, job=job)
+
+    image_keys = result["image_keys"]
+    image_timestamps = result["image_timestamps"]
+    image_key = image_keys[0] if image_keys else None
+    if result_cached or language == LANGUAGE_SQL:
+        # Only sandboxed code streams its output while it runs
+        emit("stdout", {"text": result["stdout"]})
+    for key, image_timestamp in zip(image_keys, image_timestamps):
+        emit("image", {"image_key": key, "image_timestamp": image_timestamp})
 
     response = {
         "metadata_and_sample": csv_info,
         "generated_code": code,
-        "stdout": output,
-        "stderr": error,
-        "flags": flags,
+        "language": language,
+        "stdout": result["stdout"],
+        "stderr": result["stderr"],
+        "flags": result["flags"],
         "image_key": image_key,
-        "image_timestamp": timestamp if image_key else None
+        "image_timestamp": image_timestamps[0] if image_key else None,
+        "image_keys": image_keys,
+        "image_timestamps": image_timestamps,
+        "result_cached": result_cached
     }
+    elapsed = time.perf_counter() - start
+    if timings:
+        response["timings"] = {**stage_timings, "total": round(elapsed, 6)}
+    observe_stage("analyze", elapsed)
+    return response, 200
+
+async def locate_dataset(session_id: str):
+    """
+    Returns a local path of a session's dataset, preferring its columnar copy;
+    in S3 mode it is served from the local S3 cache. None if there is none.
+    """
+    if USE_S3:
+        manifest = await run_io(load_s3_manifest, session_id)
+        # Sessions from before the blob store keep the data under their own prefix
+        prefix = s3_blob_prefix(manifest["sha256"]) if manifest else f"sessions/{session_id}/"
+        response = await run_io(s3.list_objects_v2, Bucket=S3_BUCKET, Prefix=prefix)
+        etags = {obj["Key"]: obj["ETag"] for obj in response.get("Contents", [])}
+        # Prefer the columnar copy, then the raw CSV
+        data_keys = (
+            [key for key in etags if key.endswith(local_storage.COLUMNAR_SUFFIXES)]
+            or [key for key in etags if key.endswith(".csv")]
+        )
+        if not data_keys:
+            return None
+        s3_key = data_keys[0]
+
+        # Served from the local S3 cache, downloaded only when the ETag changed
+        return await run_io(s3_cache.fetch, s3, S3_BUCKET, s3_key, etags[s3_key])
+    return local_storage.get_session_file(session_id)
+
+@app.post("/jobs/")
+async def submit_job(
+    session_id: str = Form(...),
+    user_query: str = Form(...),
+    timings: bool = Form(False)
+):
+    """
+    Starts an analysis in the background and returns its job id right away.
+    A query already running (or recently answered) for the session returns
+    that job instead of starting a new one.
+    """
+    error = invalid_session(session_id)
+    if error:
+        return error
+    job, deduplicated = job_manager.submit(
+        session_id, user_query, lambda job: analysis_pipeline(session_id, user_query, timings, job)
+    )
+    return JSONResponse(
+        content={"job_id": job.id, "status": job.status, "deduplicated": deduplicated},
+        status_code=202
+    )
+
+@app.get("/jobs/{job_id}/")
+async def get_job(job_id: str):
+    """Reports a job's status, and its result once it has finished."""
+    job = job_manager.get(job_id)
+    if not job:
+        return JSONResponse(content={"error": "Job not found"}, status_code=404)
+    return JSONResponse(content=job.to_dict())
+
+@app.get("/jobs/{job_id}/events/")
+async def stream_job_events(job_id: str, last_event_id: str | None = Header(None)):
+    """
+    Streams a job's events as server-sent events until it finishes. Clients
+    reconnecting with a Last-Event-ID header get only the events they missed.
+    """
+    job = job_manager.get(job_id)
+    if not job:
+        return JSONResponse(content={"error": "Job not found"}, status_code=404)
+    after = int(last_event_id) if last_event_id and last_event_id.isdigit() else -1
 
-    return JSONResponse(content=response)
+    async def events():
+        async for event_id, event, data in job.events_after(after):
+            yield format_sse(event_id, event, data)
+
+    return StreamingResponse(
+        events(), media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.post("/jobs/{job_id}/cancel/")
+async def cancel_job(job_id: str):
+    """Cancels a job, stopping the code it is running."""
+    job = job_manager.get(job_id)
+    if not job:
+        return JSONResponse(content={"error": "Job not found"}, status_code=404)
+    if not job_manager.cancel(job):
+        return JSONResponse(content={"error": f"Job already {job.status}"}, status_code=409)
+    return JSONResponse(content={"job_id": job.id, "cancelled": True})
 
 @app.post("/clear_session/")
 async def clear_session(session_id: str = Form(...)):
-    deletion_success = True
+    error = invalid_session(session_id)
+    if error:
+        return error
+    error_messages = await delete_session(session_id)
+    if not error_messages:
+        return JSONResponse(content={"status": "session cleared successfully"})
+    else:
+        return JSONResponse(
+            content={
+                "status": "session cleanup partially failed",
+                "errors": error_messages
+            },
+            status_code=500
+        )
+
+async def delete_session(session_id: str, local_only: bool = False) -> list[str]:
+    """
+    Deletes everything a session left behind: its files, locally or in the
+    bucket, its reference to its dataset blob, its history, cached frames and
+    temporary files. Its unfinished jobs are cancelled first. With local_only
+    the bucket is left alone and only this server's copies are removed.
+    Returns the errors met, empty if the session is gone.
+    """
+    job_manager.cancel_session(session_id)
     error_messages = []
+    # Local copies of datasets no session references any more
+    released_paths = []
 
     # Step 1: Clear storage (S3 or local)
     try:
-        if USE_S3:
+        if USE_S3 and local_only:
+            await run_io(shutil.rmtree, local_storage.LOCAL_STORAGE_PATH / session_id, True)
+        elif USE_S3:
+            manifest = await run_io(load_s3_manifest, session_id)
             prefix = f"sessions/{session_id}/"
-            # List all objects including potential hidden files
-            response = s3.list_objects_v2(Bucket=S3_BUCKET, Prefix=prefix)
-            files = response.get("Contents", [])
-            if files:
-                for obj in files:
-                    try:
-                        s3.delete_object(Bucket=S3_BUCKET, Key=obj["Key"])
-                    except Exception as e:
-                        error_messages.append(f"Failed to delete S3 object {obj['Key']}: {str(e)}")
-                        deletion_success = False
-            
-            # Double-check deletion
-            check_response = s3.list_objects_v2(Bucket=S3_BUCKET, Prefix=prefix)
-            if check_response.get("Contents"):
-                error_messages.append("Some S3 objects remained after deletion attempt")
-                deletion_success = False
+            released_keys, errors = await run_io(delete_s3_prefix, s3, S3_BUCKET, prefix)
+            error_messages += errors
+            s3_cache.evict_prefix(S3_BUCKET, prefix)
+
+            # The dataset itself is deleted with its last referencing session
+            if manifest:
+                released_keys += await run_io(release_s3_blob_ref, session_id, manifest["sha256"])
+            released_paths = [str(s3_cache.cache_path(S3_BUCKET, key)) for key in released_keys]
+            await run_io(shutil.rmtree, local_storage.LOCAL_STORAGE_PATH / session_id, True)
         else:
             # Local storage cleanup
-            if not local_storage.clear_local_session(session_id):
+            data_path = local_storage.get_session_file(session_id)
+            if not await run_io(local_storage.clear_local_session, session_id):
                 error_messages.append("Failed to fully clear local session directory")
-                deletion_success = False
+            if data_path and not os.path.exists(data_path):
+                released_paths.append(data_path)
     except Exception as e:
         error_messages.append(f"Storage cleanup error: {str(e)}")
-        deletion_success = False
 
     # Step 2: Clear memory
     try:
         clear_memory(session_id)
+        for path in released_paths:
+            evict_file(path)
+            release_shared_dataframe(path)
     except Exception as e:
         error_messages.append(f"Memory cleanup error: {str(e)}")
-        deletion_success = False
 
-    # Step 3: Clear any temporary files
-    try:
-        temp_patterns = [
-            f"/tmp/*{session_id}*",
-            f"/tmp/finanalyst_sessions/{session_id}*",
-            f"output_{session_id}_*.png"
-        ]
-        for pattern in temp_patterns:
-            for temp_file in Path("/tmp").glob(pattern):
-                try:
-                    if temp_file.is_file():
-                        os.remove(temp_file)
-                    elif temp_file.is_dir():
-                        shutil.rmtree(temp_file, ignore_errors=True)
-                except Exception as e:
-                    error_messages.append(f"Failed to clean temp file {temp_file}: {str(e)}")
-                    # Don't set deletion_success to False for temp files
-    except Exception as e:
-        error_messages.append(f"Temp cleanup error: {str(e)}")
-        # Don't set deletion_success to False for temp cleanup errors
+    # Step 3: Clear any temporary files, failures there don't count
+    await run_io(remove_temp_files, session_id)
+    return error_messages
 
-    if deletion_success:
-        return JSONResponse(content={"status": "session cleared successfully"})
-    else:
-        return JSONResponse(
-            content={
-                "status": "session cleanup partially failed",
-                "errors": error_messages
-            },
-            status_code=500
-        )
+def remove_temp_files(session_id: str):
+    """Removes the files older versions left in /tmp for a session."""
+    temp_patterns = [
+        f"*{session_id}*",
+        f"finanalyst_sessions/{session_id}*",
+    ]
+    for pattern in temp_patterns:
+        for temp_file in Path("/tmp").glob(pattern):
+            try:
+                if temp_file.is_dir():
+                    shutil.rmtree(temp_file, ignore_errors=True)
+                else:
+                    os.remove(temp_file)
+            except Exception as e:
+                print(f"Failed to clean temp file {temp_file}: {str(e)}")
+
+async def reap_sessions():
+    """
+    Deletes the sessions idle past SESSION_TTL_HOURS, and the least recently
+    used ones while local storage exceeds DISK_QUOTA_MB. Sessions with an
+    unfinished job are left alone.
+
+    Idleness is judged from the local session directory, which only shows
+    this server's use of the session. In S3 mode another server may still be
+    serving it, so only the local copies are removed and the bucket objects
+    stay until /clear_session/.
+    """
+    for session_id, reason in await run_io(sessions_to_reap):
+        if job_manager.has_active(session_id):
+            continue
+        errors = await delete_session(session_id, local_only=USE_S3)
+        inc("sessions_reaped_total", reason=reason)
+        print(f"Reaped session {session_id} ({reason})" + (f": {errors}" if errors else ""))
+
+async def reaper_loop():
+    while True:
+        await asyncio.sleep(REAPER_INTERVAL_SECONDS)
+        try:
+            await reap_sessions()
+        except Exception as e:
+            print(f"Session reaper failed: {e}")
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """Whether an If-None-Match header lists etag."""
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    # Weak comparison, as RFC 9110 asks for If-None-Match
+    return "*" in tags or etag.removeprefix("W/") in [tag.removeprefix("W/") for tag in tags]
 
 @app.get("/get_image/")
-async def get_image(session_id: str = Query(...), timestamp: str = Query(...)):
+async def get_image(
+    session_id: str = Query(...),
+    timestamp: str = Query(...),
+    variant: str = Query("original"),
+    if_none_match: str | None = Header(None)
+):
+    """
+    Serves a generated image, or its webp or thumbnail variant, with an ETag
+    and long-lived Cache-Control headers; a matching If-None-Match gets a 304.
+    """
+    if variant not in local_storage.IMAGE_FILES:
+        return JSONResponse(content={"error": f"Unknown image variant '{variant}'"}, status_code=400)
+    error = invalid_session(session_id)
+    if error:
+        return error
+    # Dashboards polling a session's images keep it alive
+    await run_io(local_storage.touch_session, session_id)
+    file_name = local_storage.image_file_name(timestamp, variant)
+    media_type = local_storage.IMAGE_FILES[variant][1]
     if USE_S3:
-        image_s3_key = f"sessions/{session_id}/output_{timestamp}.png"
-        local_path = f"/tmp/output_{session_id}_{timestamp}.png"
-        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        image_s3_key = f"sessions/{session_id}/{file_name}"
+        if IMAGE_DELIVERY == "presigned":
+            url = await run_io(
+                s3.generate_presigned_url, "get_object",
+                Params={"Bucket": S3_BUCKET, "Key": image_s3_key}, ExpiresIn=PRESIGNED_URL_SECONDS
+            )
+            # The redirect is cached for less time than the URL stays valid
+            max_age = min(IMAGE_MAX_AGE, PRESIGNED_URL_SECONDS // 2)
+            return RedirectResponse(url, status_code=302, headers={"Cache-Control": f"private, max-age={max_age}"})
+
+        params = {"Bucket": S3_BUCKET, "Key": image_s3_key}
+        if if_none_match:
+            params["IfNoneMatch"] = if_none_match
         try:
-            s3.download_file(S3_BUCKET, image_s3_key, local_path)
-            return FileResponse(local_path, media_type="image/png", filename=f"output_{timestamp}.png")
-        except ClientError:
+            obj = await run_io(s3.get_object, **params)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("304", "NotModified"):
+                etag = e.response["ResponseMetadata"]["HTTPHeaders"].get("etag", if_none_match)
+                return Response(status_code=304, headers={"ETag": etag, "Cache-Control": IMAGE_CACHE_CONTROL})
             return JSONResponse(content={"error": "No image found"}, status_code=404)
-    else:
-        # The local implementation uses a slightly different path structure
-        image_path = local_storage.get_image_path(session_id, timestamp)
-        if image_path and os.path.exists(image_path):
-            return FileResponse(image_path, media_type="image/png", filename=f"output_{timestamp}.png")
-        else:
-            # Check the alternative path for compatibility
-            legacy_path = f"/tmp/finanalyst_sessions/{session_id}/output_{session_id}_{timestamp}.png"
-            if os.path.exists(legacy_path):
-                return FileResponse(legacy_path, media_type="image/png", filename=f"output_{timestamp}.png")
-            return JSONResponse(content={"error": "No image found"}, status_code=404)
\ No newline at end of file
+        # The body goes straight from S3 to the client, without a temp file
+        body = obj["Body"]
+        return StreamingResponse(
+            body.iter_chunks(IMAGE_STREAM_CHUNK_BYTES),
+            media_type=media_type,
+            headers={
+                "ETag": obj["ETag"],
+                "Cache-Control": IMAGE_CACHE_CONTROL,
+                "Content-Length": str(obj["ContentLength"]),
+                "Content-Disposition": f'attachment; filename="{file_name}"',
+            },
+            background=BackgroundTask(body.close)
+        )
+
+    # The local implementation uses a slightly different path structure
+    image_path = local_storage.get_image_path(session_id, timestamp, variant)
+    if not image_path and variant == "original":
+        # Check the alternative path for compatibility
+        legacy_path = f"/tmp/finanalyst_sessions/{session_id}/output_{session_id}_{timestamp}.png"
+        if os.path.exists(legacy_path):
+            image_path = legacy_path
+    if not image_path:
+        return JSONResponse(content={"error": "No image found"}, status_code=404)
+    # Images are written once, so their mtime and size identify their content
+    stat = os.stat(image_path)
+    etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+    headers = {"ETag": etag, "Cache-Control": IMAGE_CACHE_CONTROL}
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(image_path, media_type=media_type, filename=file_name, headers=headers)
+
+@app.get("/ready/")
+async def get_readiness():
+    """Reports whether storage, the sandbox workers and the LLM client are ready; 503 until they all are."""
+    ready = all(state == "ready" for state in readiness.values())
+    return JSONResponse(content={"ready": ready, "components": readiness}, status_code=200 if ready else 503)
+
+@app.get("/pool_stats/")
+async def get_pool_stats():
+    """Reports queue depth and throughput of the worker pools."""
+    return JSONResponse(content=pool_stats())
+
+@app.get("/prompt_stats/")
+async def get_prompt_stats():
+    """Reports how many prompts were built and their estimated token counts."""
+    return JSONResponse(content=prompt_stats())
+
+@app.get("/metrics")
+async def get_metrics():
+    """
+    Exposes stage latencies, bytes and rows processed, LLM tokens, cache hit
+    rates, peak RSS, pool queues and prompt sizes in the Prometheus text format.
+    """
+    pools = pool_stats()
+    prompts = prompt_stats()
+    frames = cache_stats()
+    extra = {
+        "pool_tasks": ("gauge", "Tasks queued for or running in each worker pool.", {
+            (("pool", name), ("state", state)): stats[state]
+            for name, stats in pools.items() for state in ("queued", "active")
+        }),
+        "pool_completed_total": ("counter", "Tasks completed by each worker pool.", {
+            (("pool", name),): stats["completed"] for name, stats in pools.items()
+        }),
+        "pool_rejected_total": ("counter", "Tasks rejected by each saturated worker pool.", {
+            (("pool", name),): stats["rejected"] for name, stats in pools.items()
+        }),
+        "prompts_total": ("counter", "Prompts built.", {(): prompts["prompts"]}),
+        "prompt_tokens_total": ("counter", "Estimated prompt tokens, by prompt part.", {
+            (("part", "all"),): prompts["prompt_tokens_total"],
+            (("part", "csv_info"),): prompts["csv_info_tokens_total"],
+            (("part", "history"),): prompts["history_tokens_total"],
+        }),
+        "dataframe_cache_entries": ("gauge", "DataFrames held by the in-process cache.", {(): frames["entries"]}),
+        "dataframe_cache_bytes": ("gauge", "Memory taken by the cached DataFrames.", {(): frames["bytes"]}),
+    }
+    return PlainTextResponse(render(extra), media_type="text/plain; version=0.0.4")
+
+@app.get("/memory_stats/")
+async def get_memory_stats(session_id: str = Query(...)):
+    """Reports the memory a session's dataset takes with default and with lean dtypes."""
+    error = invalid_session(session_id)
+    if error:
+        return error
+    report = await run_io(memory_report, session_id)
+    if report is None:
+        return JSONResponse(content={"error": "No memory report for this session"}, status_code=404)
+    return JSONResponse(content=report)
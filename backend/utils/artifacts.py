@@ -0,0 +1,225 @@
+import os
+import json
+import shutil
+import warnings
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from utils.dataloader import load_dataset, plan_dtypes, apply_dtype_plan, dtype_enabled
+from utils.local_storage import get_dataset_dir
+from utils.processdata import to_json_value, extract_csv_metadata_and_sample
+from utils.out_of_core import execution_mode, EXECUTION_CHUNKED
+from utils.prompt_builder import format_column_list, ARTIFACTS_TOKEN_BUDGET
+
+ARTIFACTS_DIR = "artifacts"
+ARTIFACTS_FILE = "artifacts.json"
+INDEXES_FILE = "indexes.arrow"
+# Most frequent values kept per column
+TOP_K = int(os.getenv("ARTIFACTS_TOP_K", "20"))
+# Numeric columns with more distinct values get no value counts, text columns
+# no categorical codes
+MAX_CATEGORIES = int(os.getenv("ARTIFACTS_MAX_CATEGORIES", "1000"))
+# Share of parseable values for a text column to count as a date column
+DATE_PARSE_RATIO = 0.9
+
+def _detect_dates(series: pd.Series):
+    """Returns the column parsed as datetimes if it holds dates, otherwise None."""
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series
+    if not (pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series)):
+        return None
+    values = series.dropna()
+    if values.empty:
+        return None
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        # Try a sample first so free-text columns are rejected cheaply
+        sample = pd.to_datetime(values.head(1000), errors="coerce")
+        if sample.notna().mean() < DATE_PARSE_RATIO:
+            return None
+        parsed = pd.to_datetime(series, errors="coerce")
+    return parsed if parsed.notna().sum() >= DATE_PARSE_RATIO * len(values) else None
+
+def build_artifacts(df: pd.DataFrame, out_dir, metadata: dict | None = None) -> dict:
+    """
+    Computes the query-independent artifacts of a dataset and stores them in
+    out_dir: per-column statistics, top-k value counts, date ranges, and, in
+    an Arrow file workers can memory-map, row orders sorted by each date
+    column and the codes of low-cardinality text columns. Given the dataset
+    profile's metadata, it also stores the lean dtypes to load the dataset
+    with and the memory they save.
+
+    Returns:
+        dict: The artifact manifest written to artifacts.json.
+    """
+    manifest = {"num_rows": len(df), "stats": {}, "value_counts": {}, "date_range": {}, "categories": {}}
+    index_columns = {}
+
+    for name in df.columns:
+        series = df[name]
+        key = str(name)
+        described = series.describe()
+        manifest["stats"][key] = {str(stat): to_json_value(value) for stat, value in described.items()}
+
+        distinct = series.nunique(dropna=True)
+        is_text = pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series)
+        # Counts of continuous values say little, so floats get none
+        if is_text or (distinct <= MAX_CATEGORIES and not pd.api.types.is_float_dtype(series)):
+            counts = series.value_counts(dropna=True).head(TOP_K)
+            manifest["value_counts"][key] = [[to_json_value(value), int(count)] for value, count in counts.items()]
+
+        dates = _detect_dates(series)
+        if dates is not None:
+            manifest["date_range"][key] = [str(dates.min()), str(dates.max())]
+            # Missing dates sort last
+            index_columns[f"sorted_by:{key}"] = pa.array(np.argsort(dates.to_numpy(), kind="stable").astype(np.int64))
+        elif is_text and distinct <= MAX_CATEGORIES and distinct < len(series) / 2:
+            try:
+                codes, categories = pd.factorize(series, sort=True)
+            except TypeError:  # Values of mixed types can't be sorted
+                codes, categories = pd.factorize(series)
+            manifest["categories"][key] = [to_json_value(value) for value in categories]
+            index_columns[f"codes:{key}"] = pa.array(codes.astype(np.int32))
+
+    if metadata:
+        plan = plan_dtypes(metadata, manifest["date_range"])
+        lean = apply_dtype_plan(df, plan)
+        # Only the conversions that succeeded are replayed when loading
+        manifest["dtypes"] = {name: dtype for name, dtype in plan.items() if str(lean[name].dtype) != str(df[name].dtype)}
+        default_bytes = int(df.memory_usage(deep=True).sum())
+        lean_bytes = int(lean.memory_usage(deep=True).sum())
+        manifest["memory"] = {
+            "default_bytes": default_bytes,
+            "optimized_bytes": lean_bytes,
+            "saved_bytes": default_bytes - lean_bytes,
+        }
+
+    os.makedirs(out_dir, exist_ok=True)
+    if index_columns:
+        table = pa.table(index_columns)
+        tmp_file = os.path.join(out_dir, INDEXES_FILE + ".tmp")
+        with pa.OSFile(tmp_file, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+        os.replace(tmp_file, os.path.join(out_dir, INDEXES_FILE))
+    tmp_file = os.path.join(out_dir, ARTIFACTS_FILE + ".tmp")
+    with open(tmp_file, "w") as f:
+        json.dump(manifest, f, default=str)
+    os.replace(tmp_file, os.path.join(out_dir, ARTIFACTS_FILE))
+    return manifest
+
+def get_artifacts_dir(session_id: str) -> Path:
+    return get_dataset_dir(session_id) / ARTIFACTS_DIR
+
+def ensure_artifacts(file_path: str, session_id: str):
+    """
+    Builds a session dataset's artifacts unless they already exist. Datasets
+    too large to load get none.
+    """
+    artifacts_dir = get_artifacts_dir(session_id)
+    if (artifacts_dir / ARTIFACTS_FILE).exists():
+        return str(artifacts_dir)
+    try:
+        metadata = extract_csv_metadata_and_sample(file_path, session_id).get("metadata")
+        if execution_mode(metadata, file_path) == EXECUTION_CHUNKED:
+            return None
+        build_artifacts(load_dataset(file_path, session_id), artifacts_dir, metadata)
+        return str(artifacts_dir)
+    except Exception as e:
+        print(f"Failed to build dataset artifacts for {file_path}: {e}")
+        shutil.rmtree(artifacts_dir, ignore_errors=True)
+        return None
+
+def _load_manifest(session_id: str) -> dict | None:
+    try:
+        with open(get_artifacts_dir(session_id) / ARTIFACTS_FILE, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def load_dtype_plan(session_id: str) -> dict | None:
+    """Returns the lean dtypes to load a session's dataset with, None if unknown."""
+    manifest = _load_manifest(session_id)
+    if not manifest or manifest.get("dtypes") is None:
+        return None
+    return {name: dtype for name, dtype in manifest["dtypes"].items() if dtype_enabled(dtype)}
+
+def memory_report(session_id: str) -> dict | None:
+    """
+    Returns the memory a session's dataset takes as a DataFrame with default
+    dtypes and with its lean dtypes, None if the artifacts aren't built.
+    """
+    manifest = _load_manifest(session_id)
+    if not manifest or "memory" not in manifest:
+        return None
+    return {**manifest["memory"], "dtypes": manifest.get("dtypes", {})}
+
+def with_loaded_dtypes(csv_info, session_id: str):
+    """Returns csv_info with the dtypes df is actually loaded with."""
+    dtypes = load_dtype_plan(session_id)
+    metadata = csv_info.get("metadata") if isinstance(csv_info, dict) else None
+    if not dtypes or not metadata:
+        return csv_info
+    return {**csv_info, "metadata": {**metadata, "dtypes": {**metadata.get("dtypes", {}), **dtypes}}}
+
+def summarize_artifacts(session_id: str, user_query: str = "") -> str:
+    """
+    Describes the available artifacts for the prompt, or '' when there are
+    none. The columns of each kind of artifact are listed within a share of
+    ARTIFACTS_TOKEN_BUDGET, those the query mentions first.
+    """
+    manifest = _load_manifest(session_id)
+    if not manifest:
+        return ""
+
+    def names(section):
+        return format_column_list(list(manifest[section]), user_query, ARTIFACTS_TOKEN_BUDGET // 3)
+
+    return (
+        "A precomputed `artifacts` object is available next to df; prefer it over recomputing:\n"
+        "- artifacts.stats: DataFrame of df.describe() for every column (one row per column)\n"
+        f"- artifacts.value_counts[col]: Series of the top {TOP_K} values, for: {names('value_counts')}\n"
+        f"- artifacts.date_range[col]: (min, max) Timestamps, for: {names('date_range')}\n"
+        "- artifacts.sorted_index[col]: row positions ordering df by that date column "
+        "(df.iloc[artifacts.sorted_index[col]]), same columns as date_range\n"
+        f"- artifacts.categorical(col): pd.Categorical of the column, for: {names('categories')}"
+    )
+
+class DatasetArtifacts:
+    """
+    Read-only view of a dataset's artifacts for generated code. The index
+    arrays are memory-mapped, so every worker shares the same pages.
+    """
+
+    def __init__(self, artifacts_dir: str):
+        with open(os.path.join(artifacts_dir, ARTIFACTS_FILE), "r") as f:
+            manifest = json.load(f)
+        self.stats = pd.DataFrame.from_dict(manifest["stats"], orient="index")
+        self.value_counts = {
+            name: pd.Series([count for _, count in pairs], index=[value for value, _ in pairs], name="count")
+            for name, pairs in manifest["value_counts"].items()
+        }
+        self.date_range = {
+            name: (pd.Timestamp(start), pd.Timestamp(end))
+            for name, (start, end) in manifest["date_range"].items()
+        }
+        self._categories = manifest["categories"]
+        self.sorted_index = {}
+        self._codes = {}
+        indexes_file = os.path.join(artifacts_dir, INDEXES_FILE)
+        if os.path.exists(indexes_file):
+            table = pa.ipc.open_file(pa.memory_map(indexes_file, "r")).read_all()
+            for column_name in table.column_names:
+                kind, name = column_name.split(":", 1)
+                array = table.column(column_name).combine_chunks().to_numpy(zero_copy_only=True)
+                (self.sorted_index if kind == "sorted_by" else self._codes)[name] = array
+
+    def categorical(self, name: str) -> pd.Categorical:
+        """Returns a column as a pd.Categorical built from its precomputed codes."""
+        return pd.Categorical.from_codes(self._codes[name], categories=self._categories[name])
+
+    def __repr__(self):
+        return (
+            f"DatasetArtifacts(stats={len(self.stats)} columns, value_counts={list(self.value_counts)}, "
+            f"date_range={list(self.date_range)}, categorical={list(self._categories)})"
+        )
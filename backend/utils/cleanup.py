@@ -0,0 +1,104 @@
+import os
+import time
+from pathlib import Path
+from utils.local_storage import (
+    LOCAL_STORAGE_PATH, BLOB_STORAGE_PATH, REFS_DIR, get_blob_dir, load_upload_manifest, is_valid_session_id
+)
+
+# Sessions unused for longer than this are deleted by the reaper; 0 (the
+# default) keeps them
+SESSION_TTL_HOURS = float(os.getenv("SESSION_TTL_HOURS", "0"))
+# Once local storage takes more than this, the least recently used sessions
+# are deleted until it fits; 0 disables the quota
+DISK_QUOTA_MB = int(os.getenv("DISK_QUOTA_MB", "0"))
+REAPER_INTERVAL_SECONDS = int(os.getenv("REAPER_INTERVAL_SECONDS", "600"))
+# Most keys a DeleteObjects request takes
+S3_DELETE_BATCH = 1000
+
+def delete_s3_prefix(s3, bucket: str, prefix: str) -> tuple[list[str], list[str]]:
+    """
+    Deletes every object under a key prefix, walking all pages of the listing
+    and deleting up to 1000 keys per request.
+
+    Returns:
+        tuple: (the deleted keys, error messages for keys that could not be deleted)
+    """
+    deleted, errors = [], []
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, PaginationConfig={"PageSize": S3_DELETE_BATCH}):
+        keys = [obj["Key"] for obj in page.get("Contents", [])]
+        if not keys:
+            continue
+        response = s3.delete_objects(
+            Bucket=bucket,
+            Delete={"Objects": [{"Key": key} for key in keys], "Quiet": True}
+        )
+        failed = {error["Key"]: error for error in response.get("Errors", [])}
+        deleted += [key for key in keys if key not in failed]
+        errors += [f"Failed to delete S3 object {key}: {error.get('Message')}" for key, error in failed.items()]
+    return deleted, errors
+
+def directory_size(path: Path) -> int:
+    """Total size of the files under a directory, in bytes."""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+def _session_dirs():
+    """Yields (session_id, last use) of every local session, from its directory's mtime."""
+    try:
+        entries = list(os.scandir(LOCAL_STORAGE_PATH))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        if not is_valid_session_id(entry.name):
+            continue
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                yield entry.name, entry.stat(follow_symlinks=False).st_mtime
+        except OSError:
+            pass
+
+def _reclaimable_bytes(session_id: str) -> int:
+    """Bytes deleting a session frees: its directory, plus its blob if no other session uses it."""
+    size = directory_size(LOCAL_STORAGE_PATH / session_id)
+    manifest = load_upload_manifest(session_id)
+    if manifest and manifest.get("sha256"):
+        blob_dir = get_blob_dir(manifest["sha256"])
+        refs = [ref.name for ref in (blob_dir / REFS_DIR).glob("*")]
+        if refs in ([], [session_id]):
+            size += directory_size(blob_dir)
+    return size
+
+def sessions_to_reap(now: float | None = None) -> list[tuple[str, str]]:
+    """
+    Picks the sessions the reaper deletes, least recently used first: those
+    idle for longer than SESSION_TTL_HOURS, then, while local storage is over
+    DISK_QUOTA_MB, the next least recently used ones.
+
+    Returns:
+        list: (session_id, reason) pairs, reason being "ttl" or "quota".
+    """
+    now = now or time.time()
+    sessions = sorted(_session_dirs(), key=lambda session: session[1])
+    ttl_seconds = SESSION_TTL_HOURS * 3600
+    expired = [session_id for session_id, last_used in sessions if ttl_seconds and now - last_used > ttl_seconds]
+    reaped = [(session_id, "ttl") for session_id in expired]
+    if not DISK_QUOTA_MB:
+        return reaped
+
+    usage = directory_size(LOCAL_STORAGE_PATH) + directory_size(BLOB_STORAGE_PATH) - sum(_reclaimable_bytes(session_id) for session_id in expired)
+    quota = DISK_QUOTA_MB * 1024 * 1024
+    for session_id, _ in sessions:
+        if usage <= quota:
+            break
+        if session_id in expired:
+            continue
+        usage -= _reclaimable_bytes(session_id)
+        reaped.append((session_id, "quota"))
+    return reaped
@@ -0,0 +1,167 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import numpy as np
+from utils.local_storage import BACKEND_ROOT
+
+CODEGEN_CACHE_ENABLED = os.getenv("CODEGEN_CACHE_ENABLED", "true").lower() == "true"
+CODEGEN_CACHE_PATH = os.getenv("CODEGEN_CACHE_PATH", str(BACKEND_ROOT / "cache" / "codegen_cache.db"))
+CODEGEN_CACHE_TTL_SECONDS = int(os.getenv("CODEGEN_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+CODEGEN_CACHE_MAX_ENTRIES = int(os.getenv("CODEGEN_CACHE_MAX_ENTRIES", "10000"))
+# Minimum cosine similarity for a near-identical query to count as a hit;
+# 0 disables the similarity lookup and only exact (normalized) matches hit.
+CODEGEN_CACHE_SIMILARITY = float(os.getenv("CODEGEN_CACHE_SIMILARITY", "0"))
+# Number of previous user messages folded into the key of follow-up queries
+HISTORY_TURNS = 2
+EMBEDDING_DIM = 256
+
+# Queries that refer back to the conversation depend on the session history
+_HISTORY_REFERENCE = re.compile(
+    r"\b(last|previous|earlier|before|again|above|that|those|it|same|instead)\b"
+)
+
+# Generated code that never touches the data (answers about the
+# conversation, such as printing the user's earlier question) depends on
+# the session, not the dataset, so it is never shared through the cache
+_DATA_REFERENCE = re.compile(r"\b(df|dataset)\b")
+
+def _hash(*parts) -> str:
+    return hashlib.sha256("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+def normalize_query(user_query: str) -> str:
+    """Lowercases a query and drops whitespace and punctuation differences."""
+    query = re.sub(r"[^\w\s]", " ", user_query.lower())
+    return " ".join(query.split())
+
+def hashed_embedding(text: str) -> np.ndarray:
+    """
+    Local stand-in for an embedding model: word unigrams and bigrams hashed
+    into a fixed-size, L2-normalized vector. Good enough to match rephrasings
+    that share most of their words.
+    """
+    words = text.split()
+    vector = np.zeros(EMBEDDING_DIM, dtype=np.float32)
+    for token in words + [" ".join(pair) for pair in zip(words, words[1:])]:
+        digest = hashlib.md5(token.encode("utf-8")).digest()
+        vector[int.from_bytes(digest[:4], "little") % EMBEDDING_DIM] += 1.0
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+# Swap in a real embedding model with set_embedder()
+_embedder = hashed_embedding
+
+def set_embedder(embedder):
+    """Sets the function mapping a normalized query to a 1-D embedding vector."""
+    global _embedder
+    _embedder = embedder
+
+def _connect() -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(CODEGEN_CACHE_PATH), exist_ok=True)
+    conn = sqlite3.connect(CODEGEN_CACHE_PATH, timeout=10)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS codegen_cache ("
+        " key TEXT PRIMARY KEY,"
+        " scope TEXT NOT NULL,"
+        " query TEXT NOT NULL,"
+        " code TEXT NOT NULL,"
+        " embedding BLOB,"
+        " created_at REAL NOT NULL,"
+        " last_used REAL NOT NULL)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS codegen_cache_scope ON codegen_cache (scope)")
+    conn.execute("CREATE INDEX IF NOT EXISTS codegen_cache_last_used ON codegen_cache (last_used)")
+    return conn
+
+def build_key(csv_info: dict, user_query: str, history_messages: list, model_name: str, mode: str = ""):
+    """
+    Builds the cache key of a query from the dataset schema, the normalized
+    query text, the relevant part of the session history, the model and the
+    kind of code generated (mode).
+
+    Returns:
+        dict | None: The key parts, or None if the query can't be cached.
+    """
+    metadata = csv_info.get("metadata") if isinstance(csv_info, dict) else None
+    if not CODEGEN_CACHE_ENABLED or not metadata:
+        return None
+    schema_hash = _hash(json.dumps(metadata.get("dtypes", {}), sort_keys=True, default=str))
+
+    query = normalize_query(user_query)
+    history_fingerprint = ""
+    if _HISTORY_REFERENCE.search(query):
+        previous = [
+            normalize_query(str(message.content))
+            for message in history_messages
+            if getattr(message, "type", None) == "human"
+        ][-HISTORY_TURNS:]
+        history_fingerprint = _hash(*previous)
+
+    scope = _hash(schema_hash, history_fingerprint, model_name, mode)
+    return {"key": _hash(scope, query), "scope": scope, "query": query}
+
+def lookup(cache_key: dict):
+    """
+    Returns cached code for a query: an exact match on the key first, then,
+    if enabled, the most similar query within the same schema and history scope.
+    """
+    now = time.time()
+    conn = _connect()
+    try:
+        with conn:
+            conn.execute("DELETE FROM codegen_cache WHERE created_at < ?", (now - CODEGEN_CACHE_TTL_SECONDS,))
+            row = conn.execute("SELECT key, code FROM codegen_cache WHERE key = ?", (cache_key["key"],)).fetchone()
+
+            if row is None and CODEGEN_CACHE_SIMILARITY > 0:
+                target = np.asarray(_embedder(cache_key["query"]), dtype=np.float32)
+                best_score = CODEGEN_CACHE_SIMILARITY
+                for key, code, blob in conn.execute(
+                    "SELECT key, code, embedding FROM codegen_cache WHERE scope = ? AND embedding IS NOT NULL",
+                    (cache_key["scope"],),
+                ):
+                    embedding = np.frombuffer(blob, dtype=np.float32)
+                    denominator = float(np.linalg.norm(embedding) * np.linalg.norm(target))
+                    score = float(embedding @ target) / denominator if denominator else 0.0
+                    if score >= best_score:
+                        best_score, row = score, (key, code)
+
+            if row is None or not is_cacheable(row[1]):
+                return None
+            conn.execute("UPDATE codegen_cache SET last_used = ? WHERE key = ?", (now, row[0]))
+            return row[1]
+    finally:
+        conn.close()
+
+def is_cacheable(code: str) -> bool:
+    """Whether generated code reads the dataset (as df or dataset) and so may be reused for it."""
+    return bool(_DATA_REFERENCE.search(code or ""))
+
+def store(cache_key: dict, code: str):
+    """
+    Stores generated code and evicts the least recently used entries over the
+    cap. Code that doesn't read the dataset is not stored.
+    """
+    if not is_cacheable(code):
+        return
+    now = time.time()
+    embedding = None
+    if CODEGEN_CACHE_SIMILARITY > 0:
+        embedding = np.asarray(_embedder(cache_key["query"]), dtype=np.float32).tobytes()
+    conn = _connect()
+    try:
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO codegen_cache (key, scope, query, code, embedding, created_at, last_used)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (cache_key["key"], cache_key["scope"], cache_key["query"], code, embedding, now, now),
+            )
+            conn.execute(
+                "DELETE FROM codegen_cache WHERE key IN ("
+                " SELECT key FROM codegen_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (CODEGEN_CACHE_MAX_ENTRIES,),
+            )
+    finally:
+        conn.close()
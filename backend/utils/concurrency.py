@@ -0,0 +1,102 @@
+import os
+import asyncio
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+class PoolSaturatedError(RuntimeError):
+    """Raised when a pool's queue is full and new work must be rejected."""
+
+class BoundedPool:
+    """
+    A thread pool for blocking work called from async handlers. The number of
+    tasks waiting for a worker is capped so overload is rejected instead of
+    piling up, and queue depth is tracked for monitoring.
+    """
+
+    def __init__(self, name: str, max_workers: int, max_queue: int):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.active = 0
+        self.completed = 0
+        self.rejected = 0
+
+    async def run(self, func, *args, **kwargs):
+        """Runs func(*args, **kwargs) on the pool and awaits its result."""
+        with self._lock:
+            if self.queued >= self.max_queue:
+                self.rejected += 1
+                raise PoolSaturatedError(f"The {self.name} pool queue is full ({self.max_queue} tasks waiting)")
+            self.queued += 1
+
+        # Tasks see the caller's context, e.g. its request timings
+        context = contextvars.copy_context()
+
+        def task():
+            with self._lock:
+                self.queued -= 1
+                self.active += 1
+            try:
+                return context.run(func, *args, **kwargs)
+            finally:
+                with self._lock:
+                    self.active -= 1
+                    self.completed += 1
+
+        future = self._executor.submit(task)
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            # A task that never started would otherwise stay counted as queued
+            if future.cancel():
+                with self._lock:
+                    self.queued -= 1
+            raise
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "queued": self.queued,
+                "active": self.active,
+                "completed": self.completed,
+                "rejected": self.rejected,
+            }
+
+# Storage and network calls (S3, file copies)
+io_pool = BoundedPool(
+    "io",
+    int(os.getenv("IO_POOL_WORKERS", "16")),
+    int(os.getenv("IO_POOL_MAX_QUEUE", "256")),
+)
+# pandas parsing, profiling and conversion
+cpu_pool = BoundedPool(
+    "cpu",
+    int(os.getenv("CPU_POOL_WORKERS", str(os.cpu_count() or 1))),
+    int(os.getenv("CPU_POOL_MAX_QUEUE", "64")),
+)
+# Generated code execution, handed to the sandbox worker processes; sized to
+# keep every sandbox worker busy
+exec_pool = BoundedPool(
+    "exec",
+    int(os.getenv("EXEC_POOL_WORKERS", os.getenv("SANDBOX_WORKERS", str(os.cpu_count() or 1)))),
+    int(os.getenv("EXEC_POOL_MAX_QUEUE", "32")),
+)
+
+def run_io(func, *args, **kwargs):
+    return io_pool.run(func, *args, **kwargs)
+
+def run_cpu(func, *args, **kwargs):
+    return cpu_pool.run(func, *args, **kwargs)
+
+def run_exec(func, *args, **kwargs):
+    return exec_pool.run(func, *args, **kwargs)
+
+def pool_stats() -> dict:
+    """Returns the queue depth and throughput counters of every pool."""
+    return {pool.name: pool.stats() for pool in (io_pool, cpu_pool, exec_pool)}
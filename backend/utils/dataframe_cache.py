@@ -0,0 +1,92 @@
+import os
+import threading
+from collections import OrderedDict
+import pandas as pd
+from utils.dataloader import load_dataset
+from utils.metrics import record_cache
+
+# Upper bound for the parsed DataFrames kept in memory across all sessions.
+DF_CACHE_MAX_BYTES = int(os.getenv("DF_CACHE_MAX_MB", "1024")) * 1024 * 1024
+
+# file path -> (fingerprint, DataFrame, size in bytes), least recently used first
+_cache: OrderedDict = OrderedDict()
+_cache_bytes = 0
+_cache_lock = threading.Lock()
+# One lock per file so concurrent requests parse it only once
+_load_locks: dict[str, threading.Lock] = {}
+
+def file_fingerprint(file_path: str) -> tuple[str, int, int]:
+    """Identifies a version of a file by its path, modification time and size."""
+    stat = os.stat(file_path)
+    return (str(file_path), stat.st_mtime_ns, stat.st_size)
+
+def _evict_over_cap():
+    """Drops least recently used frames until the cache fits in its memory cap."""
+    global _cache_bytes
+    while _cache and _cache_bytes > DF_CACHE_MAX_BYTES:
+        _, (_, _, nbytes) = _cache.popitem(last=False)
+        _cache_bytes -= nbytes
+
+def get_dataframe(file_path: str, session_id: str | None = None, dtypes: dict | None = None) -> pd.DataFrame:
+    """
+    Returns the parsed DataFrame for a session's file, parsing it at most once
+    per file version. Entries are keyed by path, so sessions sharing a dataset
+    blob share the frame, and reused as long as the file's mtime and size and
+    the dtype plan it was loaded with are unchanged.
+
+    The returned frame is shared; callers that may mutate it must copy it first.
+    """
+    global _cache_bytes
+    key = str(file_path)
+    fingerprint = (file_fingerprint(file_path), tuple(sorted((dtypes or {}).items())))
+
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry and entry[0] == fingerprint:
+            _cache.move_to_end(key)
+            record_cache("dataframe", True)
+            return entry[1]
+        load_lock = _load_locks.setdefault(key, threading.Lock())
+
+    with load_lock:
+        # Another request may have parsed the file while we were waiting
+        with _cache_lock:
+            entry = _cache.get(key)
+            if entry and entry[0] == fingerprint:
+                _cache.move_to_end(key)
+                record_cache("dataframe", True)
+                return entry[1]
+
+        record_cache("dataframe", False)
+        df = load_dataset(file_path, session_id, dtypes)
+        nbytes = int(df.memory_usage(deep=True).sum())
+
+        with _cache_lock:
+            old = _cache.pop(key, None)
+            if old:
+                _cache_bytes -= old[2]
+            # Frames larger than the whole cache are served but never kept
+            if nbytes <= DF_CACHE_MAX_BYTES:
+                _cache[key] = (fingerprint, df, nbytes)
+                _cache_bytes += nbytes
+                _evict_over_cap()
+    return df
+
+def evict_file(file_path: str):
+    """Removes a file's DataFrame from the cache."""
+    global _cache_bytes
+    key = str(file_path)
+    with _cache_lock:
+        entry = _cache.pop(key, None)
+        if entry:
+            _cache_bytes -= entry[2]
+        _load_locks.pop(key, None)
+
+def cache_stats() -> dict:
+    """Returns the number of cached frames and the memory they occupy."""
+    with _cache_lock:
+        return {
+            "entries": len(_cache),
+            "bytes": _cache_bytes,
+            "max_bytes": DF_CACHE_MAX_BYTES,
+        }
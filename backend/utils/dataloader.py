@@ -0,0 +1,359 @@
+import os
+import json
+import codecs
+import warnings
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from chardet.universaldetector import UniversalDetector
+from utils.local_storage import get_dataset_dir, find_columnar_copy
+from utils.metrics import timed, record_cache, record_io
+
+def try_read_csv(file_path: str, encoding: str, dtypes: dict | None = None) -> tuple[pd.DataFrame | None, Exception | None]:
+    """Try to read CSV with a specific encoding, return (dataframe, error)."""
+    try:
+        df = pd.read_csv(file_path, encoding=encoding, dtype=dtypes)
+        return df, None
+    except Exception as e:
+        return None, e
+
+# Rows per chunk when streaming a dataset instead of loading it whole
+CHUNK_ROWS = int(os.getenv("CHUNK_ROWS", "100000"))
+
+# Upper bound on the bytes inspected when sniffing a file's encoding
+ENCODING_SAMPLE_BYTES = int(os.getenv("ENCODING_SAMPLE_BYTES", str(4 * 1024 * 1024)))
+CHUNK_SIZE = 64 * 1024
+ENCODING_FILE = "encoding.json"
+# Decodes any byte, for files that turn out not to match the sniffed encoding
+LATIN1_FALLBACK = "latin1"
+
+# Generated code assigns new values to text columns, which categoricals
+# reject, so loading low-cardinality text as "category" is opt-in
+CATEGORICAL_TEXT = os.getenv("CATEGORICAL_TEXT", "false").lower() == "true"
+# With CATEGORICAL_TEXT, text columns with at most this many distinct values,
+# and no more than one per two rows, are loaded as categoricals
+CATEGORY_MAX_DISTINCT = int(os.getenv("CATEGORY_MAX_DISTINCT", "10000"))
+# Narrow integers overflow silently in arithmetic (qty * price), so
+# narrowing int64 to the smallest type holding the column's range is opt-in
+DOWNCAST_INTS = os.getenv("DOWNCAST_INTS", "false").lower() == "true"
+# Narrowing float64 to float32 loses precision, so it is opt-in
+DOWNCAST_FLOATS = os.getenv("DOWNCAST_FLOATS", "false").lower() == "true"
+# Arrow-backed strings only hold strings: generated code that label-encodes
+# text in place (df.loc[mask, "col"] = 1) fails on them, so loading text as
+# Arrow strings instead of object is opt-in
+ARROW_STRINGS = os.getenv("ARROW_STRINGS", "false").lower() == "true"
+# Arrow-backed strings with NaN for missing values, so comparisons return
+# plain bool arrays like object columns do
+STRING_DTYPE = pd.StringDtype("pyarrow", na_value=np.nan)
+
+BOMS = [
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+]
+
+def _is_valid_utf8(sample: bytes, complete: bool) -> bool:
+    """Validates a byte sample as UTF-8, one chunk at a time."""
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    view = memoryview(sample)
+    try:
+        for offset in range(0, len(view), CHUNK_SIZE):
+            decoder.decode(view[offset:offset + CHUNK_SIZE])
+        # Only flush the decoder at EOF, a multi-byte character may be
+        # split across the end of the sample
+        if complete:
+            decoder.decode(b"", final=True)
+    except UnicodeDecodeError:
+        return False
+    return True
+
+def sniff_encoding(sample: bytes, complete: bool) -> str:
+    """
+    Guesses the encoding of a file from a prefix of its bytes.
+
+    Args:
+        sample (bytes): The first bytes of the file, at most ENCODING_SAMPLE_BYTES.
+        complete (bool): Whether the sample is the whole file.
+
+    Returns:
+        str: Name of the encoding to read the file with.
+    """
+    for bom, encoding in BOMS:
+        if sample.startswith(bom):
+            return encoding
+
+    if _is_valid_utf8(sample, complete):
+        return 'utf-8'
+
+    detector = UniversalDetector()
+    for offset in range(0, len(sample), CHUNK_SIZE):
+        detector.feed(sample[offset:offset + CHUNK_SIZE])
+        if detector.done:
+            break
+    detector.close()
+    detected = detector.result.get('encoding')
+
+    if detected and detected.lower() not in ['johab', 'ascii']:  # Skip problematic encodings
+        try:
+            return codecs.lookup(detected).name
+        except LookupError:
+            pass
+
+    # If all else fails, use latin1 (it can read any byte sequence)
+    return 'latin1'
+
+def _encoding_fingerprint(file_path: str) -> list:
+    stat = os.stat(file_path)
+    return [os.path.basename(file_path), stat.st_size, stat.st_mtime_ns]
+
+def store_encoding(file_path: str, session_id: str, encoding: str):
+    """Records the encoding of a session file so it is not sniffed again."""
+    encoding_file = get_dataset_dir(session_id) / ENCODING_FILE
+    encoding_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(encoding_file, "w") as f:
+        json.dump({"fingerprint": _encoding_fingerprint(file_path), "encoding": encoding}, f)
+
+def detect_encoding(file_path: str, session_id: str | None = None) -> str:
+    """
+    Detect the encoding of a file by sniffing a bounded prefix: a BOM check,
+    then UTF-8 validation, then chardet's incremental detector.
+    When a session is given the result is stored in its directory so each
+    upload is only sniffed once.
+    """
+    encoding_file = get_dataset_dir(session_id) / ENCODING_FILE if session_id else None
+
+    if encoding_file and encoding_file.exists():
+        try:
+            with open(encoding_file, "r") as f:
+                cached = json.load(f)
+            if cached.get("fingerprint") == _encoding_fingerprint(file_path):
+                record_cache("encoding", True)
+                return cached["encoding"]
+        except (OSError, ValueError, KeyError):
+            pass
+    record_cache("encoding", False)
+
+    with timed("encoding_detection"):
+        with open(file_path, 'rb') as file:
+            sample = file.read(ENCODING_SAMPLE_BYTES)
+        encoding = sniff_encoding(sample, complete=os.path.getsize(file_path) <= len(sample))
+    record_io("encoding_detection", nbytes=len(sample))
+
+    if session_id:
+        store_encoding(file_path, session_id, encoding)
+    return encoding
+
+def plan_dtypes(metadata: dict, date_columns=()) -> dict:
+    """
+    Picks a memory-lean dtype for each column from a dataset profile:
+    "datetime64[ns]" for the given date columns. With DOWNCAST_INTS integers
+    get the narrowest type holding their range, with CATEGORICAL_TEXT text
+    with few distinct values is "category", with ARROW_STRINGS other text is
+    "string" (Arrow-backed).
+    Columns left out keep the dtype pandas infers.
+    """
+    plan = {}
+    num_rows = metadata.get("num_rows") or 0
+    column_stats = metadata.get("column_stats", {})
+    for name, dtype in metadata.get("dtypes", {}).items():
+        stats = column_stats.get(name, {})
+        if name in date_columns:
+            plan[name] = "datetime64[ns]"
+        elif dtype == "int64" and DOWNCAST_INTS and isinstance(stats.get("min"), int) and isinstance(stats.get("max"), int):
+            for candidate in ("int8", "int16", "int32"):
+                bounds = np.iinfo(candidate)
+                if bounds.min <= stats["min"] and stats["max"] <= bounds.max:
+                    plan[name] = candidate
+                    break
+        elif dtype == "float64" and DOWNCAST_FLOATS:
+            plan[name] = "float32"
+        elif dtype == "object":
+            distinct = stats.get("approx_distinct")
+            few_values = (
+                CATEGORICAL_TEXT and distinct is not None and distinct <= CATEGORY_MAX_DISTINCT and distinct * 2 <= num_rows
+            )
+            if few_values:
+                plan[name] = "category"
+            elif ARROW_STRINGS:
+                plan[name] = "string"
+    return plan
+
+def dtype_enabled(dtype: str) -> bool:
+    """
+    Whether plan_dtypes may pick a dtype with the current settings, so plans
+    stored before a setting was turned off are not replayed.
+    """
+    if dtype == "string":
+        return ARROW_STRINGS
+    if dtype == "category":
+        return CATEGORICAL_TEXT
+    if dtype in ("int8", "int16", "int32"):
+        return DOWNCAST_INTS
+    if dtype == "float32":
+        return DOWNCAST_FLOATS
+    return True
+
+def _pandas_dtype(dtype: str):
+    return STRING_DTYPE if dtype == "string" else dtype
+
+def apply_dtype_plan(df: pd.DataFrame, dtypes: dict | None) -> pd.DataFrame:
+    """
+    Converts columns of df to the dtypes of a plan from plan_dtypes. A column
+    keeps its dtype when the conversion fails or would turn values into NaT.
+    """
+    if not dtypes:
+        return df
+    converted = {}
+    for name, dtype in dtypes.items():
+        if name not in df.columns:
+            continue
+        series = df[name]
+        try:
+            if dtype.startswith("datetime64"):
+                if pd.api.types.is_datetime64_any_dtype(series):
+                    continue
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore")
+                    parsed = pd.to_datetime(series, errors="coerce")
+                if parsed.isna().sum() != series.isna().sum():
+                    continue
+                converted[name] = parsed
+            elif series.dtype != _pandas_dtype(dtype):
+                converted[name] = series.astype(_pandas_dtype(dtype))
+        except (ValueError, TypeError, OverflowError):
+            continue
+    if not converted:
+        return df
+    df = df.copy(deep=False)
+    for name, series in converted.items():
+        df[name] = series
+    return df
+
+def read_csv_decoded(file_path: str, encoding: str, dtypes: dict | None = None) -> tuple[pd.DataFrame, str]:
+    """
+    Reads a CSV file with an encoding, falling back to latin1 when bytes past
+    the sniffed prefix do not decode with it. Raises RuntimeError if the file
+    cannot be parsed.
+
+    Returns:
+        tuple: (the DataFrame, the encoding that decoded the file)
+    """
+    df, error = try_read_csv(file_path, encoding, dtypes)
+
+    # The sniffed prefix may be clean while the rest of the file is not
+    if isinstance(error, UnicodeDecodeError):
+        encoding = LATIN1_FALLBACK
+        df, error = try_read_csv(file_path, encoding, dtypes)
+
+    if error and dtypes:
+        # Values the dtypes don't fit; apply_dtype_plan skips those columns
+        df, error = try_read_csv(file_path, encoding)
+
+    if error:
+        raise RuntimeError(f"Failed to read CSV with encoding {encoding}: {error}")
+    return df, encoding
+
+def load_csv(file_path: str, session_id: str | None = None, dtypes: dict | None = None) -> pd.DataFrame:
+    """
+    Loads a CSV file into a DataFrame using the best detected encoding, with
+    the columns converted to the dtypes of a plan from plan_dtypes if given.
+    Raises RuntimeError if the file cannot be parsed.
+    """
+    encoding = detect_encoding(file_path, session_id)
+    # Typed columns are parsed straight into their dtype, dates afterwards
+    read_dtypes = {
+        name: _pandas_dtype(dtype) for name, dtype in (dtypes or {}).items() if not dtype.startswith("datetime64")
+    } or None
+    df, used_encoding = read_csv_decoded(file_path, encoding, read_dtypes)
+    if used_encoding != encoding and session_id:
+        store_encoding(file_path, session_id, used_encoding)
+    return apply_dtype_plan(df, dtypes)
+
+def table_to_pandas(table: pa.Table | pa.RecordBatch, dtypes: dict | None = None) -> pd.DataFrame:
+    """
+    Converts an Arrow table or record batch to a DataFrame. With a dtype plan,
+    text columns stay Arrow-backed instead of becoming Python string objects.
+    """
+    if not dtypes:
+        return table.to_pandas()
+    df = table.to_pandas(types_mapper={pa.string(): STRING_DTYPE, pa.large_string(): STRING_DTYPE}.get)
+    return apply_dtype_plan(df, dtypes)
+
+def read_columnar(file_path: str, dtypes: dict | None = None) -> pd.DataFrame:
+    """
+    Loads a columnar copy of a dataset. Arrow IPC files are memory-mapped so
+    no parsing happens and pages are read lazily by the OS.
+    """
+    if file_path.endswith(".parquet"):
+        return table_to_pandas(pq.read_table(file_path), dtypes)
+    with pa.memory_map(file_path, "r") as source:
+        table = pa.ipc.open_file(source).read_all()
+    return table_to_pandas(table, dtypes)
+
+def load_dataset(file_path: str, session_id: str | None = None, dtypes: dict | None = None) -> pd.DataFrame:
+    """
+    Loads a session's dataset, preferring its columnar copy over the raw CSV,
+    with the columns converted to the dtypes of a plan if given.
+    """
+    columnar_path = find_columnar_copy(file_path)
+    if columnar_path:
+        try:
+            with timed("columnar_read"):
+                df = read_columnar(columnar_path, dtypes)
+            record_io("columnar_read", nbytes=os.path.getsize(columnar_path), rows=len(df))
+            return df
+        except Exception as e:
+            if columnar_path == str(file_path):
+                raise RuntimeError(f"Failed to read columnar file {columnar_path}: {e}")
+            print(f"Could not read columnar copy {columnar_path}, falling back to CSV: {e}")
+    with timed("csv_parse"):
+        df = load_csv(file_path, session_id, dtypes)
+    record_io("csv_parse", nbytes=os.path.getsize(file_path), rows=len(df))
+    return df
+
+def iter_chunks(file_path: str, session_id: str | None = None, chunksize: int = CHUNK_ROWS,
+                columns: list | None = None, dtypes: dict | None = None):
+    """
+    Yields a dataset as a sequence of DataFrames of at most `chunksize` rows,
+    so callers can scan files that do not fit in memory. Only the given
+    columns are read, and converted to the dtypes of a plan if given.
+    """
+    columnar_path = find_columnar_copy(file_path)
+    if columnar_path and columnar_path.endswith(".parquet"):
+        parquet_file = pq.ParquetFile(columnar_path)
+        for batch in parquet_file.iter_batches(batch_size=chunksize, columns=columns):
+            yield table_to_pandas(batch, dtypes)
+    elif columnar_path:
+        with pa.memory_map(columnar_path, "r") as source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                batch = reader.get_batch(i)
+                if columns is not None:
+                    batch = batch.select(columns)
+                for offset in range(0, batch.num_rows, chunksize):
+                    yield table_to_pandas(batch.slice(offset, chunksize), dtypes)
+    else:
+        encoding = detect_encoding(file_path, session_id)
+        rows = 0
+        try:
+            for chunk in _csv_chunks(file_path, encoding, chunksize, columns):
+                rows += len(chunk)
+                yield apply_dtype_plan(chunk, dtypes)
+        except UnicodeDecodeError:
+            # As in load_csv(): the rest of the file may not match the sniffed
+            # prefix. The rows already yielded are skipped on the second pass
+            if session_id:
+                store_encoding(file_path, session_id, LATIN1_FALLBACK)
+            for chunk in _csv_chunks(file_path, LATIN1_FALLBACK, chunksize, columns):
+                if rows >= len(chunk):
+                    rows -= len(chunk)
+                    continue
+                yield apply_dtype_plan(chunk.iloc[rows:], dtypes)
+                rows = 0
+
+def _csv_chunks(file_path: str, encoding: str, chunksize: int, columns: list | None):
+    with pd.read_csv(file_path, encoding=encoding, chunksize=chunksize, usecols=columns) as reader:
+        yield from reader
@@ -0,0 +1,206 @@
+import os
+import json
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import BaseMessage, messages_from_dict, message_to_dict
+from utils.local_storage import BACKEND_ROOT
+
+HISTORY_STORE_PATH = os.getenv("HISTORY_STORE_PATH", str(BACKEND_ROOT / "cache" / "history.db"))
+# Most recent messages loaded into the prompt (5 exchanges)
+HISTORY_WINDOW = int(os.getenv("HISTORY_WINDOW", "10"))
+# Session histories kept in memory, least recently used are dropped first
+HISTORY_CACHE_SESSIONS = int(os.getenv("HISTORY_CACHE_SESSIONS", "1024"))
+
+class HistoryStore(ABC):
+    """
+    Persistent storage of chat messages. Implementations append messages one
+    by one and return the most recent ones of a session in order.
+    """
+
+    @abstractmethod
+    def append(self, session_id: str, messages: list[BaseMessage]) -> tuple[int, int]:
+        """Stores messages and returns the session's history version before and after."""
+
+    @abstractmethod
+    def load(self, session_id: str, limit: int) -> tuple[list[BaseMessage], int]:
+        """Returns the last `limit` messages of a session and the history version."""
+
+    @abstractmethod
+    def version(self, session_id: str) -> int:
+        """Returns a number that changes whenever messages are appended to a session."""
+
+    @abstractmethod
+    def truncate(self, session_id: str, version: int):
+        """Deletes the messages appended to a session after it was at `version`."""
+
+    @abstractmethod
+    def clear(self, session_id: str):
+        """Deletes every message of a session."""
+
+class SQLiteHistoryStore(HistoryStore):
+    """
+    Append-only message log in SQLite (WAL mode), one row per message. Every
+    worker process opens the same file, so a session can be served by any of them.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " session_id TEXT NOT NULL,"
+                " message TEXT NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS messages_session ON messages (session_id, id)")
+        finally:
+            conn.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=10)
+
+    def append(self, session_id, messages):
+        conn = self._connect()
+        try:
+            with conn:
+                previous = self._version(conn, session_id)
+                conn.executemany(
+                    "INSERT INTO messages (session_id, message) VALUES (?, ?)",
+                    [(session_id, json.dumps(message_to_dict(message))) for message in messages],
+                )
+                return previous, self._version(conn, session_id)
+        finally:
+            conn.close()
+
+    def load(self, session_id, limit):
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT id, message FROM messages WHERE session_id = ? ORDER BY id DESC LIMIT ?",
+                (session_id, limit),
+            ).fetchall()
+        finally:
+            conn.close()
+        rows.reverse()
+        messages = messages_from_dict([json.loads(message) for _, message in rows])
+        return messages, rows[-1][0] if rows else 0
+
+    @staticmethod
+    def _version(conn, session_id) -> int:
+        row = conn.execute("SELECT MAX(id) FROM messages WHERE session_id = ?", (session_id,)).fetchone()
+        return row[0] or 0
+
+    def version(self, session_id):
+        conn = self._connect()
+        try:
+            return self._version(conn, session_id)
+        finally:
+            conn.close()
+
+    def truncate(self, session_id, version):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("DELETE FROM messages WHERE session_id = ? AND id > ?", (session_id, version))
+        finally:
+            conn.close()
+
+    def clear(self, session_id):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+        finally:
+            conn.close()
+
+class SessionHistory(BaseChatMessageHistory):
+    """
+    Chat history of one session: a window of its latest messages held in
+    memory, with every new message appended straight to the store.
+    """
+
+    def __init__(self, session_id: str, store: HistoryStore):
+        self.session_id = session_id
+        self.store = store
+        self._messages, self.version = store.load(session_id, HISTORY_WINDOW)
+
+    @property
+    def messages(self) -> list[BaseMessage]:
+        return list(self._messages)
+
+    def add_messages(self, messages) -> None:
+        messages = list(messages)
+        previous, version = self.store.append(self.session_id, messages)
+        if previous == self.version:
+            self._messages = (self._messages + messages)[-HISTORY_WINDOW:]
+            self.version = version
+        else:
+            # Another worker appended in between, the window is stale
+            self._messages, self.version = self.store.load(self.session_id, HISTORY_WINDOW)
+
+    def refresh(self):
+        """Reloads the window if another worker appended to the session."""
+        if self.store.version(self.session_id) != self.version:
+            self._messages, self.version = self.store.load(self.session_id, HISTORY_WINDOW)
+
+    def truncate(self, version: int):
+        """Drops the messages appended since the history was at version."""
+        self.store.truncate(self.session_id, version)
+        self._messages, self.version = self.store.load(self.session_id, HISTORY_WINDOW)
+
+    def clear(self) -> None:
+        self.store.clear(self.session_id)
+        self._messages = []
+        self.version = 0
+
+_store = None
+# session_id -> SessionHistory, least recently used first
+_histories: OrderedDict = OrderedDict()
+_histories_lock = threading.Lock()
+
+def get_history_store() -> HistoryStore:
+    """Returns the configured history store, opening the SQLite one on first use."""
+    global _store
+    with _histories_lock:
+        if _store is None:
+            _store = SQLiteHistoryStore(HISTORY_STORE_PATH)
+        return _store
+
+def set_history_store(store: HistoryStore):
+    """Replaces the history backend, e.g. with one shared by several hosts."""
+    global _store
+    with _histories_lock:
+        _store = store
+        _histories.clear()
+
+def get_history(session_id: str) -> SessionHistory:
+    """
+    Returns a session's history from the in-process cache, loading its latest
+    window from the store on a miss and reloading it when it is out of date.
+    """
+    store = get_history_store()
+    with _histories_lock:
+        history = _histories.get(session_id)
+        if history is not None:
+            _histories.move_to_end(session_id)
+    if history is None:
+        history = SessionHistory(session_id, store)
+        with _histories_lock:
+            _histories[session_id] = history
+            while len(_histories) > HISTORY_CACHE_SESSIONS:
+                _histories.popitem(last=False)
+    else:
+        history.refresh()
+    return history
+
+def forget_history(session_id: str):
+    """Deletes a session's history from the store and the cache."""
+    with _histories_lock:
+        _histories.pop(session_id, None)
+    get_history_store().clear(session_id)
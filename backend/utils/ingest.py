@@ -0,0 +1,280 @@
+import io
+import os
+import queue
+import asyncio
+import hashlib
+import threading
+from pathlib import Path
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from utils.dataloader import read_csv_decoded, detect_encoding, sniff_encoding, ENCODING_SAMPLE_BYTES, CHUNK_ROWS
+from utils.processdata import DatasetProfiler
+from utils.concurrency import run_io
+
+# "arrow" writes an uncompressed Arrow IPC file that can be memory-mapped,
+# "parquet" trades slower loads for a smaller file.
+COLUMNAR_FORMAT = os.getenv("COLUMNAR_FORMAT", "arrow")
+# S3 multipart parts must be at least 5 MB, except the last one
+S3_PART_SIZE = max(int(os.getenv("S3_PART_SIZE_MB", "16")), 5) * 1024 * 1024
+S3_UPLOAD_CONCURRENCY = int(os.getenv("S3_UPLOAD_CONCURRENCY", "4"))
+# Size of the reads from the request body; 0 disables the upload size limit
+UPLOAD_CHUNK_BYTES = int(os.getenv("UPLOAD_CHUNK_KB", "1024")) * 1024
+MAX_UPLOAD_MB = int(os.getenv("MAX_UPLOAD_MB", "10240"))
+
+def convert_to_columnar(csv_path: str, session_id: str | None = None, encoding: str | None = None):
+    """
+    Writes a typed columnar copy of a CSV file next to it.
+
+    Args:
+        csv_path (str): Path to the uploaded CSV file.
+        session_id (str, optional): Session owning the file.
+        encoding (str, optional): Encoding to read the file with, detected if not given.
+
+    Returns:
+        tuple: (path of the columnar copy or None if conversion failed, the
+        encoding that decoded the file, latin1 if the given one did not)
+    """
+    suffix = ".parquet" if COLUMNAR_FORMAT == "parquet" else ".arrow"
+    target = Path(csv_path).with_suffix(suffix)
+    tmp_target = target.with_name(target.name + ".tmp")
+    encoding = encoding or detect_encoding(csv_path, session_id)
+    try:
+        df, encoding = read_csv_decoded(csv_path, encoding)
+        if suffix == ".parquet":
+            df.to_parquet(tmp_target, index=False)
+        else:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            with pa.OSFile(str(tmp_target), "wb") as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+        # Rename last so readers never see a partially written copy
+        os.replace(tmp_target, target)
+        return str(target), encoding
+    except Exception as e:
+        print(f"Columnar conversion failed for {csv_path}: {e}")
+        if tmp_target.exists():
+            tmp_target.unlink()
+        return None, encoding
+
+class _ChunkPipe(io.RawIOBase):
+    """A blocking byte pipe: the upload writes chunks in, the parser reads them out."""
+
+    def __init__(self, max_chunks: int = 16):
+        self._chunks = queue.Queue(maxsize=max_chunks)
+        self._pending = memoryview(b"")
+        self._eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._pending and not self._eof:
+            chunk = self._chunks.get()
+            if chunk is None:
+                self._eof = True
+            else:
+                self._pending = memoryview(chunk)
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+    def put(self, chunk, alive):
+        """Queues a chunk, giving up if the reader has stopped."""
+        while alive():
+            try:
+                self._chunks.put(chunk, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+class StreamingIngest:
+    """
+    Ingests an upload while its bytes arrive. Each chunk is appended to the
+    CSV file on disk and hashed, and a background thread parses the stream to
+    build the dataset profile and write the columnar copy. No second pass over
+    the file is needed once the upload is complete.
+    """
+
+    def __init__(self, csv_path: str):
+        self.csv_path = csv_path
+        self.size = 0
+        self.encoding = None
+        self._hash = hashlib.sha256()
+        self._file = open(csv_path, "wb")
+        self._prefix = b""
+        self._pipe = None
+        self._parser = None
+        self._profiler = DatasetProfiler()
+        self._parse_error = None
+        suffix = ".parquet" if COLUMNAR_FORMAT == "parquet" else ".arrow"
+        self._columnar_target = Path(csv_path).with_suffix(suffix)
+        self._columnar_tmp = self._columnar_target.with_name(self._columnar_target.name + ".tmp")
+        self._columnar_ok = True
+
+    def write(self, chunk: bytes):
+        """Appends a chunk of the upload."""
+        self._file.write(chunk)
+        self._hash.update(chunk)
+        self.size += len(chunk)
+        if self._parser is None:
+            # The encoding is sniffed from the first bytes before parsing starts
+            self._prefix += chunk
+            if len(self._prefix) >= ENCODING_SAMPLE_BYTES:
+                self._start_parser(complete=False)
+        else:
+            self._pipe.put(chunk, self._parser.is_alive)
+
+    def _start_parser(self, complete: bool):
+        self.encoding = sniff_encoding(self._prefix[:ENCODING_SAMPLE_BYTES], complete)
+        self._pipe = _ChunkPipe()
+        self._parser = threading.Thread(target=self._parse, daemon=True)
+        self._parser.start()
+        self._pipe.put(self._prefix, self._parser.is_alive)
+        self._prefix = b""
+
+    def _write_columnar(self, writer, schema, chunk: pd.DataFrame):
+        """Appends a parsed chunk to the columnar copy, returning the writer."""
+        table = pa.Table.from_pandas(chunk, preserve_index=False)
+        if writer is None:
+            if self._columnar_target.suffix == ".parquet":
+                return pq.ParquetWriter(str(self._columnar_tmp), table.schema), table.schema, table
+            sink = pa.OSFile(str(self._columnar_tmp), "wb")
+            return pa.ipc.new_file(sink, table.schema), table.schema, table
+        # Types are inferred per chunk; later chunks must fit the first one
+        return writer, schema, table if table.schema == schema else table.cast(schema)
+
+    def _parse(self):
+        writer = None
+        schema = None
+        try:
+            with pd.read_csv(io.BufferedReader(self._pipe), encoding=self.encoding, chunksize=CHUNK_ROWS) as reader:
+                for chunk in reader:
+                    self._profiler.update(chunk)
+                    if not self._columnar_ok:
+                        continue
+                    try:
+                        writer, schema, table = self._write_columnar(writer, schema, chunk)
+                        writer.write_table(table)
+                    except (pa.ArrowException, ValueError) as e:
+                        print(f"Streaming columnar conversion stopped for {self.csv_path}: {e}")
+                        self._columnar_ok = False
+        except Exception as e:
+            self._parse_error = e
+        finally:
+            if writer is not None:
+                writer.close()
+
+    def finish(self) -> dict:
+        """
+        Completes the ingest once every chunk has been written.
+
+        Returns:
+            dict: The upload's sha256 and size, the encoding that decoded it,
+            the columnar copy's path (None if it could not be built) and the
+            dataset profile (None if the stream could not be parsed).
+        """
+        self._file.close()
+        if self._parser is None:
+            self._start_parser(complete=True)
+        self._pipe.put(None, self._parser.is_alive)
+        self._parser.join()
+
+        columnar_path = None
+        if self._parse_error is None and self._columnar_ok and self._columnar_tmp.exists():
+            os.replace(self._columnar_tmp, self._columnar_target)
+            columnar_path = str(self._columnar_target)
+        else:
+            self._columnar_tmp.unlink(missing_ok=True)
+            # e.g. a column whose type changes after the first chunk, or bytes
+            # past the sniffed prefix that don't decode; the encoding that
+            # read the whole file is the one recorded
+            columnar_path, self.encoding = convert_to_columnar(self.csv_path, encoding=self.encoding)
+
+        # Without a streamed profile the caller profiles the stored file instead
+        profile = self._profiler.result() if self._parse_error is None else None
+        return {
+            "sha256": self._hash.hexdigest(),
+            "size": self.size,
+            "encoding": self.encoding,
+            "columnar_path": columnar_path,
+            "profile": profile,
+        }
+
+    def abort(self):
+        """Stops the ingest and removes everything it wrote."""
+        self._file.close()
+        if self._parser is not None:
+            self._pipe.put(None, self._parser.is_alive)
+            self._parser.join()
+        for path in (self.csv_path, self._columnar_tmp):
+            Path(path).unlink(missing_ok=True)
+
+class S3MultipartUpload:
+    """
+    Streams an upload to S3 as a multipart upload, sending parts in parallel
+    while later bytes are still being received.
+    """
+
+    def __init__(self, s3, bucket: str, key: str):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self._upload_id = None
+        self._buffer = bytearray()
+        self._parts = []
+        self._next_part = 1
+        self._in_flight = set()
+        self._slots = asyncio.Semaphore(S3_UPLOAD_CONCURRENCY)
+
+    async def _upload_part(self, part_number: int, body: bytes):
+        try:
+            response = await run_io(
+                self.s3.upload_part,
+                Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                PartNumber=part_number, Body=body,
+            )
+            self._parts.append({"PartNumber": part_number, "ETag": response["ETag"]})
+        finally:
+            self._slots.release()
+
+    async def _flush(self):
+        if self._upload_id is None:
+            response = await run_io(self.s3.create_multipart_upload, Bucket=self.bucket, Key=self.key)
+            self._upload_id = response["UploadId"]
+        # Bounds the parts held in memory while S3 is slower than the client
+        await self._slots.acquire()
+        part_number = self._next_part
+        self._next_part += 1
+        body = bytes(self._buffer)
+        self._buffer.clear()
+        task = asyncio.create_task(self._upload_part(part_number, body))
+        self._in_flight.add(task)
+        task.add_done_callback(self._in_flight.discard)
+
+    async def write(self, chunk: bytes):
+        self._buffer += chunk
+        if len(self._buffer) >= S3_PART_SIZE:
+            await self._flush()
+
+    async def complete(self):
+        if self._upload_id is None:
+            # Small enough for a single request
+            await run_io(self.s3.put_object, Bucket=self.bucket, Key=self.key, Body=bytes(self._buffer))
+            return
+        if self._buffer:
+            await self._flush()
+        await asyncio.gather(*list(self._in_flight))
+        parts = sorted(self._parts, key=lambda part: part["PartNumber"])
+        await run_io(
+            self.s3.complete_multipart_upload,
+            Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+            MultipartUpload={"Parts": parts},
+        )
+
+    async def abort(self):
+        if self._in_flight:
+            await asyncio.gather(*list(self._in_flight), return_exceptions=True)
+        if self._upload_id is not None:
+            await run_io(self.s3.abort_multipart_upload, Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
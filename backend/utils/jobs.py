@@ -0,0 +1,206 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import threading
+
+# Finished jobs are kept this long, so clients can still read their result
+# and retries of the same query are answered by them
+JOB_RETENTION_SECONDS = int(os.getenv("JOB_RETENTION_SECONDS", "600"))
+# Jobs kept at most, finished ones are dropped first
+MAX_JOBS = int(os.getenv("MAX_JOBS", "1000"))
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+FINISHED_STATES = (JOB_DONE, JOB_FAILED, JOB_CANCELLED)
+
+class JobLimitError(RuntimeError):
+    """Raised when MAX_JOBS jobs are still running and a new one is submitted."""
+
+class Job:
+    """
+    One analysis running in the background. Everything it reports is kept as
+    a numbered list of events, so a client can (re)connect at any time and
+    replay what it missed.
+    """
+
+    def __init__(self, session_id: str, user_query: str, key: tuple):
+        self.id = str(uuid.uuid4())
+        self.session_id = session_id
+        self.user_query = user_query
+        self.key = key
+        self.status = JOB_QUEUED
+        self.result = None
+        self.status_code = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.events = []
+        # Set on cancellation, for the blocking code running in the pools
+        self.cancelled = threading.Event()
+        self._task = None
+        self._loop = asyncio.get_running_loop()
+        self._changed = asyncio.Condition()
+
+    def emit(self, event: str, data=None):
+        """
+        Appends an event and wakes up the clients following the job. Once the
+        job has finished its final status is the last event, so later ones
+        (output a cancelled job's worker had already sent) are dropped.
+        """
+        if self.finished:
+            return
+        self._append(event, data)
+
+    def _append(self, event: str, data=None):
+        self.events.append((event, data))
+        self._loop.create_task(self._notify())
+
+    def emit_threadsafe(self, event: str, data=None):
+        """emit() for code running in a worker thread."""
+        self._loop.call_soon_threadsafe(self.emit, event, data)
+
+    async def _notify(self):
+        async with self._changed:
+            self._changed.notify_all()
+
+    def _set_status(self, status: str):
+        self.status = status
+        if status in FINISHED_STATES:
+            self.finished_at = time.time()
+        self._append("status", {"status": status})
+
+    @property
+    def finished(self) -> bool:
+        return self.status in FINISHED_STATES
+
+    async def events_after(self, last_event_id: int = -1):
+        """
+        Yields (id, event, data) for every event after last_event_id, waiting
+        for new ones until the job has finished.
+        """
+        next_id = last_event_id + 1
+        while True:
+            async with self._changed:
+                while next_id >= len(self.events) and not self.finished:
+                    await self._changed.wait()
+            while next_id < len(self.events):
+                event, data = self.events[next_id]
+                yield next_id, event, data
+                next_id += 1
+            if self.finished:
+                return
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "session_id": self.session_id,
+            "user_query": self.user_query,
+            "status": self.status,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "status_code": self.status_code,
+            "result": self.result,
+        }
+
+def format_sse(event_id: int, event: str, data) -> str:
+    """Formats one server-sent event."""
+    return f"id: {event_id}\nevent: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+class JobManager:
+    """
+    Runs analyses as background tasks. Submitting the same query for the same
+    session while its job is running, or shortly after it finished, returns
+    that job instead of starting the work again.
+    """
+
+    def __init__(self):
+        self._jobs = {}
+        self._by_key = {}
+
+    @staticmethod
+    def job_key(session_id: str, user_query: str) -> tuple:
+        return session_id, " ".join(user_query.lower().split())
+
+    def get(self, job_id: str) -> Job | None:
+        return self._jobs.get(job_id)
+
+    def submit(self, session_id: str, user_query: str, pipeline) -> tuple[Job, bool]:
+        """
+        Starts `await pipeline(job)` as a job, which returns (response, status
+        code), unless an equal job can be reused.
+
+        Returns:
+            tuple: (the job, whether an existing job was reused)
+        """
+        self._prune()
+        key = self.job_key(session_id, user_query)
+        job = self._jobs.get(self._by_key.get(key))
+        # Failed and cancelled jobs are retried, not reused
+        if job and job.status not in (JOB_FAILED, JOB_CANCELLED):
+            return job, True
+        if len(self._jobs) >= MAX_JOBS:
+            raise JobLimitError(f"{MAX_JOBS} jobs are already running")
+
+        job = Job(session_id, user_query, key)
+        self._jobs[job.id] = job
+        self._by_key[key] = job.id
+        job.emit("status", {"status": JOB_QUEUED})
+        job._task = asyncio.create_task(self._run(job, pipeline))
+        return job, False
+
+    async def _run(self, job: Job, pipeline):
+        job._set_status(JOB_RUNNING)
+        try:
+            job.result, job.status_code = await pipeline(job)
+        except asyncio.CancelledError:
+            if not job.finished:
+                job._set_status(JOB_CANCELLED)
+            return
+        except Exception as e:
+            print(f"Job {job.id} failed: {e}")
+            job.result, job.status_code = {"error": str(e)}, 500
+        if job.status_code >= 400:
+            job.emit("error", job.result)
+            job._set_status(JOB_FAILED)
+        else:
+            job.emit("result", job.result)
+            job._set_status(JOB_DONE)
+
+    def cancel(self, job: Job) -> bool:
+        """Cancels a job that has not finished yet. Returns whether it was."""
+        if job.finished:
+            return False
+        job.cancelled.set()
+        job._task.cancel()
+        if job.status == JOB_QUEUED:
+            # The task never started, so it can't report the cancellation itself
+            job._set_status(JOB_CANCELLED)
+        return True
+
+    def has_active(self, session_id: str) -> bool:
+        """Whether a session has an unfinished job."""
+        return any(job.session_id == session_id and not job.finished for job in self._jobs.values())
+
+    def cancel_session(self, session_id: str):
+        """Cancels every unfinished job of a session."""
+        for job in list(self._jobs.values()):
+            if job.session_id == session_id:
+                self.cancel(job)
+
+    def _prune(self):
+        """Forgets finished jobs past their retention, and the oldest ones over MAX_JOBS."""
+        now = time.time()
+        finished = sorted((job for job in self._jobs.values() if job.finished), key=lambda job: job.finished_at)
+        excess = len(self._jobs) - MAX_JOBS + 1
+        for i, job in enumerate(finished):
+            if i >= excess and now - job.finished_at < JOB_RETENTION_SECONDS:
+                break
+            del self._jobs[job.id]
+            if self._by_key.get(job.key) == job.id:
+                del self._by_key[job.key]
+
+job_manager = JobManager()
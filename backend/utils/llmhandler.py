@@ -1,130 +1,342 @@
 import os
+import re
 import pickle
+import threading
 from pathlib import Path
-from langchain_google_genai import ChatGoogleGenerativeAI
 from dotenv import load_dotenv
-from langchain.memory import ConversationBufferWindowMemory
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.runnables import RunnableLambda
 from langchain_core.runnables.history import RunnableWithMessageHistory
 from langchain_core.chat_history import BaseChatMessageHistory
 from utils.processdata import extract_csv_metadata_and_sample
-from utils.local_storage import get_session_dir
+from utils.local_storage import LOCAL_STORAGE_PATH
+from utils.history_store import get_history, forget_history, get_history_store
+from utils.concurrency import run_io, run_cpu
+from utils import codegen_cache
+from utils.prompt_builder import format_csv_info, trim_history, record_prompt, count_tokens
+from utils.metrics import timed, inc, record_cache
+from utils.artifacts import summarize_artifacts, with_loaded_dtypes
+from utils.dataloader import CHUNK_ROWS
+from utils.out_of_core import execution_mode, EXECUTION_FRAME, EXECUTION_CHUNKED
 
 load_dotenv()
 
-# --- In-memory and file-based session management ---
-histories = {}
+# --- Session management ---
+# Histories live in the store of utils/history_store.py; each message is
+# appended as it is added, so there is nothing to save after a turn.
 
 def get_memory_file(session_id: str) -> Path:
-    """Returns the path to the memory file for a given session."""
-    session_dir = get_session_dir(session_id)
-    return session_dir / "memory.pkl"
+    """Returns the path of the pickled history older versions kept per session."""
+    return LOCAL_STORAGE_PATH / session_id / "memory.pkl"
 
 def get_session_history(session_id: str) -> BaseChatMessageHistory:
     """
-    Loads chat history from a file if it exists, otherwise creates a new one.
-    Keeps the history in memory for the duration of the app's lifecycle.
+    Returns the session's chat history, windowed to its latest messages.
+    A history pickled by an older version is moved into the store first.
     """
-    if session_id not in histories:
-        memory_file = get_memory_file(session_id)
-        if memory_file.exists():
+    history = get_history(session_id)
+    memory_file = get_memory_file(session_id)
+    if memory_file.exists():
+        try:
             with open(memory_file, "rb") as f:
-                histories[session_id] = pickle.load(f)
-        else:
-            # This creates a `ChatMessageHistory` object, which is what is needed
-            histories[session_id] = ConversationBufferWindowMemory(
-                k=5, return_messages=True
-            ).chat_memory
-    return histories[session_id]
-
-def save_session_history(session_id: str):
-    """Saves the current session's chat history to a file."""
-    if session_id in histories:
-        memory_file = get_memory_file(session_id)
-        with open(memory_file, "wb") as f:
-            pickle.dump(histories[session_id], f)
-
-def get_conversational_chain(csv_path: str, csv_info: str, model_name: str):
+                legacy = pickle.load(f)
+            if not history.messages:
+                history.add_messages(legacy.messages)
+            os.remove(memory_file)
+        except Exception as e:
+            print(f"Failed to import history file for session {session_id}: {e}")
+    return history
+
+# The prompt only depends on per-request inputs (csv_path, csv_info, history),
+# so one template serves every session.
+PROMPT = ChatPromptTemplate.from_messages(
+    [
+        (
+            "system",
+            "You are an expert Python data analyst and conversation assistant. You can analyze CSV data and handle queries about the conversation.\n\n"
+            "For data analysis queries:\n"
+            "- Write Python code using pandas (and matplotlib if needed)\n"
+            "- The path to the CSV file is: {csv_path}\n"
+            "{data_access}"
+            "- For plots, save as 'output.png'\n"
+            "- Output code without markdown formatting\n\n"
+            "For conversation queries (e.g., 'what was my last query'):\n"
+            "- Respond with: print('Your last query was: \"<previous query>\"')\n"
+            "- Do not try to access conversation history directly\n\n"
+            "CSV Metadata and Sample:\n{csv_info}\n\n"
+            "{artifacts}",
+        ),
+        MessagesPlaceholder(variable_name="history"),
+        ("human", "{input}"),
+    ]
+)
+
+SQL_PROMPT = ChatPromptTemplate.from_messages(
+    [
+        (
+            "system",
+            "You are an expert data analyst writing DuckDB SQL.\n\n"
+            "- The dataset is the table df; answer with one SELECT query over it (WITH clauses are allowed)\n"
+            "- Quote column names with double quotes\n"
+            "- Only SELECT is allowed: no DDL, no writes, no file or table functions\n"
+            "- Order results and LIMIT long ones\n"
+            "- Output only the SQL, without markdown formatting or explanations\n\n"
+            "CSV Metadata and Sample:\n{csv_info}",
+        ),
+        MessagesPlaceholder(variable_name="history"),
+        ("human", "{input}"),
+    ]
+)
+
+LANGUAGE_PYTHON = "python"
+LANGUAGE_SQL = "sql"
+
+# "auto" routes each query to SQL or Python, "python" or "sql" forces one
+GENERATION_MODE = os.getenv("GENERATION_MODE", "auto").lower()
+
+# Queries needing plots, modelling or the conversation are left to Python
+_PYTHON_ONLY = re.compile(
+    r"\b(plot|chart|graph|visuali[sz]|histogram|scatter|heatmap|pie|draw|trend|correlat|regress|predict|"
+    r"forecast|cluster|model|outlier|query|queries|asked)"
+)
+# Aggregates and top-n lookups SQL answers directly. Words like "by", "per"
+# or "which" appear in most analytical questions, so they don't count
+_SQL_FRIENDLY = re.compile(
+    r"\b(how many|count|number of|sum of|total|average|avg|mean|median|min|max|minimum|maximum|"
+    r"(top|bottom) \d+|highest|lowest|distinct|unique values|group by)\b"
+)
+
+def route_query(user_query: str) -> str:
+    """Picks the language code is generated in for a query: LANGUAGE_SQL or LANGUAGE_PYTHON."""
+    if GENERATION_MODE in (LANGUAGE_PYTHON, LANGUAGE_SQL):
+        return GENERATION_MODE
+    query = user_query.lower()
+    if _PYTHON_ONLY.search(query):
+        return LANGUAGE_PYTHON
+    return LANGUAGE_SQL if _SQL_FRIENDLY.search(query) else LANGUAGE_PYTHON
+
+# How generated code gets at the data, per execution mode (utils/out_of_core.py)
+DATA_ACCESS = {
+    EXECUTION_FRAME: "- The DataFrame 'df' will be loaded automatically - do not include pd.read_csv\n",
+    EXECUTION_CHUNKED: (
+        "- The dataset is too large for memory: there is no 'df', do not include pd.read_csv and never concatenate all chunks\n"
+        "- For filters, groupings and aggregates prefer dataset.sql(query), which runs a DuckDB SELECT over the table df and returns a DataFrame\n"
+        f"- Otherwise iterate over dataset.chunks(columns=[...]), which yields DataFrames of up to {CHUNK_ROWS} rows holding only the listed columns\n"
+        "- Reduce each chunk (filter, then sum/count/min/max or groupby) and combine the partial results; compute means as total sum / total count\n"
+        "- dataset.head(n) returns the first rows, dataset.columns the column names, dataset.num_rows the row count\n"
+    ),
+}
+
+def build_prompt(inputs: dict):
     """
-    Initializes and returns a conversational chain with memory.
+    Fills the prompt with the dataset description and history compacted to
+    their token budgets, and records the prompt's size.
     """
-    llm = ChatGoogleGenerativeAI(model=model_name)
-
-    prompt = ChatPromptTemplate.from_messages(
-        [
-            (
-                "system",
-                "You are an expert Python data analyst and conversation assistant. You can analyze CSV data and handle queries about the conversation.\n\n"
-                "For data analysis queries:\n"
-                "- Write Python code using pandas (and matplotlib if needed)\n"
-                "- The path to the CSV file is: {csv_path}\n"
-                "- The DataFrame 'df' will be loaded automatically - do not include pd.read_csv\n"
-                "- For plots, save as 'output.png'\n"
-                "- Output code without markdown formatting\n\n"
-                "For conversation queries (e.g., 'what was my last query'):\n"
-                "- Respond with: print('Your last query was: \"<previous query>\"')\n"
-                "- Do not try to access conversation history directly\n\n"
-                "CSV Metadata and Sample:\n{csv_info}",
-            ),
-            MessagesPlaceholder(variable_name="history"),
-            ("human", "{input}"),
-        ]
-    )
+    csv_info_text = format_csv_info(inputs["csv_info"], inputs["input"])
+    history = trim_history(inputs["history"])
+    prompt = SQL_PROMPT if inputs.get("language") == LANGUAGE_SQL else PROMPT
+    prompt_value = prompt.invoke({
+        **inputs, "csv_info": csv_info_text, "history": history, "artifacts": inputs.get("artifacts", ""),
+        "data_access": DATA_ACCESS[inputs.get("execution_mode", EXECUTION_FRAME)]
+    })
+    return record_prompt(prompt_value, csv_info_text, history)
 
-    chain = prompt | llm
+# model name -> conversational chain. Each chain holds one LLM client whose
+# connection is kept alive and reused across requests.
+_chains = {}
+_chains_lock = threading.Lock()
 
-    conversational_chain = RunnableWithMessageHistory(
-        chain,
-        get_session_history,
-        input_messages_key="input",
-        history_messages_key="history",
-    )
-    
-    return conversational_chain
+# Imported on first use by _chat_model_class(): importing the Gemini client
+# takes most of the API's startup time
+ChatGoogleGenerativeAI = None
+
+def _chat_model_class():
+    """Returns the chat model class chains are built with, importing it on first use."""
+    global ChatGoogleGenerativeAI
+    if ChatGoogleGenerativeAI is None:
+        from langchain_google_genai import ChatGoogleGenerativeAI
+    return ChatGoogleGenerativeAI
+
+def get_conversational_chain(model_name: str):
+    """
+    Returns the conversational chain with memory for a model, creating the
+    LLM client and chain on first use and reusing them afterwards.
+    """
+    with _chains_lock:
+        if model_name not in _chains:
+            llm = _chat_model_class()(model=model_name)
+
+            chain = RunnableLambda(build_prompt) | llm
+
+            _chains[model_name] = RunnableWithMessageHistory(
+                chain,
+                get_session_history,
+                input_messages_key="input",
+                history_messages_key="history",
+            )
+        return _chains[model_name]
+
+def warm_up(model_name="gemini-1.5-flash"):
+    """Builds the model's chain and opens the history store, ahead of the first query."""
+    get_conversational_chain(model_name)
+    get_history_store()
 
 def extract_code_only(text):
-    import re
-    code = re.sub(r"^```(?:python)?\s*|```$", "", text, flags=re.MULTILINE)
+    code = re.sub(r"^```(?:python|sql)?\s*|```$", "", text, flags=re.MULTILINE)
     return code.strip()
 
-def generate_code_from_query(session_id: str, csv_path: str, user_query: str, model_name="gemini-1.5-flash"):
-    csv_info = extract_csv_metadata_and_sample(csv_path)
+def _record_llm_call(response):
+    """Counts an LLM call and its tokens, as reported by the model or estimated."""
+    if isinstance(response, Exception):
+        inc("llm_calls_total", outcome="error")
+        return
+    inc("llm_calls_total", outcome="ok")
+    usage = getattr(response, "usage_metadata", None)
+    if usage:
+        inc("llm_tokens_total", usage.get("input_tokens", 0), kind="prompt")
+        inc("llm_tokens_total", usage.get("output_tokens", 0), kind="completion")
+    else:
+        content = response.content if hasattr(response, "content") else str(response)
+        inc("llm_tokens_total", count_tokens(str(content)), kind="completion")
+
+def _response_to_code(response) -> str:
+    code_raw = response.content if hasattr(response, "content") else str(response)
+    return extract_code_only(code_raw)
+
+def _execution_mode(csv_info, csv_path: str) -> str:
+    metadata = csv_info.get("metadata") if isinstance(csv_info, dict) else None
+    return execution_mode(metadata, csv_path)
+
+def _code_mode(language: str, mode: str) -> str:
+    # Kind of code generated, part of the code cache key
+    return LANGUAGE_SQL if language == LANGUAGE_SQL else mode
+
+def _lookup_cached_code(session_id: str, user_query: str, csv_info, model_name: str, mode: str = EXECUTION_FRAME):
+    """
+    Looks the query up in the code generation cache. On a hit the exchange is
+    added to the session history as if the LLM had answered it.
+
+    Returns:
+        tuple: (cache key or None, cached code or None)
+    """
+    history = get_session_history(session_id)
+    cache_key = codegen_cache.build_key(csv_info, user_query, history.messages, model_name, mode)
+    code = codegen_cache.lookup(cache_key) if cache_key else None
+    if cache_key:
+        record_cache("codegen", code is not None)
+    if code is not None:
+        history.add_user_message(user_query)
+        history.add_ai_message(code)
+    return cache_key, code
+
+def generate_code_from_query(session_id: str, csv_path: str, user_query: str, model_name="gemini-1.5-flash", csv_info=None,
+                             language=LANGUAGE_PYTHON):
+    """
+    Generates code answering a query about a session's dataset: Python by
+    default, or a DuckDB SQL query with language=LANGUAGE_SQL (see route_query()).
+    """
+    if csv_info is None:
+        csv_info = extract_csv_metadata_and_sample(csv_path, session_id)
+    csv_info = with_loaded_dtypes(csv_info, session_id)
+    mode = _execution_mode(csv_info, csv_path)
+
+    cache_key, code = _lookup_cached_code(session_id, user_query, csv_info, model_name, _code_mode(language, mode))
+    if code is not None:
+        return code
     
-    conversation_chain = get_conversational_chain(csv_path, csv_info, model_name)
+    artifacts = summarize_artifacts(session_id, user_query)
+    conversation_chain = get_conversational_chain(model_name)
     
     config = {"configurable": {"session_id": session_id}}
     
-    response = conversation_chain.invoke(
-        {
-            "input": user_query,
-            "csv_path": csv_path,
-            "csv_info": csv_info
-        },
-        config=config
+    with timed("llm_call"):
+        try:
+            response = conversation_chain.invoke(
+                {
+                    "input": user_query,
+                    "csv_path": csv_path,
+                    "csv_info": csv_info,
+                    "artifacts": artifacts,
+                    "execution_mode": mode,
+                    "language": language
+                },
+                config=config
+            )
+        except Exception as e:
+            _record_llm_call(e)
+            raise
+    _record_llm_call(response)
+
+    code = _response_to_code(response)
+    if cache_key:
+        codegen_cache.store(cache_key, code)
+    return code
+
+async def agenerate_code_from_query(session_id: str, csv_path: str, user_query: str, model_name="gemini-1.5-flash", csv_info=None,
+                                    language=LANGUAGE_PYTHON):
+    """
+    Async variant of generate_code_from_query for the API handlers. The LLM
+    call is awaited and file work runs on the worker pools, so the event loop
+    stays free while Gemini responds.
+    """
+    if csv_info is None:
+        csv_info = await run_cpu(extract_csv_metadata_and_sample, csv_path, session_id)
+    csv_info = await run_io(with_loaded_dtypes, csv_info, session_id)
+    mode = _execution_mode(csv_info, csv_path)
+
+    cache_key, code = await run_io(
+        _lookup_cached_code, session_id, user_query, csv_info, model_name, _code_mode(language, mode)
     )
-    
-    # Save the updated history back to the file
-    save_session_history(session_id)
+    if code is not None:
+        return code
 
-    code_raw = response.content if hasattr(response, "content") else str(response)
-    code = extract_code_only(code_raw)
+    artifacts = await run_io(summarize_artifacts, session_id, user_query)
+    conversation_chain = get_conversational_chain(model_name)
+
+    config = {"configurable": {"session_id": session_id}}
+
+    with timed("llm_call"):
+        try:
+            response = await conversation_chain.ainvoke(
+                {
+                    "input": user_query,
+                    "csv_path": csv_path,
+                    "csv_info": csv_info,
+                    "artifacts": artifacts,
+                    "execution_mode": mode,
+                    "language": language
+                },
+                config=config
+            )
+        except Exception as e:
+            _record_llm_call(e)
+            raise
+    _record_llm_call(response)
+
+    code = _response_to_code(response)
+    if cache_key:
+        await run_io(codegen_cache.store, cache_key, code)
     return code
 
+def history_version(session_id: str) -> int:
+    """Returns the session's history version, to roll the history back to with rollback_history()."""
+    return get_history_store().version(session_id)
+
+def rollback_history(session_id: str, version: int):
+    """Drops the messages added to a session's history since history_version() returned version."""
+    get_history(session_id).truncate(version)
+
 def clear_memory(session_id: str):
     """
     Completely removes all memory traces for a session.
     This includes in-memory history, file-based history, and any cached data.
     """
-    # Clear in-memory history
-    if session_id in histories:
-        try:
-            # Clear the actual memory object first
-            histories[session_id].clear()
-        except Exception:
-            pass  # Ensure we continue even if clear() fails
-        # Remove from the histories dictionary
-        del histories[session_id]
-    
+    # Clear the stored and cached history
+    try:
+        forget_history(session_id)
+    except Exception as e:
+        print(f"Error clearing history for session {session_id}: {e}")
+
     # Remove memory file
     memory_file = get_memory_file(session_id)
     try:
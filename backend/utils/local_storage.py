@@ -1,170 +1,268 @@
 import os
+import json
+import uuid
 import shutil
+import threading
+from contextlib import contextmanager
 from pathlib import Path
+from utils.metrics import timed
+
+try:
+    import fcntl
+except ImportError:  # Windows: blobs are only locked within the process
+    fcntl = None
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow comes with matplotlib; without it no image variants are made
+    Image = None
 
 # Define the root of the backend directory
 BACKEND_ROOT = Path(__file__).parent.parent.resolve()
-LOCAL_STORAGE_PATH = BACKEND_ROOT / "uploaded_csv"
+LOCAL_STORAGE_PATH = Path(os.getenv("LOCAL_STORAGE_PATH", str(BACKEND_ROOT / "uploaded_csv")))
+# Typed copies written next to the CSV at upload time, preferred for loading
+COLUMNAR_SUFFIXES = (".arrow", ".parquet")
+# Uploaded datasets are stored once per content hash and shared by sessions.
+# The blob store is a sibling of the session directories, so no session id
+# can name it
+BLOB_STORAGE_PATH = Path(os.getenv("BLOB_STORAGE_PATH", str(LOCAL_STORAGE_PATH.parent / "uploaded_blobs")))
+# Where the blob store used to live, inside the session root
+LEGACY_BLOB_STORAGE_PATH = LOCAL_STORAGE_PATH / "blobs"
+BLOB_FILE_NAME = "data.csv"
+REFS_DIR = "refs"
+UPLOAD_MANIFEST = "upload.json"
+# Extra versions of generated images written when they are saved, any of
+# "webp" (a compressed copy) and "thumbnail"
+IMAGE_VARIANTS = [name.strip() for name in os.getenv("IMAGE_VARIANTS", "").split(",") if name.strip()]
+IMAGE_WEBP_QUALITY = int(os.getenv("IMAGE_WEBP_QUALITY", "80"))
+# Largest width and height of thumbnails
+IMAGE_THUMBNAIL_PX = int(os.getenv("IMAGE_THUMBNAIL_PX", "320"))
+# variant -> (file name suffix, media type)
+IMAGE_FILES = {
+    "original": (".png", "image/png"),
+    "webp": (".webp", "image/webp"),
+    "thumbnail": (".thumb.png", "image/png"),
+}
+
+_blob_lock = threading.Lock()
 
 def setup_local_storage():
-    """Create the base directory for local sessions if it doesn't exist."""
+    """Create the base directories for local sessions and blobs if they don't exist."""
     LOCAL_STORAGE_PATH.mkdir(parents=True, exist_ok=True)
+    if LEGACY_BLOB_STORAGE_PATH.is_dir() and not BLOB_STORAGE_PATH.exists():
+        # Blobs stored before the blob store moved out of the session root
+        shutil.move(str(LEGACY_BLOB_STORAGE_PATH), str(BLOB_STORAGE_PATH))
+    BLOB_STORAGE_PATH.mkdir(parents=True, exist_ok=True)
+
+def is_valid_session_id(session_id: str) -> bool:
+    """Whether a session id is a UUID as issued by /upload/, so it can't name any other path."""
+    try:
+        return str(uuid.UUID(session_id)) == session_id
+    except (ValueError, TypeError, AttributeError):
+        return False
 
 def get_session_dir(session_id: str) -> Path:
     """Returns the path to a session directory, creating it if necessary."""
     session_dir = LOCAL_STORAGE_PATH / session_id
-    session_dir.mkdir(exist_ok=True)
+    session_dir.mkdir(parents=True, exist_ok=True)
     return session_dir
 
-def save_uploaded_file(session_id: str, file):
-    """Saves an uploaded file to a session-specific directory."""
-    session_dir = get_session_dir(session_id)
-    file_path = session_dir / file.filename
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
-    return str(file_path)
+@contextmanager
+def blob_lock():
+    """Serializes reference changes on blobs across threads and, where supported, processes."""
+    BLOB_STORAGE_PATH.mkdir(parents=True, exist_ok=True)
+    with _blob_lock, open(BLOB_STORAGE_PATH / ".lock", "a") as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+def get_blob_dir(content_hash: str) -> Path:
+    """Returns the directory holding a dataset blob and its derived files."""
+    return BLOB_STORAGE_PATH / content_hash
+
+def get_staging_dir() -> Path:
+    """Creates a directory for an upload whose content hash isn't known yet."""
+    staging_dir = BLOB_STORAGE_PATH / ".staging" / str(uuid.uuid4())
+    staging_dir.mkdir(parents=True)
+    return staging_dir
+
+def add_blob_ref(session_id: str, content_hash: str):
+    """Records that a session references a blob."""
+    refs_dir = get_blob_dir(content_hash) / REFS_DIR
+    refs_dir.mkdir(parents=True, exist_ok=True)
+    (refs_dir / session_id).touch()
+
+def commit_blob(session_id: str, staging_dir: Path, content_hash: str) -> tuple[Path, bool]:
+    """
+    Moves a staged upload into the blob store under its content hash and adds
+    the session's reference. If the blob already exists the staged copy is
+    dropped and the existing one is shared.
+
+    Returns:
+        tuple[Path, bool]: The blob directory and whether it was newly created.
+    """
+    blob_dir = get_blob_dir(content_hash)
+    with blob_lock():
+        created = not (blob_dir / BLOB_FILE_NAME).exists()
+        if created:
+            # Leftovers of a blob whose data is gone are replaced
+            shutil.rmtree(blob_dir, ignore_errors=True)
+            os.replace(staging_dir, blob_dir)
+        else:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+        add_blob_ref(session_id, content_hash)
+    return blob_dir, created
+
+def release_blob_ref(session_id: str, content_hash: str) -> bool:
+    """
+    Drops a session's reference to a blob and deletes the blob once no
+    session references it any more.
+
+    Returns:
+        bool: True if the blob was deleted.
+    """
+    blob_dir = get_blob_dir(content_hash)
+    with blob_lock():
+        (blob_dir / REFS_DIR / session_id).unlink(missing_ok=True)
+        refs_dir = blob_dir / REFS_DIR
+        if refs_dir.exists() and any(refs_dir.iterdir()):
+            return False
+        shutil.rmtree(blob_dir, ignore_errors=True)
+        return True
+
+def save_upload_manifest(session_id: str, manifest: dict):
+    """Records a session's upload: its file name, content hash and size."""
+    manifest_file = get_session_dir(session_id) / UPLOAD_MANIFEST
+    with open(manifest_file, "w") as f:
+        json.dump(manifest, f)
+
+def load_upload_manifest(session_id: str):
+    """Returns a session's upload manifest, or None for sessions without one."""
+    manifest_file = LOCAL_STORAGE_PATH / session_id / UPLOAD_MANIFEST
+    try:
+        with open(manifest_file, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def get_dataset_dir(session_id: str) -> Path:
+    """
+    Returns the directory holding the files derived from a session's dataset
+    (encoding, profile): its blob directory, shared with every session that
+    uploaded the same content, or the session directory for older sessions.
+    Not created here, so reading a deleted session's files doesn't bring
+    its directories back.
+    """
+    manifest = load_upload_manifest(session_id)
+    if manifest and manifest.get("sha256"):
+        return get_blob_dir(manifest["sha256"])
+    return LOCAL_STORAGE_PATH / session_id
+
+def find_columnar_copy(csv_path: str):
+    """
+    Returns the columnar copy of a CSV file if one exists and is at least as
+    recent as the CSV itself, otherwise None.
+    """
+    csv_path = Path(csv_path)
+    if csv_path.suffix in COLUMNAR_SUFFIXES:
+        return str(csv_path)
+    for suffix in COLUMNAR_SUFFIXES:
+        copy_path = csv_path.with_suffix(suffix)
+        if not copy_path.exists():
+            continue
+        if not csv_path.exists() or copy_path.stat().st_mtime_ns >= csv_path.stat().st_mtime_ns:
+            return str(copy_path)
+    return None
 
 def get_session_file(session_id: str):
-    """Gets the path of the CSV file in a session directory."""
+    """
+    Gets the path of the data file in a session directory, preferring the
+    columnar copy of the CSV when one is available.
+    """
     session_dir = LOCAL_STORAGE_PATH / session_id
     if not session_dir.exists():
         return None
-    
-    # Find the first CSV file in the directory
-    csv_files = list(session_dir.glob("*.csv"))
-    if csv_files:
-        return str(csv_files[0])
-    return None
 
-def save_output_image(session_id: str, source_path: str, timestamp: str):
-    """Saves a generated image to the session directory with a timestamp."""
-    session_dir = get_session_dir(session_id)
-    destination_path = session_dir / f"output_{timestamp}.png"
-    shutil.copy(source_path, destination_path)
-    return str(destination_path)
+    with timed("storage_lookup"):
+        manifest = load_upload_manifest(session_id)
+        if manifest and manifest.get("sha256"):
+            csv_path = get_blob_dir(manifest["sha256"]) / BLOB_FILE_NAME
+            if not csv_path.exists():
+                return None
+            return find_columnar_copy(csv_path) or str(csv_path)
 
-def get_image_path(session_id: str, timestamp: str):
-    """Gets the path of a generated image from a session directory."""
+        # Sessions from before the blob store keep the CSV in their own directory
+        csv_files = list(session_dir.glob("*.csv"))
+        if csv_files:
+            return find_columnar_copy(csv_files[0]) or str(csv_files[0])
+        return None
+
+def image_file_name(timestamp: str, variant: str = "original") -> str:
+    return f"output_{timestamp}{IMAGE_FILES[variant][0]}"
+
+def image_media_type(path: str) -> str:
+    return next(media_type for suffix, media_type in IMAGE_FILES.values() if str(path).endswith(suffix))
+
+def save_output_image(image_path: str) -> list[str]:
+    """
+    Writes the IMAGE_VARIANTS of a generated PNG next to it, so they are
+    encoded once instead of on every request. Returns the paths written.
+    """
+    if not IMAGE_VARIANTS or Image is None:
+        return []
+    stem = str(image_path)[:-len(IMAGE_FILES["original"][0])]
+    paths = []
+    try:
+        with Image.open(image_path) as image:
+            if "webp" in IMAGE_VARIANTS:
+                path = stem + IMAGE_FILES["webp"][0]
+                image.save(path, "WEBP", quality=IMAGE_WEBP_QUALITY, method=4)
+                paths.append(path)
+            if "thumbnail" in IMAGE_VARIANTS:
+                path = stem + IMAGE_FILES["thumbnail"][0]
+                thumbnail = image.copy()
+                thumbnail.thumbnail((IMAGE_THUMBNAIL_PX, IMAGE_THUMBNAIL_PX))
+                thumbnail.save(path, "PNG", optimize=True)
+                paths.append(path)
+    except OSError as e:
+        print(f"Failed to write image variants of {image_path}: {e}")
+    return paths
+
+def get_image_path(session_id: str, timestamp: str, variant: str = "original"):
+    """Gets the path of a generated image, or of one of its variants, from a session directory."""
     session_dir = LOCAL_STORAGE_PATH / session_id
     # The key is just the timestamp, so we construct the filename
-    image_path = session_dir / f"output_{timestamp}.png"
+    image_path = session_dir / image_file_name(timestamp, variant)
     if image_path.exists():
         return str(image_path)
     return None
 
+def touch_session(session_id: str):
+    """Marks a session as used now; the reaper deletes the least recently used ones."""
+    try:
+        os.utime(LOCAL_STORAGE_PATH / session_id)
+    except OSError:
+        pass
+
+def _make_writable(func, path, exc_info):
+    """rmtree error handler for read-only files, which Windows refuses to delete."""
+    os.chmod(path, 0o777)
+    func(path)
+
 def clear_local_session(session_id: str):
     """
-    Deletes a session directory and its contents completely.
-    Returns True if the session was found and deleted, False otherwise.
+    Deletes a session directory and its contents completely, and releases
+    the session's reference to its dataset blob.
+    Returns True if nothing of the session directory is left.
     """
     session_dir = LOCAL_STORAGE_PATH / session_id
-    print(f"\nAttempting to delete session directory: {session_dir}")
-    
-    if not session_dir.exists():
-        print("Directory doesn't exist - already clean")
-        return True
-
-    def log_dir_state():
-        """Log the current state of the directory"""
-        try:
-            if session_dir.exists():
-                print(f"Directory exists: {session_dir}")
-                items = list(session_dir.glob('*'))
-                print(f"Contents: {[item.name for item in items]}")
-                print(f"Is directory empty: {len(items) == 0}")
-                if os.name == 'nt':  # Windows
-                    import stat
-                    attrs = os.stat(session_dir).st_file_attributes
-                    print(f"Directory attributes: {attrs}")
-            else:
-                print("Directory no longer exists")
-        except Exception as e:
-            print(f"Error checking directory state: {e}")
-
-    log_dir_state()
-    print("\nAttempting cleanup...")
-
+    manifest = load_upload_manifest(session_id)
+    if manifest and manifest.get("sha256"):
+        release_blob_ref(session_id, manifest["sha256"])
     try:
-        # 1. Release any handles and reset attributes (Windows)
-        if os.name == 'nt':
-            try:
-                import win32con
-                import win32file
-                attrs = win32file.GetFileAttributes(str(session_dir))
-                win32file.SetFileAttributes(str(session_dir), win32con.FILE_ATTRIBUTE_NORMAL)
-                print("Reset Windows file attributes")
-            except Exception as e:
-                print(f"Warning: Could not reset Windows attributes: {e}")
-
-        # 2. Force close any open handles (Windows)
-        if os.name == 'nt':
-            try:
-                os.system(f'handle -c "{session_dir}"')  # Requires sysinternals handle.exe
-            except Exception:
-                pass
-
-        # 3. Recursive permission reset and cleanup
-        for root, dirs, files in os.walk(str(session_dir), topdown=False):
-            for name in files:
-                try:
-                    path = Path(root) / name
-                    print(f"Processing file: {path}")
-                    # Reset attributes and permissions
-                    if os.name == 'nt':
-                        os.system(f'attrib -r -h -s "{path}"')
-                    os.chmod(str(path), 0o666)
-                    path.unlink()
-                    print(f"Deleted file: {path}")
-                except Exception as e:
-                    print(f"Warning: Could not delete file {name}: {e}")
-                    
-            for name in dirs:
-                try:
-                    path = Path(root) / name
-                    print(f"Processing directory: {path}")
-                    if os.name == 'nt':
-                        os.system(f'attrib -r -h -s "{path}"')
-                    os.chmod(str(path), 0o777)
-                    path.rmdir()
-                    print(f"Deleted directory: {path}")
-                except Exception as e:
-                    print(f"Warning: Could not delete directory {name}: {e}")
-
-        # 4. Final directory removal attempts
-        print("\nAttempting to remove main directory...")
-        deletion_methods = [
-            lambda: session_dir.rmdir(),
-            lambda: shutil.rmtree(str(session_dir), ignore_errors=True),
-            lambda: os.rmdir(str(session_dir)),
-            # Windows-specific aggressive cleanup
-            lambda: os.system(f'rmdir /s /q "{session_dir}"') if os.name == 'nt' else None,
-            lambda: os.system(f'del /f /s /q "{session_dir}\\*" && rmdir /s /q "{session_dir}"') if os.name == 'nt' else None,
-            # Unix-specific cleanup
-            lambda: os.system(f'rm -rf "{session_dir}"') if os.name != 'nt' else None
-        ]
-
-        for method in deletion_methods:
-            if method is None:
-                continue
-            try:
-                method()
-                if not session_dir.exists():
-                    print("Directory successfully deleted!")
-                    return True
-            except Exception as e:
-                print(f"Deletion method failed: {e}")
-
-        # 5. Final check
-        log_dir_state()
-        if not session_dir.exists():
-            print("Directory successfully removed")
-            return True
-        else:
-            print("WARNING: Directory still exists after all deletion attempts")
-            return False
-
-    except Exception as e:
-        print(f"Error during session cleanup: {e}")
-        log_dir_state()
-        return False
-
+        shutil.rmtree(session_dir, onerror=_make_writable)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print(f"Error deleting session directory {session_dir}: {e}")
+    return not session_dir.exists()
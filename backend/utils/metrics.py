@@ -0,0 +1,150 @@
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows, peak RSS is not reported
+    resource = None
+
+METRIC_PREFIX = "dataquery_"
+# Upper bounds (seconds) of the stage latency histogram buckets
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# name -> (type, help)
+_METRICS = {
+    "stage_duration_seconds": ("histogram", "Time spent in each stage of request handling."),
+    "bytes_total": ("counter", "Bytes read, written or transferred, by stage."),
+    "rows_total": ("counter", "Dataset rows loaded or returned, by stage."),
+    "llm_tokens_total": ("counter", "LLM tokens, by kind (prompt or completion)."),
+    "llm_calls_total": ("counter", "LLM calls, by outcome."),
+    "cache_requests_total": ("counter", "Cache lookups, by cache and result (hit or miss)."),
+    "sessions_reaped_total": ("counter", "Sessions deleted by the reaper, by reason (ttl or quota)."),
+    "sandbox_peak_rss_bytes": ("gauge", "Largest peak resident set size reported by a sandbox worker."),
+    "process_peak_rss_bytes": ("gauge", "Peak resident set size of the API process."),
+}
+
+_lock = threading.Lock()
+# (name, sorted label items) -> value; histograms keep [bucket counts, sum, count]
+_values: dict = {}
+# Timings of the request being handled, when it asked for them
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+
+def _key(name: str, labels: dict) -> tuple:
+    return name, tuple(sorted(labels.items()))
+
+def inc(name: str, value: float = 1, **labels):
+    """Adds value to a counter."""
+    key = _key(name, labels)
+    with _lock:
+        _values[key] = _values.get(key, 0) + value
+
+def set_max(name: str, value: float, **labels):
+    """Raises a gauge to value if it is higher."""
+    key = _key(name, labels)
+    with _lock:
+        _values[key] = max(_values.get(key, 0), value)
+
+def observe_stage(stage: str, seconds: float):
+    """Records the duration of one run of a stage."""
+    key = _key("stage_duration_seconds", {"stage": stage})
+    with _lock:
+        buckets, total, count = _values.get(key) or ([0] * len(STAGE_BUCKETS), 0.0, 0)
+        for i, bound in enumerate(STAGE_BUCKETS):
+            if seconds <= bound:
+                buckets[i] += 1
+        _values[key] = (buckets, total + seconds, count + 1)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[stage] = round(timings.get(stage, 0) + seconds, 6)
+
+@contextmanager
+def timed(stage: str):
+    """Times the enclosed block as one run of a stage."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start)
+
+def record_cache(cache: str, hit: bool):
+    inc("cache_requests_total", cache=cache, result="hit" if hit else "miss")
+
+def record_io(stage: str, nbytes: int = 0, rows: int = 0):
+    """Counts the bytes and rows a stage handled."""
+    if nbytes:
+        inc("bytes_total", nbytes, stage=stage)
+    if rows:
+        inc("rows_total", rows, stage=stage)
+
+def start_request_timings() -> dict:
+    """
+    Collects the stage timings of the current request (and of the pool tasks
+    it starts) into the returned dict.
+    """
+    timings = {}
+    _request_timings.set(timings)
+    return timings
+
+def peak_rss_bytes() -> int | None:
+    """Peak resident set size of this process."""
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+def _format_value(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def render(extra: dict | None = None) -> str:
+    """
+    Renders every metric in the Prometheus text exposition format. extra
+    maps further metric names to (type, help, {labels tuple: value}), for
+    values kept by other modules (pool queues, cache sizes, prompt sizes).
+    """
+    with _lock:
+        values = {
+            key: (list(value[0]), value[1], value[2]) if isinstance(value, tuple) else value
+            for key, value in _values.items()
+        }
+    rss = peak_rss_bytes()
+    if rss is not None:
+        values[("process_peak_rss_bytes", ())] = rss
+
+    lines = []
+    described = set()
+
+    def describe(name, kind, help_text):
+        if name not in described:
+            described.add(name)
+            lines.append(f"# HELP {METRIC_PREFIX}{name} {help_text}")
+            lines.append(f"# TYPE {METRIC_PREFIX}{name} {kind}")
+
+    for (name, labels), value in sorted(values.items()):
+        kind, help_text = _METRICS[name]
+        describe(name, kind, help_text)
+        metric = METRIC_PREFIX + name
+        if kind == "histogram":
+            buckets, total, count = value
+            for bound, bucket_count in zip(STAGE_BUCKETS, buckets):
+                lines.append(f"{metric}_bucket{_format_labels(labels + (('le', bound),))} {bucket_count}")
+            lines.append(f"{metric}_bucket{_format_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{metric}_sum{_format_labels(labels)} {total!r}")
+            lines.append(f"{metric}_count{_format_labels(labels)} {count}")
+        else:
+            lines.append(f"{metric}{_format_labels(labels)} {_format_value(value)}")
+
+    for name, (kind, help_text, series) in (extra or {}).items():
+        describe(name, kind, help_text)
+        for labels, value in series.items():
+            lines.append(f"{METRIC_PREFIX}{name}{_format_labels(labels)} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
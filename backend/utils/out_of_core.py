@@ -0,0 +1,78 @@
+import os
+import pandas as pd
+from utils.dataloader import iter_chunks, plan_dtypes, CHUNK_ROWS, ARROW_STRINGS
+from utils.sql_engine import query_dataset
+
+# Datasets taking more memory than this as a DataFrame (as profiled at
+# upload) are analyzed chunk by chunk; 0 always loads the whole DataFrame
+OUT_OF_CORE_MB = int(os.getenv("OUT_OF_CORE_MB", "1024"))
+
+EXECUTION_FRAME = "frame"
+EXECUTION_CHUNKED = "chunked"
+
+def execution_mode(metadata: dict | None, file_path: str | None = None) -> str:
+    """
+    Picks how generated code sees a dataset: as one DataFrame `df`, or as a
+    ChunkedDataset `dataset` when its in-memory size exceeds OUT_OF_CORE_MB.
+    Profiles from before the size was recorded fall back to the file size.
+    """
+    size = (metadata or {}).get("memory_bytes")
+    if size is None and file_path and os.path.exists(file_path):
+        size = os.path.getsize(file_path)
+    if OUT_OF_CORE_MB and size and size > OUT_OF_CORE_MB * 1024 * 1024:
+        return EXECUTION_CHUNKED
+    return EXECUTION_FRAME
+
+def chunk_dtypes(metadata: dict) -> dict:
+    """
+    Lean dtypes for reading a dataset in chunks. Categories would differ from
+    chunk to chunk, so low-cardinality text is read like other text.
+    """
+    dtypes = {}
+    for name, dtype in plan_dtypes(metadata).items():
+        if dtype == "category":
+            if not ARROW_STRINGS:
+                continue
+            dtype = "string"
+        dtypes[name] = dtype
+    return dtypes
+
+class ChunkedDataset:
+    """
+    The `dataset` object of generated code for datasets too large to load.
+    Nothing is held in memory: each call to chunks() streams the file again,
+    reading only the requested columns. sql() hands filters and aggregates
+    to DuckDB instead, which scans the columnar copy lazily and spills to
+    disk, so generated code need not combine partial results itself.
+    """
+
+    def __init__(self, file_path: str, session_id: str | None = None, columns: list | None = None,
+                 num_rows: int | None = None, dtypes: dict | None = None, chunksize: int = CHUNK_ROWS):
+        self.file_path = file_path
+        self.session_id = session_id
+        self.columns = list(columns or [])
+        self.num_rows = num_rows
+        self.chunksize = chunksize
+        self._dtypes = dtypes
+
+    def chunks(self, columns: list | None = None):
+        """Yields the dataset as DataFrames of at most `chunksize` rows."""
+        if isinstance(columns, str):
+            columns = [columns]
+        yield from iter_chunks(self.file_path, self.session_id, self.chunksize, columns, self._dtypes)
+
+    def sql(self, query: str) -> pd.DataFrame:
+        """Runs a DuckDB SELECT over the dataset, as table df, and returns its result."""
+        return query_dataset(query, self.file_path, self.session_id)
+
+    def head(self, n: int = 5) -> pd.DataFrame:
+        """Returns the first n rows."""
+        for chunk in self.chunks():
+            return chunk.head(n)
+        return pd.DataFrame(columns=self.columns)
+
+    def __iter__(self):
+        return self.chunks()
+
+    def __repr__(self):
+        return f"ChunkedDataset(rows={self.num_rows}, columns={self.columns}, chunksize={self.chunksize})"
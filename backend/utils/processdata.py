@@ -1,29 +1,182 @@
+import os
+import json
+import math
+from pathlib import Path
+import numpy as np
 import pandas as pd
+from utils.dataloader import iter_chunks
+from utils.local_storage import get_dataset_dir
 
-def extract_csv_metadata_and_sample(file_path):
-    """
-    Reads a CSV file and extracts its metadata and a sample of 5 rows.
+PROFILE_FILE = "profile.json"
+SAMPLE_SIZE = 5
+# Number of smallest hashes kept per column for the distinct count estimate
+DISTINCT_SKETCH_SIZE = 1024
 
-    Args:
-        file_path (str): Path to the CSV file.
+def to_json_value(value):
+    """Converts numpy scalars and missing values into JSON friendly values."""
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    if value is pd.NaT or value is pd.NA:
+        return None
+    if isinstance(value, (pd.Timestamp, pd.Timedelta)):
+        return str(value)
+    return value
 
-    Returns:
-        dict: A dictionary containing metadata and a sample of 5 rows.
+def _merge_dtypes(dtypes: set) -> str:
+    """Resolves the dtype of a column that was inferred separately per chunk."""
+    if len(dtypes) == 1:
+        return next(iter(dtypes))
+    if all(dtype.startswith(("int", "float")) for dtype in dtypes):
+        return "float64"
+    return "object"
+
+class _ColumnProfile:
+    """Running statistics for one column, updated chunk by chunk."""
+
+    def __init__(self):
+        self.dtypes = set()
+        self.missing = 0
+        self.numeric = True
+        self.min = None
+        self.max = None
+        self.hashes = np.array([], dtype=np.uint64)
+
+    def update(self, series: pd.Series):
+        self.dtypes.add(str(series.dtype))
+        self.missing += int(series.isna().sum())
+        values = series.dropna()
+        if values.empty:
+            return
+
+        if self.numeric and pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+            chunk_min, chunk_max = values.min(), values.max()
+            self.min = chunk_min if self.min is None else min(self.min, chunk_min)
+            self.max = chunk_max if self.max is None else max(self.max, chunk_max)
+        else:
+            self.numeric = False
+            self.min = self.max = None
+
+        # K-minimum-values sketch: keep the smallest distinct hashes seen so far
+        hashes = pd.util.hash_pandas_object(values, index=False).to_numpy()
+        self.hashes = np.union1d(self.hashes, hashes)[:DISTINCT_SKETCH_SIZE]
+
+    def approx_distinct(self) -> int:
+        if len(self.hashes) < DISTINCT_SKETCH_SIZE:
+            return len(self.hashes)
+        kth_hash = float(self.hashes[-1]) / float(2 ** 64)
+        return int((DISTINCT_SKETCH_SIZE - 1) / kth_hash)
+
+class DatasetProfiler:
     """
-    try:
-        df = pd.read_csv(file_path)
+    Builds a dataset profile from a stream of DataFrame chunks with flat
+    memory use: dtypes, null counts, row count, in-memory size, numeric min/max,
+    approximate distinct counts and a uniform reservoir sample of rows.
+    """
+
+    def __init__(self):
+        self._rng = np.random.default_rng()
+        self._columns = {}
+        self._num_rows = 0
+        # Size of the data as pandas DataFrames with default dtypes
+        self._memory_bytes = 0
+        # Reservoir of (row number, record) pairs
+        self._reservoir = []
+
+    def update(self, chunk: pd.DataFrame):
+        for name in chunk.columns:
+            self._columns.setdefault(name, _ColumnProfile()).update(chunk[name])
+
+        # Algorithm R, vectorised: row i replaces a random slot with probability k/(i+1)
+        positions = np.arange(self._num_rows, self._num_rows + len(chunk))
+        slots = self._rng.integers(0, positions + 1)
+        for offset in np.flatnonzero((slots < SAMPLE_SIZE) | (positions < SAMPLE_SIZE)):
+            record = chunk.iloc[offset].to_dict()
+            if positions[offset] < SAMPLE_SIZE:
+                self._reservoir.append((int(positions[offset]), record))
+            else:
+                self._reservoir[slots[offset]] = (int(positions[offset]), record)
+        self._num_rows += len(chunk)
+        self._memory_bytes += int(chunk.memory_usage(deep=True, index=False).sum())
+
+    def result(self) -> dict:
+        columns = self._columns
         metadata = {
-            "columns": list(df.columns),
-            "num_rows": len(df),
-            "num_columns": len(df.columns),
-            "dtypes": df.dtypes.apply(lambda x: str(x)).to_dict(),
-            "missing_values": df.isnull().sum().to_dict()
+            "columns": list(columns),
+            "num_rows": self._num_rows,
+            "num_columns": len(columns),
+            "memory_bytes": self._memory_bytes,
+            "dtypes": {name: _merge_dtypes(col.dtypes) for name, col in columns.items()},
+            "missing_values": {name: col.missing for name, col in columns.items()},
+            "column_stats": {
+                name: {
+                    "min": to_json_value(col.min),
+                    "max": to_json_value(col.max),
+                    "approx_distinct": col.approx_distinct(),
+                }
+                for name, col in columns.items()
+            },
         }
-        sample = df.head(5).to_dict(orient="records")
+        sample = [
+            {key: to_json_value(value) for key, value in record.items()}
+            for _, record in sorted(self._reservoir, key=lambda item: item[0])
+        ]
         return {
             "metadata": metadata,
             "sample_rows": sample
         }
+
+def profile_dataset(file_path, session_id=None):
+    """
+    Streams a dataset in chunks and builds its profile.
+
+    Args:
+        file_path (str): Path to the CSV file or its columnar copy.
+        session_id (str, optional): Session owning the file.
+
+    Returns:
+        dict: A dictionary containing metadata and a sample of 5 rows.
+    """
+    profiler = DatasetProfiler()
+    for chunk in iter_chunks(file_path, session_id):
+        profiler.update(chunk)
+    return profiler.result()
+
+def save_profile(session_id, file_path, profile):
+    """Stores the profile of a session's dataset in its session directory."""
+    profile_file = get_dataset_dir(session_id) / PROFILE_FILE
+    profile_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = profile_file.with_suffix(".tmp")
+    with open(tmp_file, "w") as f:
+        json.dump({"dataset": Path(file_path).stem, "profile": profile}, f, default=str)
+    os.replace(tmp_file, profile_file)
+
+def extract_csv_metadata_and_sample(file_path, session_id=None):
+    """
+    Returns the metadata and a sample of 5 rows of a dataset. The profile is
+    computed once per upload and stored in the session directory.
+
+    Args:
+        file_path (str): Path to the CSV file.
+        session_id (str, optional): Session owning the file, used to store the profile.
+
+    Returns:
+        dict: A dictionary containing metadata and a sample of 5 rows.
+    """
+    profile_file = get_dataset_dir(session_id) / PROFILE_FILE if session_id else None
+    try:
+        if profile_file and profile_file.exists():
+            with open(profile_file, "r") as f:
+                stored = json.load(f)
+            if stored.get("dataset") == Path(file_path).stem:
+                return stored["profile"]
+
+        profile = profile_dataset(file_path, session_id)
+
+        if session_id:
+            save_profile(session_id, file_path, profile)
+        return profile
     except Exception as e:
         return {
             "error": str(e)
@@ -0,0 +1,204 @@
+import os
+import re
+import math
+import threading
+from langchain_core.messages import trim_messages
+
+# Token budgets of the dataset description and of the conversation history
+# placed in the prompt
+CSV_INFO_TOKEN_BUDGET = int(os.getenv("CSV_INFO_TOKEN_BUDGET", "1500"))
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "1500"))
+# Token budget of the column names listed in the artifacts description
+ARTIFACTS_TOKEN_BUDGET = int(os.getenv("ARTIFACTS_TOKEN_BUDGET", "300"))
+# Longer sample cell values are cut to this many characters
+MAX_CELL_CHARS = int(os.getenv("PROMPT_MAX_CELL_CHARS", "40"))
+# Columns shown in the sample rows besides the ones the query mentions
+DEFAULT_SAMPLE_COLUMNS = 8
+# Share of the dataset budget kept for the sample rows
+SAMPLE_BUDGET_SHARE = 0.25
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about 4 characters per token for English and code)."""
+    return math.ceil(len(text) / 4)
+
+# Swap in an exact tokenizer with set_token_counter()
+_count_tokens = estimate_tokens
+
+def set_token_counter(counter):
+    """Sets the function mapping a string to its number of tokens."""
+    global _count_tokens
+    _count_tokens = counter
+
+def count_tokens(text: str) -> int:
+    return _count_tokens(text)
+
+def _words(text: str) -> set[str]:
+    # Splits snake_case, camelCase and punctuation into lowercase words
+    text = re.sub(r"([a-z0-9])([A-Z])", r"\1 \2", str(text))
+    return {word for word in re.split(r"[^0-9a-zA-Z]+", text.lower()) if word}
+
+def rank_columns(columns: list, user_query: str) -> tuple[list, set]:
+    """
+    Orders columns by how much of their name appears in the query, keeping
+    the dataset order among equally relevant columns.
+
+    Returns:
+        tuple: (the ordered columns, the columns the query mentions)
+    """
+    query_words = _words(user_query)
+    query_text = " ".join(str(user_query).lower().split())
+
+    def score(column):
+        name = " ".join(str(column).lower().split())
+        if name and name in query_text:
+            return 2.0
+        words = _words(column)
+        return len(words & query_words) / len(words) if words else 0.0
+
+    scores = {column: score(column) for column in columns}
+    return sorted(columns, key=lambda column: -scores[column]), {c for c, s in scores.items() if s > 0}
+
+def format_column_list(columns: list, user_query: str, budget: int) -> str:
+    """
+    Lists column names within a token budget, the columns the query mentions
+    first. Names that don't fit are counted as "(+N more)".
+    """
+    if not columns:
+        return "none"
+    ranked, _ = rank_columns(columns, user_query)
+    listed = []
+    used = count_tokens(f"(+{len(ranked)} more)")
+    for name in ranked:
+        cost = count_tokens(f"{name}, ")
+        if used + cost > budget:
+            break
+        listed.append(str(name))
+        used += cost
+    text = ", ".join(listed)
+    if len(listed) < len(ranked):
+        text += f"{', ' if listed else ''}(+{len(ranked) - len(listed)} more)"
+    return text
+
+def _truncate(value) -> str:
+    if isinstance(value, float):
+        return f"{value:.6g}"
+    text = "" if value is None else str(value).replace("\n", " ")
+    return text if len(text) <= MAX_CELL_CHARS else text[:MAX_CELL_CHARS - 3] + "..."
+
+def _describe_column(name, metadata: dict) -> str:
+    parts = [str(metadata.get("dtypes", {}).get(name, "?"))]
+    missing = metadata.get("missing_values", {}).get(name)
+    if missing:
+        parts.append(f"{missing} missing")
+    stats = metadata.get("column_stats", {}).get(name, {})
+    if stats.get("min") is not None:
+        parts.append(f"range {_truncate(stats['min'])}..{_truncate(stats['max'])}")
+    if stats.get("approx_distinct") is not None:
+        parts.append(f"~{stats['approx_distinct']} distinct")
+    return f"- {name}: {', '.join(parts)}"
+
+def format_csv_info(csv_info, user_query: str, budget: int = CSV_INFO_TOKEN_BUDGET) -> str:
+    """
+    Renders the dataset profile for the prompt within a token budget: one
+    compact line per column, the columns the query mentions first, then the
+    sample rows restricted to those columns with long values truncated.
+    Columns that don't fit are listed by name as far as the budget allows.
+    """
+    metadata = csv_info.get("metadata") if isinstance(csv_info, dict) else None
+    if not metadata:
+        return str(csv_info)
+
+    columns = metadata.get("columns", [])
+    ranked, relevant = rank_columns(columns, user_query)
+    lines = [f"Rows: {metadata.get('num_rows')}, columns: {metadata.get('num_columns', len(columns))}", "Columns:"]
+    used = count_tokens("\n".join(lines))
+    schema_budget = budget - int(budget * SAMPLE_BUDGET_SHARE)
+    descriptions = [_describe_column(name, metadata) for name in ranked]
+    costs = [count_tokens(line) + 1 for line in descriptions]
+    # When not every column fits, part of the budget goes to listing the rest by name
+    describe_budget = schema_budget if used + sum(costs) <= schema_budget else used + (schema_budget - used) * 2 // 3
+
+    described = 0
+    for line, cost in zip(descriptions, costs):
+        if used + cost > describe_budget:
+            break
+        lines.append(line)
+        used += cost
+        described += 1
+
+    rest = ranked[described:]
+    if rest:
+        listed = []
+        listed_cost = count_tokens(f"Other columns: (+{len(rest)} more)")
+        for name in rest:
+            cost = count_tokens(f"{name}, ")
+            if used + listed_cost + cost > schema_budget:
+                break
+            listed.append(str(name))
+            listed_cost += cost
+        line = "Other columns: " + ", ".join(listed)
+        if len(listed) < len(rest):
+            line += f"{', ' if listed else ''}(+{len(rest) - len(listed)} more)"
+        lines.append(line)
+        used += count_tokens(line) + 1
+
+    sample_rows = csv_info.get("sample_rows") or []
+    # Sample the columns the query is about, topped up to a few columns
+    mentioned = sum(1 for name in ranked[:described] if name in relevant)
+    sample_columns = ranked[:min(described, max(mentioned, DEFAULT_SAMPLE_COLUMNS))]
+    if sample_rows and sample_columns:
+        header = "Sample rows (" + ", ".join(str(name) for name in sample_columns) + "):"
+        if used + count_tokens(header) < budget:
+            lines.append(header)
+            used += count_tokens(header) + 1
+            for row in sample_rows:
+                line = " | ".join(_truncate(row.get(name)) for name in sample_columns)
+                cost = count_tokens(line) + 1
+                if used + cost > budget:
+                    break
+                lines.append(line)
+                used += cost
+    return "\n".join(lines)
+
+def _message_tokens(messages) -> int:
+    return sum(count_tokens(str(message.content)) for message in messages)
+
+def trim_history(messages: list, budget: int = HISTORY_TOKEN_BUDGET) -> list:
+    """Keeps the most recent exchanges of the history that fit the token budget."""
+    return trim_messages(
+        messages,
+        max_tokens=budget,
+        token_counter=_message_tokens,
+        strategy="last",
+        start_on="human",
+    )
+
+_stats_lock = threading.Lock()
+_stats = {
+    "prompts": 0,
+    "prompt_tokens_total": 0,
+    "prompt_tokens_max": 0,
+    "csv_info_tokens_total": 0,
+    "history_tokens_total": 0,
+}
+
+def record_prompt(prompt_value, csv_info_text: str, history: list):
+    """Adds a built prompt to the token metrics."""
+    prompt_tokens = sum(count_tokens(str(message.content)) for message in prompt_value.to_messages())
+    with _stats_lock:
+        _stats["prompts"] += 1
+        _stats["prompt_tokens_total"] += prompt_tokens
+        _stats["prompt_tokens_max"] = max(_stats["prompt_tokens_max"], prompt_tokens)
+        _stats["csv_info_tokens_total"] += count_tokens(csv_info_text)
+        _stats["history_tokens_total"] += _message_tokens(history)
+    return prompt_value
+
+def prompt_stats() -> dict:
+    """Returns the number of prompts built and their estimated token counts."""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["prompt_tokens_avg"] = stats["prompt_tokens_total"] / stats["prompts"] if stats["prompts"] else 0
+    stats["csv_info_token_budget"] = CSV_INFO_TOKEN_BUDGET
+    stats["history_token_budget"] = HISTORY_TOKEN_BUDGET
+    stats["artifacts_token_budget"] = ARTIFACTS_TOKEN_BUDGET
+    return stats
@@ -1,81 +1,63 @@
-import sys
-import io
 import os
-import pandas as pd
-import chardet
+import pyarrow as pa
 from utils.llmhandler import generate_code_from_query
+from utils.dataframe_cache import get_dataframe, file_fingerprint
+from utils.local_storage import find_columnar_copy
+from utils.artifacts import load_dtype_plan
+from utils.processdata import extract_csv_metadata_and_sample
+from utils.out_of_core import execution_mode, chunk_dtypes, EXECUTION_CHUNKED
+from utils.sandbox import get_sandbox_pool, share_dataframe
+from utils.metrics import timed, set_max
 
-def try_read_csv(file_path: str, encoding: str) -> tuple[pd.DataFrame | None, Exception | None]:
-    """Try to read CSV with a specific encoding, return (dataframe, error)."""
-    try:
-        df = pd.read_csv(file_path, encoding=encoding)
-        return df, None
-    except Exception as e:
-        return None, e
-
-def detect_encoding(file_path: str) -> str:
-    """
-    Detect the encoding of a file using a priority list of common encodings
-    and falling back to chardet only if needed.
+def run_generated_code(code: str, csv_path: str, session_id: str | None = None, output_dir: str = ".", image_name: str = "output", artifacts_dir: str | None = None,
+                       on_output=None, cancelled=None):
     """
-    # Try common encodings first in order of likelihood
-    common_encodings = ['utf-8', 'latin1', 'cp1252', 'ISO-8859-1']
-    
-    for encoding in common_encodings:
-        df, error = try_read_csv(file_path, encoding)
-        if df is not None:
-            return encoding
-    
-    # If common encodings fail, try chardet but validate its suggestion
-    with open(file_path, 'rb') as file:
-        raw_data = file.read()
-        result = chardet.detect(raw_data)
-        detected = result.get('encoding')
-        
-        if detected and detected.lower() not in ['johab']:  # Skip problematic encodings
-            df, error = try_read_csv(file_path, detected)
-            if df is not None:
-                return detected
-    
-    # If all else fails, use latin1 (it can read any byte sequence)
-    return 'latin1'
-
-def run_generated_code(code: str, csv_path: str):
-    """
-    Executes the generated Python code with a DataFrame 'df' loaded from csv_path.
+    Executes the generated Python code with a DataFrame 'df' loaded from csv_path,
+    and 'artifacts', the dataset's precomputed artifacts from artifacts_dir (None without).
+    Datasets too large for memory are given as 'dataset', a ChunkedDataset, instead of 'df'.
+    The code runs in a sandbox worker process with CPU, wall-clock and memory limits.
     Captures and returns stdout and stderr output.
-    Also returns flags indicating if an image was generated, if stdout was produced, or both.
+    Also returns flags indicating if an image was generated, if stdout was produced, or both,
+    and the paths of all generated images, saved into output_dir as <image_name>.png,
+    <image_name>_1.png, ...
+    on_output and cancelled stream stdout and cancel the run, see SandboxPool.run.
     """
-    # Try to load the CSV with the best encoding
-    encoding = detect_encoding(csv_path)
-    df, error = try_read_csv(csv_path, encoding)
-    
-    if error:
-        raise RuntimeError(f"Failed to read CSV with encoding {encoding}: {error}")
+    with timed("prepare_frame"):
+        metadata = extract_csv_metadata_and_sample(csv_path, session_id).get("metadata")
+        # Lean dtypes picked from the dataset profile when it was uploaded
+        dtypes = load_dtype_plan(session_id) if session_id else None
+        columnar_path = find_columnar_copy(csv_path)
+        if execution_mode(metadata, csv_path) == EXECUTION_CHUNKED:
+            # Workers stream the file themselves, nothing is loaded here
+            frame = {"chunked": {
+                "file_path": str(csv_path), "session_id": session_id, "columns": metadata.get("columns"),
+                "num_rows": metadata.get("num_rows"), "dtypes": chunk_dtypes(metadata)
+            }}
+        elif columnar_path and columnar_path.endswith(".arrow"):
+            # Workers memory-map the Arrow file, which the OS shares between them
+            frame = {"path": columnar_path, "mtime": os.stat(columnar_path).st_mtime_ns, "dtypes": dtypes}
+        else:
+            # Reuse the dataset's parsed frame and hand it over through shared memory
+            df = get_dataframe(csv_path, session_id, dtypes)
+            try:
+                shared = share_dataframe(str(csv_path), file_fingerprint(csv_path), df)
+            except pa.ArrowException:
+                # Columns Arrow cannot represent (e.g. mixed types) are pickled instead
+                shared = None
+            # So are frames too large for the shared memory cap
+            frame = {**shared, "dtypes": dtypes} if shared else {"df": df}
 
-    # Prepare the execution environment
-    local_vars = {'df': df}
-    stdout = io.StringIO()
-    stderr = io.StringIO()
-    old_stdout = sys.stdout
-    old_stderr = sys.stderr
-    image_path = "output.png"
-    # Remove any existing output.png before running
-    if os.path.exists(image_path):
-        os.remove(image_path)
-    try:
-        sys.stdout = stdout
-        sys.stderr = stderr
-        exec(code, {}, local_vars)
-    except Exception as e:
-        print(f"Error during code execution: {e}")
-    finally:
-        sys.stdout = old_stdout
-        sys.stderr = old_stderr
+    with timed("sandbox_exec"):
+        result = get_sandbox_pool().run(
+            code, frame, os.path.abspath(output_dir), image_name, artifacts_dir, on_output, cancelled
+        )
+    if result.get("peak_rss_bytes"):
+        set_max("sandbox_peak_rss_bytes", result["peak_rss_bytes"])
 
-    output = stdout.getvalue()
-    error = stderr.getvalue()
-    image_generated = os.path.exists(image_path)
+    output = result["stdout"]
+    error = result["stderr"]
+    images = result["images"]
+    image_generated = bool(images)
     stdout_generated = bool(output.strip())
     # Both means both image and stdout are present
     both_generated = image_generated and stdout_generated
@@ -85,7 +67,7 @@ def run_generated_code(code: str, csv_path: str):
         "stdout_generated": stdout_generated,
         "both_generated": both_generated
     }
-    return output, error, flags
+    return output, error, flags, images
 
 def main():
     # Path to your CSV file
@@ -98,7 +80,7 @@ def main():
     print("Generated Python code:\n")
     print(code)
     print("\n--- Running generated code ---\n")
-    output, error, flags = run_generated_code(code, csv_path)
+    output, error, flags, images = run_generated_code(code, csv_path)
     if output:
         print("Output:\n", output)
     if error:
@@ -0,0 +1,37 @@
+import os
+import json
+import hashlib
+from utils.local_storage import LOCAL_STORAGE_PATH, get_session_dir
+
+RESULTS_DIR = "results"
+
+def result_key(code: str, file_path: str, language: str = "python") -> str:
+    """
+    Identifies one execution: the exact generated code and its language plus
+    the version of the dataset it ran against (file name, size and
+    modification time).
+    """
+    stat = os.stat(file_path)
+    fingerprint = f"{os.path.basename(file_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+    return hashlib.sha256(f"{fingerprint}\x1f{language}\x1f{code}".encode("utf-8")).hexdigest()
+
+def load_result(session_id: str, key: str):
+    """Returns the stored result of an execution in a session, or None."""
+    result_file = LOCAL_STORAGE_PATH / session_id / RESULTS_DIR / f"{key}.json"
+    try:
+        with open(result_file, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_result(session_id: str, key: str, result: dict):
+    """
+    Stores the result of an execution (stdout, stderr, flags and the keys of
+    its images) in the session directory.
+    """
+    results_dir = get_session_dir(session_id) / RESULTS_DIR
+    results_dir.mkdir(exist_ok=True)
+    tmp_file = results_dir / f"{key}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(result, f)
+    os.replace(tmp_file, results_dir / f"{key}.json")
@@ -0,0 +1,100 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+from utils.metrics import timed, record_cache, record_io
+
+# Local read-through cache of S3 objects, mirrored as <dir>/<bucket>/<key> so
+# every session's files get their own path
+S3_CACHE_DIR = Path(os.getenv("S3_CACHE_DIR", os.path.join(tempfile.gettempdir(), "dataquery_s3_cache")))
+S3_CACHE_MAX_BYTES = int(os.getenv("S3_CACHE_MAX_MB", "10240")) * 1024 * 1024
+ETAG_SUFFIX = ".etag"
+
+_cache_lock = threading.Lock()
+
+def cache_path(bucket: str, key: str) -> Path:
+    """Returns the local path an object is cached at."""
+    return S3_CACHE_DIR / bucket / key
+
+def _read_etag(path: Path):
+    try:
+        return path.with_name(path.name + ETAG_SUFFIX).read_text()
+    except OSError:
+        return None
+
+def _evict_over_cap(keep: Path):
+    """Deletes the least recently used cached objects until the cache fits its cap."""
+    entries = []
+    total = 0
+    for root, _, files in os.walk(S3_CACHE_DIR):
+        for name in files:
+            if name.endswith(ETAG_SUFFIX) or name.endswith(".part"):
+                continue
+            path = Path(root) / name
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            total += stat.st_size
+            entries.append((stat.st_atime, stat.st_size, path))
+
+    for _, size, path in sorted(entries):
+        if total <= S3_CACHE_MAX_BYTES:
+            break
+        if path == keep:
+            continue
+        path.unlink(missing_ok=True)
+        path.with_name(path.name + ETAG_SUFFIX).unlink(missing_ok=True)
+        total -= size
+
+def fetch(s3, bucket: str, key: str, etag: str | None = None) -> str:
+    """
+    Returns a local path holding the current version of an S3 object,
+    downloading it only if the cached copy is missing or its ETag changed.
+
+    Args:
+        s3: boto3 S3 client.
+        bucket (str): Bucket name.
+        key (str): Object key.
+        etag (str, optional): The object's current ETag, e.g. from a listing.
+            Looked up with head_object when not given.
+
+    Returns:
+        str: Path of the cached file.
+    """
+    if etag is None:
+        etag = s3.head_object(Bucket=bucket, Key=key)["ETag"]
+    path = cache_path(bucket, key)
+
+    if path.exists() and _read_etag(path) == etag:
+        # Mark as recently used without changing the mtime other caches key on
+        stat = path.stat()
+        os.utime(path, ns=(time.time_ns(), stat.st_mtime_ns))
+        record_cache("s3", True)
+        return str(path)
+    record_cache("s3", False)
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Download under a unique name and rename, so concurrent readers never
+    # see a partial file
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=path.name, suffix=".part")
+    os.close(fd)
+    try:
+        with timed("s3_download"):
+            s3.download_file(bucket, key, tmp_path)
+        record_io("s3_download", nbytes=os.path.getsize(tmp_path))
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    path.with_name(path.name + ETAG_SUFFIX).write_text(etag)
+
+    with _cache_lock:
+        _evict_over_cap(keep=path)
+    return str(path)
+
+def evict_prefix(bucket: str, prefix: str):
+    """Removes every cached object under a key prefix, e.g. a whole session."""
+    shutil.rmtree(cache_path(bucket, prefix), ignore_errors=True)
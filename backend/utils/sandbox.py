@@ -0,0 +1,419 @@
+import io
+import os
+import math
+import sys
+import queue
+import shutil
+import tempfile
+import time
+import signal
+import threading
+import multiprocessing
+from collections import OrderedDict
+from multiprocessing import shared_memory
+from pathlib import Path
+import pyarrow as pa
+
+try:
+    import resource
+except ImportError:  # Windows has no rlimits, jobs only get the wall-clock limit
+    resource = None
+
+# Number of prewarmed worker processes executing generated code
+SANDBOX_WORKERS = int(os.getenv("SANDBOX_WORKERS", str(os.cpu_count() or 1)))
+# Per-job limits; a memory limit of 0 disables it
+SANDBOX_CPU_SECONDS = int(os.getenv("SANDBOX_CPU_SECONDS", "60"))
+SANDBOX_WALL_SECONDS = float(os.getenv("SANDBOX_WALL_SECONDS", "120"))
+SANDBOX_MEMORY_MB = int(os.getenv("SANDBOX_MEMORY_MB", "4096"))
+# Upper bound for the session frames kept in shared memory for the workers
+# to attach to; larger frames are pickled to the worker instead
+SANDBOX_SHARED_MAX_BYTES = int(os.getenv("SANDBOX_SHARED_MB", "1024")) * 1024 * 1024
+# How often a job streaming its output sends what it printed so far
+STREAM_INTERVAL_SECONDS = float(os.getenv("SANDBOX_STREAM_INTERVAL", "0.25"))
+
+class CpuLimitExceeded(Exception):
+    """Raised inside a worker when a job uses up its CPU time budget."""
+
+class SandboxCancelled(Exception):
+    """Raised by SandboxPool.run when its job was cancelled; the worker was replaced."""
+
+# --- Worker process side ---
+
+# ids of the figures the current job saved itself
+_saved_figures = set()
+
+def _on_cpu_limit(signum, frame):
+    raise CpuLimitExceeded(f"CPU time limit of {SANDBOX_CPU_SECONDS}s exceeded")
+
+def _attach_table(frame: dict, tables: OrderedDict) -> pa.Table:
+    """
+    Maps the job's dataset without copying it through the pipe: Arrow files
+    are memory-mapped from disk, other frames are read from the shared memory
+    block published by the API process. Recently used tables are kept mapped.
+    """
+    key = frame.get("shm_name") or f"{frame['path']}:{frame['mtime']}"
+    if key in tables:
+        tables.move_to_end(key)
+        return tables[key][0]
+
+    if frame.get("shm_name"):
+        handle = shared_memory.SharedMemory(name=frame["shm_name"])
+        buffer = pa.py_buffer(handle.buf)[:frame["size"]]
+        table = pa.ipc.open_stream(buffer).read_all()
+    else:
+        handle = pa.memory_map(frame["path"], "r")
+        table = pa.ipc.open_file(handle).read_all()
+
+    tables[key] = (table, handle)
+    while len(tables) > 2:
+        _, (_, old_handle) = tables.popitem(last=False)
+        try:
+            old_handle.close()
+        except BufferError:
+            pass  # Still referenced, the mapping goes away with the worker
+    return table
+
+class _StreamingOutput(io.StringIO):
+    """
+    A job's stdout buffer that also sends what was printed to the API process
+    as ("stdout", text) messages, at most every STREAM_INTERVAL_SECONDS.
+    """
+
+    def __init__(self, conn):
+        super().__init__()
+        self._conn = conn
+        self._pending = []
+        self._sent_at = time.monotonic()
+
+    def write(self, text):
+        self._pending.append(text)
+        # Whole lines only, print() writes the text and its newline separately
+        if text.endswith("\n") and time.monotonic() - self._sent_at >= STREAM_INTERVAL_SECONDS:
+            self.flush_pending()
+        return super().write(text)
+
+    def flush_pending(self):
+        if self._pending:
+            self._conn.send(("stdout", "".join(self._pending)))
+            self._pending = []
+        self._sent_at = time.monotonic()
+
+def _track_savefig(savefig):
+    """Wraps Figure.savefig to remember which figures the job saved itself."""
+    def tracked_savefig(fig, fname, *args, **kwargs):
+        # Only saves into the job's scratch directory are picked up as images
+        if isinstance(fname, (str, os.PathLike)) and os.path.abspath(fname).startswith(os.getcwd()):
+            _saved_figures.add(id(fig))
+        return savefig(fig, fname, *args, **kwargs)
+    return tracked_savefig
+
+def _collect_images(scratch_dir: str, output_dir: str, image_name: str) -> list[str]:
+    """
+    Moves every image the job produced into output_dir: files it saved into
+    its scratch directory plus any open figure it never saved. The first image
+    is named <image_name>.png, the following ones <image_name>_<n>.png.
+    """
+    import matplotlib.pyplot as plt
+    for num in plt.get_fignums():
+        fig = plt.figure(num)
+        if id(fig) not in _saved_figures:
+            fig.savefig(os.path.join(scratch_dir, f"figure_{num}.png"))
+
+    files = sorted(Path(scratch_dir).glob("*.png"), key=lambda path: path.stat().st_mtime_ns)
+    images = []
+    for i, path in enumerate(files):
+        name = f"{image_name}.png" if i == 0 else f"{image_name}_{i}.png"
+        target = os.path.join(output_dir, name)
+        shutil.move(str(path), target)
+        images.append(target)
+    return images
+
+def _execute_job(job: dict, tables: OrderedDict, conn=None) -> dict:
+    """
+    Runs one piece of generated code with its own stdout/stderr buffers and
+    its own scratch directory as working directory, so relative plot paths
+    like output.png never collide between jobs. Jobs asking for it stream
+    their stdout over conn while they run.
+    """
+    stdout = _StreamingOutput(conn) if job.get("stream") else io.StringIO()
+    stderr = io.StringIO()
+    old_stdout = sys.stdout
+    old_stderr = sys.stderr
+    old_cwd = os.getcwd()
+    scratch_dir = tempfile.mkdtemp(prefix="sandbox_")
+    images = []
+    _saved_figures.clear()
+    cpu_hard = resource.getrlimit(resource.RLIMIT_CPU)[1] if resource else None
+    try:
+        sys.stdout = stdout
+        sys.stderr = stderr
+        os.chdir(scratch_dir)
+        frame = job["frame"]
+        dataset = None
+        if "df" in frame:
+            df = frame["df"]
+        elif "chunked" in frame:
+            from utils.out_of_core import ChunkedDataset
+            df = None
+            dataset = ChunkedDataset(**frame["chunked"])
+        else:
+            from utils.dataloader import table_to_pandas
+            # to_pandas copies, so each job gets a frame it can freely mutate
+            df = table_to_pandas(_attach_table(frame, tables), frame.get("dtypes"))
+        local_vars = {'df': df, 'dataset': dataset, 'artifacts': None}
+        if job.get("artifacts_dir"):
+            from utils.artifacts import DatasetArtifacts
+            try:
+                local_vars['artifacts'] = DatasetArtifacts(job["artifacts_dir"])
+            except Exception as e:
+                print(f"Dataset artifacts unavailable: {e}", file=stderr)
+
+        if resource:
+            # RLIMIT_CPU counts the whole process lifetime, so the budget is
+            # relative to what the worker has already used
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            used = math.ceil(usage.ru_utime + usage.ru_stime)
+            resource.setrlimit(resource.RLIMIT_CPU, (used + SANDBOX_CPU_SECONDS, cpu_hard))
+        exec(job["code"], {}, local_vars)
+    except MemoryError:
+        print(f"Error during code execution: memory limit of {SANDBOX_MEMORY_MB} MB exceeded")
+    except (Exception, CpuLimitExceeded) as e:
+        print(f"Error during code execution: {e}")
+    finally:
+        if resource:
+            resource.setrlimit(resource.RLIMIT_CPU, (cpu_hard, cpu_hard))
+        try:
+            images = _collect_images(scratch_dir, job["output_dir"], job["image_name"])
+        except Exception as e:
+            print(f"Failed to save generated images: {e}", file=stderr)
+        sys.stdout = old_stdout
+        sys.stderr = old_stderr
+        if job.get("stream"):
+            stdout.flush_pending()
+        os.chdir(old_cwd)
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+        import matplotlib.pyplot as plt
+        plt.close("all")
+    # Peak memory of the worker so far, in bytes (ru_maxrss is in kilobytes)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 if resource else None
+    return {"stdout": stdout.getvalue(), "stderr": stderr.getvalue(), "images": images, "peak_rss_bytes": peak_rss}
+
+def _worker_main(conn):
+    """Entry point of a sandbox worker: warm up, then serve jobs until told to stop."""
+    # Import the heavy libraries once so jobs start immediately
+    import pandas  # noqa: F401
+    import utils.out_of_core  # noqa: F401
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot  # noqa: F401
+    from matplotlib.figure import Figure
+    Figure.savefig = _track_savefig(Figure.savefig)
+
+    if resource:
+        if SANDBOX_MEMORY_MB:
+            limit = SANDBOX_MEMORY_MB * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        signal.signal(signal.SIGXCPU, _on_cpu_limit)
+
+    tables = OrderedDict()
+    conn.send("ready")
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+        conn.send(_execute_job(job, tables, conn))
+
+# --- API process side ---
+
+class _Worker:
+    def __init__(self, context):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.ready = False
+
+    def wait_ready(self, timeout: float) -> bool:
+        if not self.ready and self.conn.poll(timeout):
+            self.ready = self.conn.recv() == "ready"
+        return self.ready
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+class SandboxPool:
+    """
+    A pool of long-lived worker processes that execute generated code in
+    isolation. A job that overruns its wall-clock limit or crashes its worker
+    gets the worker killed and replaced; the rest of the pool is unaffected.
+    """
+
+    def __init__(self, size: int):
+        # forkserver keeps the workers from inheriting the API process's
+        # threads and sockets; Windows only supports spawn
+        start_method = "forkserver" if os.name != "nt" else "spawn"
+        self._context = multiprocessing.get_context(start_method)
+        self._idle = queue.Queue()
+        self.size = size
+        for _ in range(size):
+            self._idle.put(_Worker(self._context))
+
+    def run(self, code: str, frame: dict, output_dir: str, image_name: str, artifacts_dir: str | None = None,
+            on_output=None, cancelled: threading.Event | None = None) -> dict:
+        """
+        Executes code against a dataset frame, with the dataset's precomputed
+        artifacts when given, and returns its stdout, stderr and the paths of
+        the images it produced, saved into output_dir.
+
+        on_output, if given, is called with each piece of stdout while the
+        code runs. Setting cancelled stops the job by killing its worker and
+        raises SandboxCancelled.
+        """
+        worker = self._idle.get()
+        try:
+            if not worker.wait_ready(SANDBOX_WALL_SECONDS):
+                raise TimeoutError("Sandbox worker failed to start")
+            worker.conn.send({
+                "code": code, "frame": frame, "output_dir": output_dir,
+                "image_name": image_name, "artifacts_dir": artifacts_dir,
+                "stream": on_output is not None,
+            })
+            deadline = time.monotonic() + SANDBOX_WALL_SECONDS
+            while True:
+                remaining = deadline - time.monotonic()
+                # Cancellable jobs wake up regularly to check for it
+                wait = min(remaining, 0.1) if cancelled else remaining
+                if cancelled and cancelled.is_set():
+                    raise SandboxCancelled("Code execution was cancelled")
+                if remaining <= 0:
+                    raise TimeoutError(f"Code execution exceeded the {SANDBOX_WALL_SECONDS}s time limit")
+                if not worker.conn.poll(max(wait, 0)):
+                    continue
+                message = worker.conn.recv()
+                if isinstance(message, tuple):
+                    on_output(message[1])
+                    continue
+                return message
+        except SandboxCancelled:
+            worker.kill()
+            worker = _Worker(self._context)
+            raise
+        except (TimeoutError, EOFError, OSError) as e:
+            worker.kill()
+            worker = _Worker(self._context)
+            message = str(e) or "Sandbox worker exited unexpectedly"
+            return {"stdout": f"Error during code execution: {message}\n", "stderr": "", "images": []}
+        finally:
+            self._idle.put(worker)
+
+    def warm_up(self, timeout: float) -> bool:
+        """Waits until every worker has started. Returns whether they all did within timeout."""
+        deadline = time.monotonic() + timeout
+        workers = []
+        try:
+            while len(workers) < self.size:
+                workers.append(self._idle.get(timeout=max(deadline - time.monotonic(), 0)))
+            return all(worker.wait_ready(max(deadline - time.monotonic(), 0)) for worker in workers)
+        except queue.Empty:
+            return False
+        finally:
+            for worker in workers:
+                self._idle.put(worker)
+
+    def shutdown(self):
+        """Stops the idle workers; workers busy with a job are stopped when it ends."""
+        while not self._idle.empty():
+            worker = self._idle.get_nowait()
+            try:
+                worker.conn.send(None)
+            except OSError:
+                pass
+            worker.kill()
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_sandbox_pool() -> SandboxPool:
+    """Returns the process-wide sandbox pool, starting its workers on first use."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = SandboxPool(SANDBOX_WORKERS)
+        return _pool
+
+def shutdown_sandbox():
+    """Stops the sandbox workers, if started, and frees the shared memory blocks."""
+    global _pool, _shared_bytes
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool:
+        pool.shutdown()
+    with _shared_lock:
+        while _shared_frames:
+            _, (_, handle, _) = _shared_frames.popitem()
+            _release(handle)
+        _shared_bytes = 0
+
+# key -> (fingerprint, SharedMemory, size), least recently used first
+_shared_frames: OrderedDict = OrderedDict()
+_shared_bytes = 0
+_shared_lock = threading.Lock()
+
+def _release(handle: shared_memory.SharedMemory):
+    handle.close()
+    handle.unlink()
+
+def share_dataframe(key: str, fingerprint, df) -> dict | None:
+    """
+    Publishes a DataFrame to shared memory as an Arrow IPC stream so workers
+    can map it instead of receiving a pickled copy. The block is reused for
+    as long as the dataset fingerprint is unchanged, and the least recently
+    used blocks are freed to keep all of them within SANDBOX_SHARED_MB.
+    Returns None for frames larger than that on their own.
+    """
+    global _shared_bytes
+    with _shared_lock:
+        entry = _shared_frames.get(key)
+        if entry and entry[0] == fingerprint:
+            _shared_frames.move_to_end(key)
+            return {"shm_name": entry[1].name, "size": entry[2]}
+
+        table = pa.Table.from_pandas(df)
+        # Size the stream first so it can be written straight into the block
+        mock_sink = pa.MockOutputStream()
+        with pa.ipc.new_stream(mock_sink, table.schema) as writer:
+            writer.write_table(table)
+        size = mock_sink.size()
+        if size > SANDBOX_SHARED_MAX_BYTES:
+            return None
+
+        handle = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        sink = pa.FixedSizeBufferWriter(pa.py_buffer(handle.buf))
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        del sink
+
+        if entry:
+            _release(_shared_frames.pop(key)[1])
+            _shared_bytes -= entry[2]
+        _shared_frames[key] = (fingerprint, handle, size)
+        _shared_bytes += size
+        while _shared_bytes > SANDBOX_SHARED_MAX_BYTES:
+            _, (_, old_handle, old_size) = _shared_frames.popitem(last=False)
+            _release(old_handle)
+            _shared_bytes -= old_size
+        return {"shm_name": handle.name, "size": size}
+
+def release_shared_dataframe(key: str):
+    """Frees the shared memory block of a dataset."""
+    global _shared_bytes
+    with _shared_lock:
+        entry = _shared_frames.pop(key, None)
+        if entry:
+            _release(entry[1])
+            _shared_bytes -= entry[2]
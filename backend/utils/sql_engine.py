@@ -0,0 +1,116 @@
+import os
+import tempfile
+import threading
+import duckdb
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.dataset as ds
+from utils.dataloader import detect_encoding
+from utils.local_storage import find_columnar_copy
+from utils.metrics import timed, record_io
+
+# Rows of a query result that are printed
+SQL_MAX_ROWS = int(os.getenv("SQL_MAX_ROWS", "1000"))
+SQL_TIMEOUT_SECONDS = float(os.getenv("SQL_TIMEOUT_SECONDS", "60"))
+# Memory DuckDB may use per query before spilling to disk
+SQL_MEMORY_MB = int(os.getenv("SQL_MEMORY_MB", "2048"))
+SQL_THREADS = int(os.getenv("SQL_THREADS", str(os.cpu_count() or 1)))
+SQL_SPILL_DIR = os.getenv("SQL_SPILL_DIR", os.path.join(tempfile.gettempdir(), "duckdb_spill"))
+
+# Name of the table generated SQL queries read
+TABLE_NAME = "df"
+
+class SQLValidationError(ValueError):
+    """Raised for generated SQL that is not a single read-only query."""
+
+def _open_dataset(file_path: str, session_id: str | None = None):
+    """
+    Opens a dataset as an Arrow source DuckDB scans lazily: the columnar copy
+    if there is one (Arrow files memory-mapped), otherwise the CSV.
+    """
+    columnar_path = find_columnar_copy(file_path)
+    if columnar_path and columnar_path.endswith(".parquet"):
+        return ds.dataset(columnar_path, format="parquet")
+    if columnar_path:
+        return pa.ipc.open_file(pa.memory_map(columnar_path, "r")).read_all()
+    read_options = pacsv.ReadOptions(encoding=detect_encoding(file_path, session_id))
+    return ds.dataset(file_path, format=ds.CsvFileFormat(read_options=read_options))
+
+def _connect(source) -> duckdb.DuckDBPyConnection:
+    """
+    Opens an in-memory DuckDB with the dataset registered as `df`. File and
+    network access are then disabled and the settings locked, so a query can
+    only read the dataset.
+    """
+    os.makedirs(SQL_SPILL_DIR, exist_ok=True)
+    con = duckdb.connect(":memory:")
+    con.execute(f"SET threads = {SQL_THREADS}")
+    con.execute(f"SET memory_limit = '{SQL_MEMORY_MB}MB'")
+    con.execute(f"SET temp_directory = '{SQL_SPILL_DIR}'")
+    con.register(TABLE_NAME, source)
+    con.execute("SET enable_external_access = false")
+    con.execute("SET lock_configuration = true")
+    return con
+
+def validate_sql(con, sql: str) -> str:
+    """Returns the query if it is a single SELECT statement, else raises SQLValidationError."""
+    try:
+        statements = con.extract_statements(sql)
+    except duckdb.Error as e:
+        raise SQLValidationError(f"Invalid SQL: {e}")
+    if len(statements) != 1:
+        raise SQLValidationError("Expected exactly one SQL statement")
+    if statements[0].type != duckdb.StatementType.SELECT:
+        raise SQLValidationError("Only SELECT queries can be run")
+    return sql.strip().rstrip(";")
+
+def query_dataset(sql: str, file_path: str, session_id: str | None = None, limit: int | None = None):
+    """
+    Runs a single SELECT over a dataset registered as `df` and returns the
+    result as a DataFrame, of at most `limit` rows if given. DuckDB scans the
+    dataset lazily and spills to SQL_SPILL_DIR, so datasets larger than
+    memory work too. Raises SQLValidationError for anything but a SELECT,
+    and duckdb.InterruptException after SQL_TIMEOUT_SECONDS.
+    """
+    con = _connect(_open_dataset(file_path, session_id))
+    timer = threading.Timer(SQL_TIMEOUT_SECONDS, con.interrupt)
+    try:
+        query = validate_sql(con, sql)
+        timer.start()
+        relation = con.sql(query)
+        if limit is not None:
+            relation = relation.limit(limit)
+        return relation.df()
+    finally:
+        timer.cancel()
+        con.close()
+
+def run_sql(sql: str, file_path: str, session_id: str | None = None):
+    """
+    Runs a generated SQL query over a session's dataset in an embedded DuckDB
+    and prints its first SQL_MAX_ROWS rows. The query is interrupted after
+    SQL_TIMEOUT_SECONDS.
+
+    Returns:
+        tuple: (stdout, stderr, flags, image paths), like run_generated_code
+    """
+    output, error = "", ""
+    try:
+        with timed("sql_exec"):
+            result = query_dataset(sql, file_path, session_id, limit=SQL_MAX_ROWS + 1)
+        record_io("sql_exec", rows=len(result))
+        truncated = len(result) > SQL_MAX_ROWS
+        output = result.head(SQL_MAX_ROWS).to_string(index=False) + "\n"
+        if truncated:
+            output += f"(showing the first {SQL_MAX_ROWS} rows)\n"
+    except duckdb.InterruptException:
+        error = f"SQL query exceeded the {SQL_TIMEOUT_SECONDS:g} s time limit"
+    except (duckdb.Error, SQLValidationError, pa.ArrowException, OSError) as e:
+        error = f"{type(e).__name__}: {e}"
+
+    flags = {
+        "image_generated": False,
+        "stdout_generated": bool(output.strip()),
+        "both_generated": False
+    }
+    return output, error, flags, []